@@ -1,11 +1,20 @@
+import os
 import time
+import uuid
 from sqlite3 import IntegrityError
+from typing import Optional
 
-from flask import Blueprint, flash, redirect, render_template, request, url_for, current_app, g
+from flask import Blueprint, flash, redirect, render_template, request, url_for, current_app, g, jsonify, send_file
 
 from auth import login_required
 from core import save_student_photo, save_student_face_descriptor
-from db import add_student_to_course, fetch_all_admin, create_user, delete_user_by_id, fetch_user_by_username
+from data_model import Job
+from db import (
+    add_student_to_course, fetch_all_admin, create_user, delete_user_by_id, fetch_user_by_username,
+    enqueue_job, fetch_job_by_id
+)
+from enroll import enroll, read_report, STATUS_OK
+from roster import import_roster_file, read_report as read_roster_report, STATUS_ERROR
 
 bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -28,8 +37,8 @@ def course_manager():
         if error is None:
             try:
                 add_student_to_course(student_username, course_id)
-            except IntegrityError:
-                error = '无法将学生添加到课程'
+            except IntegrityError:  # 学生已在该课程中
+                error = '学生已在该课程中'
             except RuntimeError as e:  # 学生不存在，或教师不存在
                 error = str(e)
             else:
@@ -50,6 +59,7 @@ def photo_manager():
     if request.method == 'POST':
         file = request.files['file']
         student_username = request.form['student_username'].strip()
+        append = request.form.get('append') == 'on'
         error = None
 
         if g.user.role not in [2, 3]:
@@ -68,8 +78,8 @@ def photo_manager():
         if error is None:
             try:
                 start = time.time()
-                photo_path = save_student_photo(student_username, file)
-                save_student_face_descriptor(student_username, photo_path)
+                photo_path = save_student_photo(student_username, file, append=append)
+                save_student_face_descriptor(student_username, photo_path, append=append)
             except Exception as e:
                 error = str(e)
             else:
@@ -85,6 +95,180 @@ def photo_manager():
     return render_template('admin/photo_manager.html')
 
 
+@bp.route('/enroll', methods=('GET', 'POST'))
+@login_required
+def enroll_manager():
+    if g.user.role not in [2, 3]:
+        g.error = '你所在的用户组无法执行此操作'
+        return render_template('error.html')
+
+    if request.method == 'POST':
+        file = request.files['file']
+        if file.filename == '':
+            flash('请选择一个文件')
+            return redirect(request.url)
+
+        name = uuid.uuid4().hex
+        file.save(os.path.join(current_app.config['TEMP'], f'{name}.zip'))
+        job_id = enqueue_job(
+            'enroll', {'archive': f'{name}.zip', 'report': f'{name}.report.csv', 'admin_id': g.user.id}
+        )
+        current_app.logger.info(f'{g.user.nickname}（{g.user.username}）已提交批量录入照片任务 {job_id}')
+        return redirect(url_for('admin.enroll_job', job_id=job_id))
+
+    return render_template('admin/enroll.html')
+
+
+def fetch_admin_job(job_id: int, kind: str) -> Optional[Job]:
+    """只返回当前管理员提交的 kind 类型的任务"""
+    admin_job = fetch_job_by_id(job_id)
+    if admin_job is None or admin_job.kind != kind or admin_job.payload.get('admin_id') != g.user.id:
+        return None
+    return admin_job
+
+
+def fetch_enroll_job(job_id: int) -> Optional[Job]:
+    return fetch_admin_job(job_id, 'enroll')
+
+
+def job_status(admin_job: Optional[Job]):
+    """供任务页面轮询任务状态"""
+    if admin_job is None:
+        return jsonify({'error': '任务不存在'}), 404
+
+    return jsonify({
+        'id': admin_job.id,
+        'status': admin_job.status,
+        'attempts': admin_job.attempts,
+        'error': admin_job.error,
+    })
+
+
+@bp.route('/enroll/job/<int:job_id>')
+@login_required
+def enroll_job(job_id: int):
+    enroll_job = fetch_enroll_job(job_id)
+    if enroll_job is None:
+        g.error = '批量录入任务不存在'
+        return render_template('error.html')
+
+    return render_template('admin/enroll_job.html', job=enroll_job, headline=['文件名', '学号', '状态', '说明'])
+
+
+@bp.route('/enroll/job/<int:job_id>/status')
+@login_required
+def enroll_job_status(job_id: int):
+    """供批量录入任务页面轮询任务状态"""
+    return job_status(fetch_enroll_job(job_id))
+
+
+@bp.route('/enroll/job/<int:job_id>/report')
+@login_required
+def enroll_job_report(job_id: int):
+    enroll_job = fetch_enroll_job(job_id)
+    report_path = os.path.join(current_app.config['TEMP'], enroll_job.payload['report']) if enroll_job else None
+    if report_path is None or not os.path.isfile(report_path):
+        g.error = '报告不存在'
+        return render_template('error.html')
+
+    return send_file(os.path.abspath(report_path), mimetype='text/csv', as_attachment=True,
+                     download_name=f'enroll_{job_id}.csv')
+
+
+def run_enroll_job(enroll_job: Job) -> dict:
+    """由 worker 执行的批量录入任务，任务重试时从报告中断处继续"""
+    source = os.path.join(current_app.config['TEMP'], enroll_job.payload['archive'])
+    report_path = os.path.join(current_app.config['TEMP'], enroll_job.payload['report'])
+
+    start = time.time()
+    counts = enroll(source, report_path, current_app.logger)
+    current_app.logger.info(f'批量录入照片结束，耗时 {time.time() - start:.3f} 秒')
+    os.remove(source)
+
+    return {
+        'counts': dict(counts),
+        'failures': [result._asdict() for result in read_report(report_path) if result.status != STATUS_OK],
+    }
+
+
+@bp.route('/roster', methods=('GET', 'POST'))
+@login_required
+def roster_manager():
+    if g.user.role not in [2, 3]:
+        g.error = '你所在的用户组无法执行此操作'
+        return render_template('error.html')
+
+    if request.method == 'POST':
+        file = request.files['file']
+        if file.filename == '':
+            flash('请选择一个文件')
+            return redirect(request.url)
+
+        name = uuid.uuid4().hex
+        file.save(os.path.join(current_app.config['TEMP'], f'{name}.csv'))
+        job_id = enqueue_job('roster', {
+            'roster': f'{name}.csv',
+            'report': f'{name}.report.csv',
+            'dry_run': request.form.get('dry_run') == 'on',
+            'admin_id': g.user.id,
+        })
+        current_app.logger.info(f'{g.user.nickname}（{g.user.username}）已提交导入名单任务 {job_id}')
+        return redirect(url_for('admin.roster_job', job_id=job_id))
+
+    return render_template('admin/roster.html')
+
+
+@bp.route('/roster/job/<int:job_id>')
+@login_required
+def roster_job(job_id: int):
+    roster_job = fetch_admin_job(job_id, 'roster')
+    if roster_job is None:
+        g.error = '导入名单任务不存在'
+        return render_template('error.html')
+
+    return render_template('admin/roster_job.html', job=roster_job, headline=['行号', '用户名', '课程代号', '说明'])
+
+
+@bp.route('/roster/job/<int:job_id>/status')
+@login_required
+def roster_job_status(job_id: int):
+    """供导入名单任务页面轮询任务状态"""
+    return job_status(fetch_admin_job(job_id, 'roster'))
+
+
+@bp.route('/roster/job/<int:job_id>/report')
+@login_required
+def roster_job_report(job_id: int):
+    roster_job = fetch_admin_job(job_id, 'roster')
+    report_path = os.path.join(current_app.config['TEMP'], roster_job.payload['report']) if roster_job else None
+    if report_path is None or not os.path.isfile(report_path):
+        g.error = '报告不存在'
+        return render_template('error.html')
+
+    return send_file(os.path.abspath(report_path), mimetype='text/csv', as_attachment=True,
+                     download_name=f'roster_{job_id}.csv')
+
+
+def run_roster_job(roster_job: Job) -> dict:
+    """由 worker 执行的导入名单任务，名单在同一个事务中写入，重试时已导入的行会被跳过"""
+    source = os.path.join(current_app.config['TEMP'], roster_job.payload['roster'])
+    report_path = os.path.join(current_app.config['TEMP'], roster_job.payload['report'])
+
+    start = time.time()
+    counts = import_roster_file(source, report_path, roster_job.payload.get('dry_run', False), current_app.logger)
+    current_app.logger.info(f'导入名单结束，耗时 {time.time() - start:.3f} 秒')
+    os.remove(source)
+
+    return {
+        'counts': dict(counts),
+        'dry_run': roster_job.payload.get('dry_run', False),
+        # 只在页面上显示前 1000 个错误，完整的结果见报告
+        'failures': [
+            result._asdict() for result in read_roster_report(report_path) if result.status == STATUS_ERROR
+        ][:1000],
+    }
+
+
 @bp.route('/admin_manager')
 @login_required
 def admin_manager():
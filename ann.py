@@ -0,0 +1,255 @@
+"""
+全校范围的近似最近邻索引，用于识别不在课程名单中的学生（例如走错教室、旁听）
+
+IVFIndex 用 k-means 将所有特征划分为若干个列表，查询时只扫描与人脸最近的 n_probe 个列表。
+开启量化时，列表中只保存特征相对于聚类中心的残差，按每个特征的最大绝对值缩放为 int8，
+内存占用约为 float32 的四分之一，近似距离最小的 rerank 个候选再从人脸特征存储中读取原始特征计算精确距离
+
+SchoolIndex 在 IVFIndex 之上对接人脸特征存储：每次查询前增量添加新录入的特征，
+存储被压缩（行号发生变化）或特征数增长到训练时的数倍后重新训练
+"""
+import threading
+from typing import Callable, Optional
+
+import numpy as np
+
+from config_local import ANN_N_PROBE, ANN_QUANTIZE, ANN_RERANK
+from matching import distance_matrix
+from store import DescriptorStore, descriptor_store
+
+
+def kmeans(x: np.ndarray, k: int, n_iter=20, seed=0) -> np.ndarray:
+    """返回 k 个聚类中心，x 的形状为 (N, D)"""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].astype(np.float64)
+    for _ in range(n_iter):
+        assign = nearest_centroid(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        # 按聚类排序后分段求和，比 np.add.at 快得多
+        order = np.argsort(assign, kind='stable')
+        sums = np.zeros_like(centroids)
+        present = np.flatnonzero(counts)
+        sums[present] = np.add.reduceat(x[order], np.searchsorted(assign[order], present), axis=0)
+        empty = counts == 0
+        # 空的聚类重新以随机的特征作为中心
+        sums[empty] = x[rng.choice(len(x), size=int(empty.sum()))]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+    return centroids.astype(np.float32)
+
+
+def nearest_centroid(x: np.ndarray, centroids: np.ndarray, batch_size=4096) -> np.ndarray:
+    """分批计算，避免 (N, k) 的距离矩阵占用过多内存"""
+    return np.concatenate([
+        distance_matrix(x[i:i + batch_size], centroids).argmin(axis=1) for i in range(0, len(x), batch_size)
+    ]) if len(x) else np.zeros(0, dtype=np.int64)
+
+
+class IVFIndex:
+    """倒排文件索引，ids 为调用方定义的整数编号"""
+
+    def __init__(self, centroids: np.ndarray, quantize=True):
+        self.centroids = centroids
+        self.quantize = quantize
+        n_lists = len(centroids)
+        self._ids = [np.zeros(0, dtype=np.int64) for _ in range(n_lists)]
+        # 量化时保存 int8 残差与缩放系数，否则保存 float32 原始特征
+        self._vectors = [
+            np.zeros((0, centroids.shape[1]), dtype=np.int8 if quantize else np.float32) for _ in range(n_lists)
+        ]
+        self._scales = [np.zeros(0, dtype=np.float32) for _ in range(n_lists)]
+        self._norms = [np.zeros(0, dtype=np.float32) for _ in range(n_lists)]  # 量化后残差的模长的平方
+        self.size = 0
+
+    @classmethod
+    def train(cls, x: np.ndarray, n_lists: Optional[int] = None, quantize=True, seed=0) -> 'IVFIndex':
+        """n_lists 默认为特征数的平方根，训练使用最多 256 * n_lists 个随机特征"""
+        n_lists = n_lists or max(1, int(np.sqrt(len(x))))
+        n_lists = min(n_lists, len(x))
+        rng = np.random.default_rng(seed)
+        sample = x[rng.choice(len(x), size=min(len(x), 256 * n_lists), replace=False)]
+        return cls(kmeans(np.asarray(sample, dtype=np.float32), n_lists, seed=seed), quantize=quantize)
+
+    @property
+    def nbytes(self) -> int:
+        return self.centroids.nbytes + sum(
+            ids.nbytes + vectors.nbytes + scales.nbytes + norms.nbytes
+            for ids, vectors, scales, norms in zip(self._ids, self._vectors, self._scales, self._norms)
+        )
+
+    def add(self, ids: np.ndarray, x: np.ndarray) -> None:
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.centroids.shape[1])
+        assign = nearest_centroid(x, self.centroids)
+        for c in np.unique(assign):
+            members = assign == c
+            vectors = x[members]
+            self._ids[c] = np.concatenate([self._ids[c], ids[members]])
+            if self.quantize:
+                residuals = vectors - self.centroids[c]
+                scales = np.abs(residuals).max(axis=1) / 127
+                codes = np.round(residuals / np.maximum(scales, 1e-12)[:, None]).astype(np.int8)
+                norms = np.einsum('ij,ij->i', codes, codes, dtype=np.float32) * scales ** 2
+                self._vectors[c] = np.concatenate([self._vectors[c], codes])
+                self._scales[c] = np.concatenate([self._scales[c], scales.astype(np.float32)])
+                self._norms[c] = np.concatenate([self._norms[c], norms.astype(np.float32)])
+            else:
+                self._vectors[c] = np.concatenate([self._vectors[c], vectors])
+        self.size += len(x)
+
+    def search(
+            self,
+            queries: np.ndarray,
+            k=1,
+            n_probe=8,
+            rerank=32,
+            exact: Optional[Callable[[np.ndarray], np.ndarray]] = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        返回每个查询最近的 k 个编号与距离，形状均为 (查询数, k)，不足 k 个时编号为 -1、距离为 inf
+
+        量化时近似距离最小的 rerank 个候选会通过 exact(ids) 读取原始特征计算精确距离，
+        exact 为 None 时直接返回近似距离
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.centroids.shape[1])
+        result_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        result_distances = np.full((len(queries), k), np.inf)
+        if not len(queries):
+            return result_ids, result_distances
+
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argsort(distance_matrix(queries, self.centroids), axis=1)[:, :n_probe]
+
+        # 按列表而不是按查询遍历，探查同一个列表的所有查询一次性计算
+        candidate_ids = [[] for _ in range(len(queries))]
+        candidate_distances = [[] for _ in range(len(queries))]
+        for c in np.unique(probes):
+            if not len(self._ids[c]):
+                continue
+            members = np.flatnonzero((probes == c).any(axis=1))
+            if self.quantize:
+                # |q - (c + s * r)|^2 = |q - c|^2 - 2s(q - c)·r + s^2|r|^2，不需要将 int8 残差还原为特征
+                offsets = queries[members] - self.centroids[c]
+                dots = offsets @ self._vectors[c].T.astype(np.float32)
+                squared = (np.einsum('ij,ij->i', offsets, offsets)[:, None]
+                           - 2 * dots * self._scales[c][None, :] + self._norms[c][None, :])
+                distances = np.sqrt(np.maximum(squared, 0))
+            else:
+                distances = distance_matrix(queries[members], self._vectors[c])
+            for member, member_distances in zip(members, distances):
+                candidate_ids[member].append(self._ids[c])
+                candidate_distances[member].append(member_distances)
+
+        for q, query in enumerate(queries):
+            if not candidate_ids[q]:
+                continue
+            ids = np.concatenate(candidate_ids[q])
+            distances = np.concatenate(candidate_distances[q])
+
+            if self.quantize and exact is not None:
+                candidates = top_k(distances, max(rerank, k))
+                ids = ids[candidates]
+                distances = distance_matrix(query[None], exact(ids))[0]
+
+            best = top_k(distances, k)
+            result_ids[q, :len(best)] = ids[best]
+            result_distances[q, :len(best)] = distances[best]
+        return result_ids, result_distances
+
+
+def top_k(distances: np.ndarray, k: int) -> np.ndarray:
+    """返回距离最小的 k 个下标，按距离从小到大排列"""
+    if len(distances) > k:
+        candidates = np.argpartition(distances, k - 1)[:k]
+    else:
+        candidates = np.arange(len(distances))
+    return candidates[np.argsort(distances[candidates])]
+
+
+class SchoolIndex:
+    """全校所有学生照片库的索引，编号为人脸特征存储中的行号"""
+
+    def __init__(self, store: DescriptorStore, n_probe: int, quantize: bool, rerank: int, retrain_factor=4):
+        self.store = store
+        self.n_probe = n_probe
+        self.quantize = quantize
+        self.rerank = rerank
+        self.retrain_factor = retrain_factor
+        self._lock = threading.Lock()
+        self._index: Optional[IVFIndex] = None
+        self._generation: Optional[int] = None
+        self._trained_size = 0
+        self._version = None
+        self._usernames: dict[int, str] = {}  # 行号 -> 学号，只包含仍在照片库中的行
+
+    def sync(self) -> None:
+        """增量添加新录入的特征，必要时重新训练"""
+        version = self.store.version()
+        if version == self._version:
+            return
+        generation, rows, usernames = self.store.live_rows()
+        with self._lock:
+            self._version = version
+            if (
+                    self._index is None
+                    or generation != self._generation
+                    or len(rows) > self.retrain_factor * max(self._trained_size, 256)
+            ):
+                self._build(generation, rows, usernames)
+                return
+
+            # 被替换或删除的行不再对应任何学生，查询时会被过滤掉
+            new_ids = np.array([row for row in rows.tolist() if row not in self._usernames], dtype=np.int64)
+            self._usernames = dict(zip(rows.tolist(), usernames))
+            if len(new_ids):
+                read_generation, vectors = self.store.read_rows(new_ids)
+                if read_generation != generation:  # 读取期间存储被压缩，下次查询时重新训练
+                    self._version = None
+                    self._index = None
+                    return
+                self._index.add(new_ids, vectors)
+
+    def identify(self, faces: np.ndarray, k=1) -> list[list[tuple[str, float]]]:
+        """返回每张人脸最近的 k 名学生 (学号, 距离)，同一名学生的多个特征只计一次"""
+        self.sync()
+        with self._lock:
+            if self._index is None or not self._usernames:
+                return [[] for _ in range(len(faces))]
+            generation = self._generation
+
+            def exact(ids: np.ndarray) -> np.ndarray:
+                read_generation, vectors = self.store.read_rows(ids)
+                if read_generation != generation:  # 查询期间存储被压缩，行号已经失效
+                    raise RuntimeError('人脸特征存储已被压缩，请重新查询')
+                return vectors
+
+            # 多取一些候选，以便去除已删除的行以及同一名学生的重复特征
+            ids, distances = self._index.search(
+                faces, k=k * 4 + 4, n_probe=self.n_probe, rerank=self.rerank, exact=exact
+            )
+            results = []
+            for face_ids, face_distances in zip(ids, distances):
+                identities = {}
+                for row, distance in zip(face_ids.tolist(), face_distances.tolist()):
+                    username = self._usernames.get(row)
+                    if username is not None and username not in identities:
+                        identities[username] = distance
+                results.append(list(identities.items())[:k])
+            return results
+
+    def _build(self, generation: int, rows: np.ndarray, usernames: list[str]) -> None:
+        self._generation = generation
+        self._usernames = dict(zip(rows.tolist(), usernames))
+        self._trained_size = len(rows)
+        if not len(rows):
+            self._index = None
+            return
+        read_generation, vectors = self.store.read_rows(rows)
+        if read_generation != generation:  # 读取期间存储被压缩，下次查询时重新训练
+            self._version = None
+            self._index = None
+            return
+        self._index = IVFIndex.train(vectors, quantize=self.quantize)
+        self._index.add(rows, vectors)
+
+
+school_index = SchoolIndex(descriptor_store, ANN_N_PROBE, ANN_QUANTIZE, ANN_RERANK)
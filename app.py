@@ -1,10 +1,17 @@
 import os.path
 
-from flask import Flask, url_for, redirect
+from flask import Flask, Response, url_for, redirect, jsonify, abort
 
-from db import init_db
+import metrics
+from core import models
+from db import close_db
+from migrations import init_db, migrate_db
+from worker import collect_job_metrics
 
 app = Flask(__name__)
+app.teardown_appcontext(close_db)
+app.before_request(metrics.start_request_timer)
+app.after_request(metrics.observe_request)
 
 
 @app.route('/')
@@ -12,6 +19,22 @@ def index():
     return redirect(url_for('dashboard.index'))
 
 
+@app.route('/healthz')
+def healthz():
+    """服务端始终可以响应，DETECTOR 所需的人脸识别模型全部载入后才返回 200"""
+    status = models.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 文本格式的指标，见 metrics.py"""
+    if not app.config['METRICS']:
+        abort(404)
+    collect_job_metrics()
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 def import_config():
     try:
         import config_local as config
@@ -44,6 +67,7 @@ def check_dir():
         os.path.isfile('model/dlib_face_recognition_resnet_model_v1.dat'),
         os.path.isfile('model/mmod_human_face_detector.dat'),
         os.path.isfile('model/shape_predictor_68_face_landmarks_GTX.dat'),
+        os.path.isfile(app.config['RECOGNITION_MODES'][app.config['RECOGNITION_MODE']]['landmarks']),
     ]):
         app.logger.warning("""
             'model 文件夹内缺少必要的模型文件，考勤功能将不能正常使用，请在'
@@ -60,6 +84,19 @@ def check_db():
         app.logger.warning(f'数据库不存在，将会在 {app.config["DATABASE"]} 中初始化创建数据库')
         with app.app_context():
             init_db()
+    else:
+        with app.app_context():
+            migrate_db()
+
+
+def check_descriptor_store():
+    # 导入旧版本保存在照片文件夹中的 <学号>.npy 文件
+    from store import descriptor_store
+
+    if len(descriptor_store) == 0:
+        count = descriptor_store.import_npy(app.config['PHOTO'])
+        if count:
+            app.logger.warning(f'已将 {count} 名学生的人脸特征导入 {app.config["DESCRIPTOR_STORE"]}')
 
 
 def register_blueprints():
@@ -74,12 +111,24 @@ def register_blueprints():
     app.register_blueprint(attendance.bp)
 
 
-def main():
+def init_app():
     import_config()
     check_dir()
     check_db()
+    check_descriptor_store()
     register_blueprints()
 
+
+def main():
+    from worker import start_worker_threads
+
+    init_app()
+
+    if app.config['MODEL_WARMUP']:
+        models.warm_up(app.logger)
+    if app.config['ATTENDANCE_WORKER_THREADS']:
+        start_worker_threads(app, app.config['ATTENDANCE_WORKER_THREADS'])
+
     app.run(host=app.config['HOST'], port=app.config['PORT'])
 
 
@@ -1,16 +1,23 @@
+import hashlib
 import os
 import time
+import uuid
+from typing import Optional
 
-from flask import Blueprint, flash, redirect, render_template, request, current_app, g
+from flask import Blueprint, flash, redirect, render_template, request, current_app, g, url_for, jsonify
+from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
+import metrics
 from auth import login_required
-from core import check_attendance, AttendanceStatus
-from data_model import User, Course
+from core import check_attendance, add_timing, AttendanceStatus, DETECTORS
+from data_model import User, Course, Job, COLOR_BLOCK
 from db import (
-    fetch_course_by_id, update_attendance_record,
-    fetch_course_from_teacher, fetch_attendance_detail_by_student, fetch_student_list_from_course
+    fetch_course_by_id, add_attendance_session, fetch_course_from_teacher, fetch_student_list_from_course,
+    enqueue_job, fetch_job_by_id, fetch_user_list_by_usernames
 )
+from descriptor_cache import descriptor_cache
+from face_cache import content_hash
 
 bp = Blueprint('attendance', __name__, url_prefix='/attendance')
 
@@ -20,7 +27,10 @@ bp = Blueprint('attendance', __name__, url_prefix='/attendance')
 def index():
     if g.user.role == 1:
         course_list = fetch_course_from_teacher(g.user.id)
-        return render_template('attendance/index.html', course_list=course_list)
+        return render_template(
+            'attendance/index.html', course_list=course_list, detectors=DETECTORS,
+            default_detector=current_app.config['DETECTOR']
+        )
     else:
         g.error = '你所在的用户组无法执行此操作'
         return render_template('error.html')
@@ -32,58 +42,183 @@ def post_photo():
     # if 'file' not in request.files:
     #     return redirect(request.url)
 
-    file = request.files['file']
+    # 同一次考勤可以上传多张照片，例如分别拍摄前排与后排
+    files = [file for file in request.files.getlist('file') if file.filename != '']
     course_id = request.form['course_id']
-    if file.filename == '':
+    detector = request.form.get('detector') or current_app.config['DETECTOR']
+    if not files:
         flash('请选择一个文件')
         return redirect(request.url)
     if not course_id:
         flash('请选择一个课程')
         return redirect(request.url)
+    if detector not in DETECTORS:
+        flash('请选择一个人脸检测器')
+        return redirect(request.url)
 
-    filename = secure_filename(file.filename)
-    save_path = os.path.join(current_app.config['TEMP'], filename)
-    file.save(save_path)
+    # 以内容哈希作为文件名，不同教师同时上传的同名照片不会互相覆盖，重复上传的照片只保存一份
+    photos = [save_photo(file) for file in files]
 
-    student_list = fetch_student_list_from_course(course_id)
-    course = fetch_course_by_id(course_id)
+    job_id = enqueue_job(
+        'attendance', {'course_id': course_id, 'photos': photos, 'teacher_id': g.user.id, 'detector': detector}
+    )
+    current_app.logger.info(f'{g.user.nickname}（{g.user.username}）已提交课程 {course_id} 的考勤任务 {job_id}')
+    return redirect(url_for('attendance.job', job_id=job_id))
 
-    start = time.time()
-    batch_attendance_result = attendance(course, student_list, save_path)
-    current_app.logger.info(f'考勤分析结束，耗时{time.time() - start:.3f}秒')
 
-    color_block_list = [generate_color_block(attendance_status) for attendance_status in batch_attendance_result]
-    headline = ['学号', '姓名']
+@bp.route('/job/<int:job_id>', methods=('GET',))
+@login_required
+def job(job_id: int):
+    attendance_job = fetch_job_by_id(job_id)
+    if attendance_job is None or attendance_job.payload.get('teacher_id') != g.user.id:
+        g.error = '考勤任务不存在'
+        return render_template('error.html')
+
+    if attendance_job.status != 'done':
+        return render_template('attendance/job.html', job=attendance_job)
 
+    students = attendance_job.result['students']
+    batch_attendance_result = [AttendanceStatus[student['status']] for student in students]
     return render_template(
-        'attendance/index.html',
+        'attendance/job.html',
+        job=attendance_job,
         zip=zip,  # 必须给定 zip 函数，因为 jinja2 默认没有定义该函数
-        headline=headline,
-        color_block_list=color_block_list,
-        student_list=student_list,
+        headline=['学号', '姓名'],
+        color_block_list=[generate_color_block(attendance_status) for attendance_status in batch_attendance_result],
+        student_list=students,
         count_present=batch_attendance_result.count(AttendanceStatus.PRESENT),
         count_absent=batch_attendance_result.count(AttendanceStatus.ABSENT),
+        other_list=attendance_job.result.get('others', []),
+    )
+
+
+@bp.route('/job/<int:job_id>/status', methods=('GET',))
+@login_required
+def job_status(job_id: int):
+    """供考勤任务页面轮询任务状态"""
+    attendance_job = fetch_job_by_id(job_id)
+    if attendance_job is None or attendance_job.payload.get('teacher_id') != g.user.id:
+        return jsonify({'error': '考勤任务不存在'}), 404
+
+    return jsonify({
+        'id': attendance_job.id,
+        'status': attendance_job.status,
+        'attempts': attendance_job.attempts,
+        'error': attendance_job.error,
+    })
+
+
+def save_photo(file: FileStorage) -> str:
+    """边保存边计算 sha256，返回保存在 TEMP 中的文件名 <sha256>.<后缀>"""
+    filename = secure_filename(file.filename)
+    suffix = filename.rsplit('.', 1)[1].lower() if '.' in filename else 'jpg'
+    temp_path = os.path.join(current_app.config['TEMP'], f'{uuid.uuid4().hex}.part')
+    sha256 = hashlib.sha256()
+    with open(temp_path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+            sha256.update(chunk)
+            f.write(chunk)
+
+    photo = f'{sha256.hexdigest()}.{suffix}'
+    # 同一张照片已经存在时内容相同，直接替换即可
+    os.replace(temp_path, os.path.join(current_app.config['TEMP'], photo))
+    return photo
+
+
+def run_attendance_job(attendance_job: Job) -> dict:
+    """由 worker 执行的考勤任务"""
+    course = fetch_course_by_id(attendance_job.payload['course_id'])
+    if course is None:
+        raise RuntimeError(f'课程 {attendance_job.payload["course_id"]} 不存在')
+    student_list = fetch_student_list_from_course(course.id)
+    photos = attendance_job.payload.get('photos') or [attendance_job.payload['photo']]  # 兼容只有一张照片的旧任务
+    photo_paths = [os.path.join(current_app.config['TEMP'], photo) for photo in photos]
+
+    start = time.time()
+    timings = {}
+    identified = [] if current_app.config['ANN_IDENTIFY_UNMATCHED'] else None
+    batch_attendance_result = attendance(
+        course, student_list, photo_paths, job_id=attendance_job.id, timings=timings, identified=identified,
+        detector=attendance_job.payload.get('detector')
+    )
+    frames = int(timings.pop('frames', 0))
+    # cascade 模式下各检测阶段检测到的人脸数
+    detector_faces = {key[len('faces_'):]: int(timings.pop(key)) for key in list(timings) if key.startswith('faces_')}
+    if detector_faces:
+        current_app.logger.info('检测到的人脸数：' + '，'.join(f'{stage} {count} 张' for stage, count in detector_faces.items()))
+        for stage, count in detector_faces.items():
+            metrics.detector_faces.inc(count, stage=stage)
+    if frames:
+        current_app.logger.info(f'共读取视频 {frames} 帧，处理速度 {frames / (time.time() - start):.1f} 帧/秒')
+    current_app.logger.info(
+        f'考勤分析结束，耗时{time.time() - start:.3f}秒（'
+        + '，'.join(f'{stage} {seconds:.3f} 秒' for stage, seconds in timings.items()) + '）'
     )
+    metrics.attendance_job_seconds.observe(time.time() - start)
+    for stage, seconds in timings.items():
+        metrics.attendance_stage_seconds.observe(seconds, stage=stage)
+    metrics.attendance_students_matched.observe(batch_attendance_result.count(AttendanceStatus.PRESENT))
+    for attendance_status in batch_attendance_result:
+        metrics.attendance_students.inc(status=attendance_status.name)
 
+    cache_stats = descriptor_cache.stats()
+    current_app.logger.info(f'人脸特征缓存命中 {cache_stats["hits"]} 次，未命中 {cache_stats["misses"]} 次')
 
-def attendance(course: Course, student_list: list[User], photo_path: str) -> list[AttendanceStatus]:
-    batch_attendance_result = check_attendance(student_list, photo_path, threshold=current_app.config['THRESHOLD'])
+    distances = dict(identified or [])
+    others = fetch_user_list_by_usernames(list(distances))
+    if others:
+        current_app.logger.info(f'识别到 {len(others)} 名不在课程 {course.id} 名单中的学生')
 
-    for attendance_status, student in zip(batch_attendance_result, student_list):
-        change_attendance_record(course.id, student.id, attendance_status)
+    return {
+        'students': [
+            {'username': student.username, 'nickname': student.nickname, 'status': attendance_status.name}
+            for attendance_status, student in zip(batch_attendance_result, student_list)
+        ],
+        'others': [
+            {'username': user.username, 'nickname': user.nickname, 'distance': round(distances[user.username], 3)}
+            for user in others
+        ],
+    }
+
+
+def attendance(
+        course: Course,
+        student_list: list[User],
+        photo_paths: list[str],
+        job_id: Optional[int] = None,
+        timings: Optional[dict[str, float]] = None,
+        identified: Optional[list[tuple[str, float]]] = None,
+        detector: Optional[str] = None
+) -> list[AttendanceStatus]:
+    batch_attendance_result = check_attendance(
+        student_list, photo_paths, threshold=current_app.config['THRESHOLD'], course_id=course.id, timings=timings,
+        identified=identified, detector=detector
+    )
+
+    start = time.perf_counter()
+    photo_hash = hash_photos(photo_paths)
+    add_timing(timings, 'hash', start)
+
+    # 整个班级的考勤结果在同一个事务中写入
+    start = time.perf_counter()
+    add_attendance_session(
+        course.id,
+        {student.id: attendance_status for attendance_status, student in zip(batch_attendance_result, student_list)},
+        photo_hash=photo_hash,
+        job_id=job_id
+    )
+    add_timing(timings, 'record', start)
 
     return batch_attendance_result
 
 
-def change_attendance_record(course_id: str, student_id: int, attendance_status: AttendanceStatus) -> None:
-    old_attendance = fetch_attendance_detail_by_student(course_id, student_id).attendance
-    new_attendance = old_attendance + [generate_color_block(attendance_status)]
-    update_attendance_record(course_id, student_id, new_attendance)
+def hash_photos(photo_paths: list[str]) -> str:
+    """只有一张照片时为该照片的 sha256，多张照片时为各照片 sha256 拼接后的 sha256"""
+    photo_hashes = [content_hash(photo_path) for photo_path in photo_paths]
+    if len(photo_hashes) == 1:
+        return photo_hashes[0]
+    return hashlib.sha256(''.join(photo_hashes).encode()).hexdigest()
 
 
 def generate_color_block(attendance_status: AttendanceStatus) -> str:
-    return {
-        AttendanceStatus.UNKNOWN: '🟥',
-        AttendanceStatus.PRESENT: '🟩',
-        AttendanceStatus.ABSENT: '🟥',
-    }.get(attendance_status, '🟨')
+    return COLOR_BLOCK.get(attendance_status, '🟨')
@@ -4,7 +4,7 @@ from sqlite3 import IntegrityError
 from flask import Blueprint, flash, redirect, render_template, request, session, url_for, g
 from werkzeug.security import check_password_hash
 
-from db import fetch_user_by_id, fetch_user_by_username, create_user
+from db import fetch_cached_user_by_id, fetch_user_by_username, create_user
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -81,7 +81,7 @@ def load_logged_in_user():
     if user_id is None:
         g.user = None
     else:
-        g.user = fetch_user_by_id(user_id)
+        g.user = fetch_cached_user_by_id(user_id)
 
 
 def login_required(view):
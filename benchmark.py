@@ -0,0 +1,817 @@
+"""
+性能基准测试，除 detect、detectors、video 与 embed 外无需模型文件即可运行，tracking 与 video 需要安装 opencv-python-headless
+
+用法：
+python benchmark.py compare [--students 500] [--faces 200] [--repeat 5]
+python benchmark.py queries [--sizes 10 300]
+python benchmark.py users [--requests 1000] [--users 50]
+python benchmark.py plans [--students 300]
+python benchmark.py detect <照片路径> [--repeat 3]
+python benchmark.py detectors <照片路径> [--expected 50] [--detectors hog cnn cascade]
+python benchmark.py video <照片路径> [--seconds 30] [--fps 25]
+python benchmark.py tracking [--seconds 20] [--fps 25] [--faces 5]
+python benchmark.py embed <照片路径> [--modes fast balanced accurate] [--repeat 3]
+python benchmark.py gallery [--students 500] [--faces 200] [--sizes 1 5 10] [--repeat 5]
+python benchmark.py ann [--students 20000] [--queries 200] [--probes 4 8 16]
+python benchmark.py suite [--sizes 10 100 1000] [--faces 1 50 200] [--output result.json] [--baseline baseline.json]
+
+suite 使用随机生成的数据，各用例的耗时写入 JSON 文件，给定 baseline 时与之比较，
+任一用例比基准慢超过 tolerance 时以状态码 1 退出
+
+仓库没有单独的测试套件，queries（面板页面的 SQL 语句数不随班级规模增长）、plans 与 tracking 同时作为回归检查，
+检查失败时以状态码 1 退出，修改对应的代码后应当运行
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+from unittest import mock
+
+import numpy as np
+from flask import Flask, redirect, url_for
+
+import db
+from data_model import AttendanceStatus
+from matching import distance_matrix, match_faces
+
+
+def legacy_compare_faces(
+        student_face_descriptors: list[Optional[np.ndarray]],
+        unknown_face_descriptors: list[np.ndarray],
+        threshold=0.4
+) -> list[AttendanceStatus]:
+    """原 core.compare_faces 的逐对循环实现，仅作为基准对照"""
+    result = []
+    for student_face_descriptor in student_face_descriptors:
+        if student_face_descriptor is None:
+            result.append(AttendanceStatus.UNKNOWN)
+            continue
+        for unknown_face_descriptor in unknown_face_descriptors:
+            distance = np.linalg.norm(student_face_descriptor - unknown_face_descriptor)
+            if distance < threshold:
+                result.append(AttendanceStatus.PRESENT)
+                break
+        else:
+            result.append(AttendanceStatus.ABSENT)
+
+    return result
+
+
+def generate_descriptors(n_students: int, n_faces: int, seed=0) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """生成随机的学生特征与人脸特征，约 90% 的学生录入了照片，约 80% 的人脸属于已录入的学生"""
+    rng = np.random.default_rng(seed)
+    # dlib 特征向量的模长约为 0.6，两个不同的人之间的距离通常大于 0.6
+    students = rng.normal(scale=0.055, size=(n_students, 128)).astype(np.float32)
+    mask = rng.random(n_students) < 0.9
+
+    n_known = min(int(n_faces * 0.8), int(mask.sum()))
+    known = rng.choice(np.flatnonzero(mask), size=n_known, replace=False)
+    faces = np.concatenate([
+        students[known] + rng.normal(scale=0.02, size=(n_known, 128)),
+        rng.normal(scale=0.055, size=(n_faces - n_known, 128)),
+    ]).astype(np.float32)
+    return students, mask, faces[rng.permutation(n_faces)]
+
+
+def timeit(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_compare_faces(n_students: int, n_faces: int, repeat: int) -> None:
+    students, mask, faces = generate_descriptors(n_students, n_faces)
+    student_list = [student if has_descriptor else None for student, has_descriptor in zip(students, mask)]
+    face_list = list(faces)
+
+    legacy = timeit(lambda: legacy_compare_faces(student_list, face_list), repeat)
+    vectorized = timeit(lambda: match_faces(students, mask, faces), repeat)
+
+    legacy_status = legacy_compare_faces(student_list, face_list)
+    vectorized_status = match_faces(students, mask, faces).status
+    mismatch = sum(a != b for a, b in zip(legacy_status, vectorized_status))
+
+    print(f'compare_faces：{n_students} 名学生 × {n_faces} 张人脸')
+    print(f'  逐对循环：{legacy * 1000:.2f} ms')
+    print(f'  批量矩阵 + 一对一匹配：{vectorized * 1000:.2f} ms（{legacy / vectorized:.1f} 倍）')
+    print(f'  结果不一致的学生数：{mismatch}')
+
+
+def bench_gallery(n_students: int, n_faces: int, sizes: list[int], repeat: int) -> None:
+    """比较不同照片库大小下匹配的耗时与内存占用"""
+    students, mask, faces = generate_descriptors(n_students, n_faces)
+    rng = np.random.default_rng(1)
+    print(f'照片库匹配：{n_students} 名学生 × {n_faces} 张人脸')
+    for k in sizes:
+        # 照片库中的特征为同一个人在不同外貌下的特征，第一个位置总是有特征，其余位置随机留空
+        gallery = (students[:, None, :] + rng.normal(scale=0.02, size=(n_students, k, 128))).astype(np.float32)
+        gallery_mask = (rng.random((n_students, k)) < 0.7) & mask[:, None]
+        gallery_mask[:, 0] = mask
+
+        memory = gallery.nbytes + gallery_mask.nbytes + n_students * k * n_faces * 8  # 照片库与距离矩阵
+        results = []
+        for mode in ['min', 'centroid']:
+            seconds = timeit(lambda: match_faces(gallery, gallery_mask, faces, mode=mode), repeat)
+            present = match_faces(gallery, gallery_mask, faces, mode=mode).status.count(AttendanceStatus.PRESENT)
+            results.append(f'{mode} {seconds * 1000:.2f} ms（出勤 {present} 人）')
+        print(f'  K={k}：{"，".join(results)}，内存约 {memory / 1024 / 1024:.1f} MiB')
+
+
+def bench_ann(n_students: int, n_queries: int, probes: list[int]) -> None:
+    """比较全校近似最近邻索引与暴力搜索的 recall@1 与查询耗时"""
+    from ann import IVFIndex
+
+    students, _, _ = generate_descriptors(n_students, 0)
+    rng = np.random.default_rng(2)
+    queries = students[rng.choice(n_students, size=n_queries, replace=False)]
+    queries = (queries + rng.normal(scale=0.02, size=queries.shape)).astype(np.float32)
+    ids = np.arange(n_students)
+
+    start = time.perf_counter()
+    truth = distance_matrix(queries, students).argmin(axis=1)
+    brute_force = time.perf_counter() - start
+    print(f'全校识别：{n_students} 名学生，{n_queries} 张人脸')
+    print(f'  暴力搜索：每张人脸 {brute_force / n_queries * 1000:.3f} ms，内存 {students.nbytes / 1024 / 1024:.1f} MiB')
+
+    for quantize in [False, True]:
+        start = time.perf_counter()
+        index = IVFIndex.train(students, quantize=quantize)
+        index.add(ids, students)
+        build = time.perf_counter() - start
+        print(f'  IVF（{"int8 量化 + 精确重排" if quantize else "float32"}）：'
+              f'{len(index.centroids)} 个列表，构建 {build:.2f} 秒，内存 {index.nbytes / 1024 / 1024:.1f} MiB')
+        for n_probe in probes:
+            start = time.perf_counter()
+            found, _ = index.search(queries, k=1, n_probe=n_probe, exact=lambda rows: students[rows])
+            seconds = time.perf_counter() - start
+            recall = (found[:, 0] == truth).mean()
+            print(f'    n_probe={n_probe}：recall@1 {recall:.3f}，每张人脸 {seconds / n_queries * 1000:.3f} ms')
+
+
+def populate_db(file_path: str, n_students: int, n_courses=3, n_sessions=20, seed=0) -> None:
+    """生成一个包含 1 名教师、n_students 名学生与 n_courses 门课程的数据库，所有学生选修所有课程"""
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql'), encoding='utf8') as f:
+        init_sql = f.read()
+
+    conn = sqlite3.connect(file_path)
+    conn.executescript(init_sql)
+    conn.execute("INSERT INTO user (nickname, username, password, role) VALUES ('teacher', 'teacher', '', 1)")
+    conn.executemany(
+        "INSERT INTO user (nickname, username, password, role) VALUES (?, ?, '', 0)",
+        [(f'student{i}', f'student{i}') for i in range(n_students)]
+    )
+    student_ids = [row[0] for row in conn.execute('SELECT id FROM user WHERE role = 0')]
+    for i in range(n_courses):
+        course_id = f'course{i}'
+        conn.execute('INSERT INTO course (id, name, teacher_id) VALUES (?, ?, 1)', (course_id, course_id))
+        conn.executemany(
+            'INSERT INTO attendance (course_id, student_id) VALUES (?, ?)',
+            [(course_id, student_id) for student_id in student_ids]
+        )
+        for _ in range(n_sessions):
+            session_id = conn.execute('INSERT INTO session (course_id) VALUES (?)', (course_id,)).lastrowid
+            statuses = rng.integers(1, 4, size=len(student_ids))
+            conn.executemany(
+                'INSERT INTO attendance_mark (session_id, student_id, status) VALUES (?, ?, ?)',
+                [(session_id, student_id, int(status)) for student_id, status in zip(student_ids, statuses)]
+            )
+    db.rebuild_attendance_stat(conn.cursor())
+    conn.commit()
+    conn.close()
+
+
+# 引入版本号之前最早的表结构：考勤记录以 JSON 保存在 attendance.record 中，没有考勤、任务与统计表，也没有任何索引
+LEGACY_SCHEMA = """
+CREATE TABLE user (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  nickname TEXT NOT NULL,
+  username TEXT UNIQUE NOT NULL,
+  password TEXT NOT NULL,
+  role INTEGER NOT NULL
+);
+
+CREATE TABLE course (
+  id TEXT PRIMARY KEY,
+  name TEXT UNIQUE NOT NULL,
+  teacher_id INTEGER NOT NULL
+);
+
+CREATE TABLE attendance (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  course_id INTEGER NOT NULL,
+  student_id INTEGER NOT NULL,
+  record TEXT NOT NULL DEFAULT '[]'
+);
+"""
+
+
+def populate_legacy_db(file_path: str, n_students: int, n_courses=3, n_sessions=20, seed=0) -> None:
+    """
+    按 LEGACY_SCHEMA 生成与 populate_db 规模相同的数据库，每门课程的最后一名学生较晚加入、记录较短，
+    第一名学生重复加入了每门课程，与旧版本一样考勤只追加到最早的一条选课记录
+    """
+    rng = np.random.default_rng(seed)
+    blocks = np.array(['🟩', '🟥'])
+    conn = sqlite3.connect(file_path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.execute("INSERT INTO user (nickname, username, password, role) VALUES ('teacher', 'teacher', '', 1)")
+    conn.executemany(
+        "INSERT INTO user (nickname, username, password, role) VALUES (?, ?, '', 0)",
+        [(f'student{i}', f'student{i}') for i in range(n_students)]
+    )
+    student_ids = [row[0] for row in conn.execute('SELECT id FROM user WHERE role = 0')]
+    for i in range(n_courses):
+        course_id = f'course{i}'
+        conn.execute('INSERT INTO course (id, name, teacher_id) VALUES (?, ?, 1)', (course_id, course_id))
+        lengths = [n_sessions] * (len(student_ids) - 1) + [n_sessions // 2]
+        conn.executemany(
+            'INSERT INTO attendance (course_id, student_id, record) VALUES (?, ?, ?)',
+            [
+                (course_id, student_id, json.dumps(rng.choice(blocks, size=length).tolist()))
+                for student_id, length in zip(student_ids, lengths)
+            ]
+        )
+        conn.execute('INSERT INTO attendance (course_id, student_id) VALUES (?, ?)', (course_id, student_ids[0]))
+    conn.commit()
+    conn.close()
+
+
+def create_app(database: str) -> Flask:
+    """创建只注册了面板相关蓝图的应用，不需要载入人脸识别模型"""
+    import auth
+    import dashboard
+
+    test_app = Flask('app', root_path=os.path.dirname(os.path.abspath(__file__)))
+    test_app.config.from_object('config_local')
+    test_app.config.update(DATABASE=database, TESTING=True)
+    test_app.secret_key = test_app.config['SECRET_KEY']
+    test_app.teardown_appcontext(db.close_db)
+    test_app.add_url_rule('/', 'index', lambda: redirect(url_for('dashboard.index')))
+    test_app.register_blueprint(auth.bp)
+    test_app.register_blueprint(dashboard.bp)
+    return test_app
+
+
+# 面板页面的名称: (用户 id, URL)，populate_db 生成的数据库中用户 1 为教师，2 起为学生
+DASHBOARD_ROUTES = {
+    '学生 /dashboard/data': (2, '/dashboard/data'),
+    '教师 /dashboard/data': (1, '/dashboard/data'),
+    '教师 /dashboard/data/attendance_detail': (1, '/dashboard/data/attendance_detail?course_id=course0'),
+}
+
+
+def count_route_queries(n_students: int) -> dict[str, int]:
+    """返回各面板页面在给定班级规模下执行的 SQL 语句数"""
+    routes = DASHBOARD_ROUTES
+    result = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database = os.path.join(temp_dir, 'data.sqlite')
+        populate_db(database, n_students)
+        client = create_app(database).test_client()
+        for name, (user_id, url) in routes.items():
+            with client.session_transaction() as session:
+                session['id'] = user_id
+            before = db.connection_stats['queries']
+            response = client.get(url)
+            assert response.status_code == 200, f'{url} 返回了 {response.status_code}'
+            result[name] = db.connection_stats['queries'] - before
+    return result
+
+
+def check_route_queries(sizes: list[int]) -> bool:
+    """检查各面板页面执行的 SQL 语句数与班级规模无关"""
+    counts = {n_students: count_route_queries(n_students) for n_students in sizes}
+    constant = True
+    for route in counts[sizes[0]]:
+        route_counts = [counts[n_students][route] for n_students in sizes]
+        ok = len(set(route_counts)) == 1
+        constant &= ok
+        detail = '，'.join(f'{n_students} 名学生：{count} 条' for n_students, count in zip(sizes, route_counts))
+        print(f'{"通过" if ok else "失败"} {route}（{detail}）')
+    return constant
+
+
+def collect_route_statements(database: str, routes: dict[str, tuple[int, str]]) -> dict[str, list[str]]:
+    """返回各页面执行的 SQL 语句（参数已代入）"""
+    statements: list[str] = []
+    count_query = db.count_query
+
+    def trace(statement: str) -> None:
+        statements.append(statement)
+        count_query(statement)
+
+    result = {}
+    client = create_app(database).test_client()
+    with mock.patch.object(db, 'count_query', trace):
+        for name, (user_id, url) in routes.items():
+            with client.session_transaction() as session:
+                session['id'] = user_id
+            statements.clear()
+            response = client.get(url)
+            assert response.status_code == 200, f'{url} 返回了 {response.status_code}'
+            response.get_data()  # 流式响应在读取时才执行查询
+            result[name] = list(statements)
+    return result
+
+
+def find_full_scans(conn: sqlite3.Connection, statement: str) -> list[str]:
+    """返回 EXPLAIN QUERY PLAN 中没有使用索引的全表扫描"""
+    plan = conn.execute(f'EXPLAIN QUERY PLAN {statement}').fetchall()
+    return [detail for _, _, _, detail in plan if detail.startswith('SCAN ') and ' USING ' not in detail]
+
+
+def check_query_plans(n_students: int) -> bool:
+    """
+    用 EXPLAIN QUERY PLAN 检查面板页面与导出的查询没有全表扫描，分别检查按 schema.sql 新建的数据库，
+    以及按 LEGACY_SCHEMA 生成、再由 migrations.py 升级的数据库
+    """
+    import migrations
+
+    routes = dict(DASHBOARD_ROUTES, **{
+        '教师 /dashboard/data/attendance_export': (1, '/dashboard/data/attendance_export?course_id=course0'),
+    })
+    ok = True
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for source in ('schema.sql', 'migrations.py'):
+            database = os.path.join(temp_dir, f'{source}.sqlite')
+            if source == 'migrations.py':
+                populate_legacy_db(database, n_students)
+                with create_app(database).app_context():
+                    migrations.migrate_db(database)
+            else:
+                populate_db(database, n_students)
+
+            # 不执行 ANALYZE，与服务端的数据库一致，查询优化器只根据索引选择查询计划
+            conn = sqlite3.connect(database)
+            print(f'{source}：')
+            for name, statements in collect_route_statements(database, routes).items():
+                scans = [
+                    (statement, scan) for statement in statements if statement.lstrip().upper().startswith('SELECT')
+                    for scan in find_full_scans(conn, statement)
+                ]
+                ok &= not scans
+                print(f'  {"失败" if scans else "通过"} {name}（{len(statements)} 条 SQL 语句）')
+                for statement, scan in scans:
+                    print(f'    {scan}：{statement}')
+            conn.close()
+    return ok
+
+
+def bench_user_cache(n_requests: int, n_users: int, seed=0) -> None:
+    """比较关闭与开启登录用户缓存时，多名用户交替访问面板页面的平均 SQL 语句数与耗时"""
+    from user_cache import user_cache
+
+    rng = np.random.default_rng(seed)
+    urls = ['/dashboard/', '/dashboard/data', '/dashboard/profile']
+    # 用户 1 为教师，2 起为学生
+    requests = [(int(rng.integers(2, n_users + 2)), urls[rng.integers(len(urls))]) for _ in range(n_requests)]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        database = os.path.join(temp_dir, 'data.sqlite')
+        populate_db(database, n_users, n_sessions=5)
+        client = create_app(database).test_client()
+        print(f'登录用户缓存：{n_users} 名用户，{n_requests} 次请求')
+        for name, ttl in (('关闭', 0), ('开启', user_cache.ttl)):
+            user_cache.clear()
+            stats = user_cache.stats()
+            with mock.patch.object(user_cache, 'ttl', ttl):
+                before = db.connection_stats['queries']
+                start = time.perf_counter()
+                for user_id, url in requests:
+                    with client.session_transaction() as session:
+                        session['id'] = user_id
+                    assert client.get(url).status_code == 200, f'{url} 访问失败'
+                seconds = time.perf_counter() - start
+                queries = db.connection_stats['queries'] - before
+            print(f'  {name}：每次请求 {queries / n_requests:.2f} 条 SQL 语句，{seconds / n_requests * 1000:.2f} ms')
+        stats = {key: value - stats[key] for key, value in user_cache.stats().items() if key != 'entries'}
+        print('  缓存：' + '，'.join(f'{key} {value}' for key, value in stats.items()))
+
+
+def bench_detect(photo_path: str, repeat: int) -> None:
+    """比较整张照片放大一次检测与分块检测的耗时和检测到的人脸数，需要安装 dlib"""
+    import dlib
+    import core
+
+    img = dlib.load_rgb_image(photo_path)
+    core.models.detector  # 预先载入模型，避免计入耗时
+    full_faces = list(core.models.detector(img, 1))
+    full = timeit(lambda: core.models.detector(img, 1), repeat)
+
+    timings = {}
+    tiled_faces = core.detect_boxes_tiled(img, timings)
+    tiled = timeit(lambda: core.detect_boxes_tiled(img), repeat)
+
+    print(f'人脸检测：{img.shape[1]} × {img.shape[0]}')
+    print(f'  整张照片：{full * 1000:.0f} ms，检测到 {len(full_faces)} 张人脸')
+    print(f'  分块检测：{tiled * 1000:.0f} ms（{full / tiled:.1f} 倍），检测到 {len(tiled_faces)} 张人脸')
+    print('  ' + '，'.join(f'{stage} {seconds * 1000:.0f} ms' for stage, seconds in timings.items()))
+
+
+def bench_detectors(photo_path: str, detectors: list[str], expected: Optional[int]) -> None:
+    """比较各人脸检测器的耗时与检测到的人脸数，cascade 模式还会列出各阶段的耗时与人脸数，需要安装 dlib 与模型文件"""
+    import dlib
+    import core
+
+    img = dlib.load_rgb_image(photo_path)
+    core.models.detector, core.models.cnn_detector  # 预先载入模型，避免计入耗时
+    print(f'人脸检测器：{img.shape[1]} × {img.shape[0]}，预期 {expected or "-"} 张人脸')
+    for detector in detectors:
+        timings = {}
+        start = time.perf_counter()
+        faces = core.detect_faces(img, timings, detector, expected)
+        elapsed = time.perf_counter() - start
+        counts = {key: int(timings.pop(key)) for key in list(timings) if key.startswith('faces_')}
+        print(f'  {detector}：{elapsed * 1000:.0f} ms，检测到 {len(faces)} 张人脸')
+        print('    ' + '，'.join(f'{stage} {seconds * 1000:.0f} ms' for stage, seconds in timings.items()))
+        if counts:
+            print('    ' + '，'.join(f'{key[len("faces_"):]} {count} 张' for key, count in counts.items()))
+
+
+def bench_embed(photo_path: str, modes: list[str], repeat: int) -> None:
+    """比较各特征提取模式的速度，以及逐张人脸与批量提取特征的速度，需要安装 dlib 与对应的模型文件"""
+    import dlib
+    import core
+    from config_local import RECOGNITION_MODES
+
+    img = dlib.load_rgb_image(photo_path)
+    faces = core.detect_faces(img)
+    print(f'特征提取：{img.shape[1]} × {img.shape[0]}，{len(faces)} 张人脸')
+    if not faces:
+        return
+
+    facerec = core.models.facerec
+    for mode_name in modes:
+        mode = RECOGNITION_MODES[mode_name]
+        sp = dlib.shape_predictor(mode['landmarks'])
+        shapes = dlib.full_object_detections()
+        for face in faces:
+            shapes.append(sp(img, face))
+
+        landmarks = timeit(lambda: [sp(img, face) for face in faces], repeat)
+        per_face = timeit(lambda: [
+            facerec.compute_face_descriptor(img, shape, mode['num_jitters'], mode['padding']) for shape in shapes
+        ], repeat)
+        batched = timeit(lambda: facerec.compute_face_descriptor(img, shapes, mode['num_jitters'], mode['padding']), repeat)
+        print(
+            f'  {mode_name}：特征点 {len(faces) / landmarks:.0f} 张/秒，'
+            f'逐张提取 {len(faces) / per_face:.1f} 张/秒，批量提取 {len(faces) / batched:.1f} 张/秒（{per_face / batched:.2f} 倍），'
+            f'合计 {len(faces) / (landmarks + batched):.1f} 张/秒'
+        )
+
+
+def make_test_clip(photo_path: str, video_path: str, seconds: float, fps: int, size=(1280, 720)) -> None:
+    """将一张教室照片制作成缓慢平移的视频片段，模拟固定摄像头拍摄的画面，逐帧写入，不占用大量内存"""
+    import cv2
+
+    img = cv2.imread(photo_path)
+    width, height = size
+    if img.shape[1] < width or img.shape[0] < height:
+        scale = max(width / img.shape[1], height / img.shape[0])
+        img = cv2.resize(img, None, fx=scale, fy=scale)
+
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    n_frames = int(seconds * fps)
+    max_left, max_top = img.shape[1] - width, img.shape[0] - height
+    for i in range(n_frames):
+        # 画面在前后两个方向上往返平移一次
+        progress = (1 - np.cos(2 * np.pi * i / n_frames)) / 2
+        left, top = int(max_left * progress), int(max_top * progress)
+        writer.write(np.ascontiguousarray(img[top:top + height, left:left + width]))
+    writer.release()
+
+
+def bench_video(photo_path: str, seconds: float, fps: int) -> None:
+    """用照片生成测试视频，统计视频考勤的处理速度与各阶段耗时，需要安装 dlib 与 opencv-python-headless"""
+    import core
+    import video
+
+    core.models.detector, core.models.sp, core.models.facerec  # 预先载入模型，避免计入耗时
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = os.path.join(temp_dir, 'clip.mp4')
+        make_test_clip(photo_path, video_path, seconds, fps)
+
+        timings = {}
+        start = time.perf_counter()
+        tracker = video.track_video(video_path, timings)
+        descriptors = tracker.descriptors()
+        elapsed = time.perf_counter() - start
+
+    print(f'视频考勤：{seconds:g} 秒，{fps} 帧/秒')
+    print(f'  读取 {tracker.frames} 帧，抽取 {tracker.sampled_frames} 帧，耗时 {elapsed:.2f} 秒（{tracker.frames / elapsed:.1f} 帧/秒）')
+    print(f'  检测到 {tracker.detections} 张人脸，{len(tracker.tracks)} 条轨迹，{len(descriptors)} 人')
+    print(f'  提取特征 {tracker.embeddings} 次（逐帧提取需要 {tracker.detections} 次）')
+    print('  ' + '，'.join(f'{stage} {seconds * 1000:.0f} ms' for stage, seconds in timings.items()))
+
+
+# check_video_tracking() 生成的测试视频中各人脸方块的颜色（BGR），也用于区分是哪一个人
+TRACKING_COLORS = [
+    (0, 0, 255), (0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 0, 255), (255, 255, 0), (255, 255, 255), (0, 128, 255)
+]
+
+
+class FakeRect:
+    """检测替身返回的人脸框，与 dlib.rectangle 一样通过方法读取坐标"""
+
+    __slots__ = ('box',)
+
+    def __init__(self, box: tuple[int, int, int, int]):
+        self.box = box
+
+    def left(self) -> int:
+        return self.box[0]
+
+    def top(self) -> int:
+        return self.box[1]
+
+    def right(self) -> int:
+        return self.box[2]
+
+    def bottom(self) -> int:
+        return self.box[3]
+
+
+def make_tracking_clip(video_path: str, seconds: float, fps: int, n_faces: int, size=(640, 360), face_size=60) -> None:
+    """
+    生成 n_faces 个纯色方块代替人脸的视频：第 i 个方块在第 i * seconds / (2 * n_faces) 秒出现，
+    之后缓慢平移直到视频结束，逐帧写入
+    """
+    import cv2
+
+    width, height = size
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    columns = (width - face_size) // (face_size * 2)
+    for i in range(int(seconds * fps)):
+        seen = i / fps
+        frame = np.full((height, width, 3), 64, dtype=np.uint8)
+        for face in range(n_faces):
+            if seen < face * seconds / (2 * n_faces):
+                continue
+            left = face_size + (face % columns) * face_size * 2 + int(10 * seen)  # 每秒平移 10 像素
+            top = face_size + (face // columns) * face_size * 2
+            frame[top:top + face_size, left:left + face_size] = TRACKING_COLORS[face]
+        writer.write(frame)
+    writer.release()
+
+
+def check_video_tracking(seconds: float, fps: int, n_faces: int) -> bool:
+    """
+    不需要 dlib 与模型文件：检测与特征提取由替身代替，按颜色找出方块并为每种颜色返回固定的特征，
+    用 OpenCV 生成的测试视频检查抽帧、跟踪与合并后恰好得到 n_faces 个人，并且提取特征的次数远少于检测到的人脸数
+    """
+    import video
+
+    assert n_faces <= len(TRACKING_COLORS), f'最多 {len(TRACKING_COLORS)} 个人脸'
+    rng = np.random.default_rng(0)
+    identities = rng.normal(size=(len(TRACKING_COLORS), 128)).astype(np.float32)
+    identities /= np.linalg.norm(identities, axis=1, keepdims=True)
+    palette = np.array(TRACKING_COLORS, dtype=np.float64)[:, ::-1]  # 视频读取后为 RGB
+
+    def detect_faces(img, timings=None, detector=None, expected=None):
+        start = time.perf_counter()
+        faces = []
+        pixels = img.astype(np.int16)
+        for color in palette.astype(np.int16):
+            ys, xs = np.nonzero(np.abs(pixels - color).max(axis=2) < 60)
+            if len(xs) > 100:
+                faces.append(FakeRect((int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)))
+        video.add_timing(timings, 'detect', start)
+        return faces
+
+    def compute_box_descriptors(img, boxes, timings=None):
+        start = time.perf_counter()
+        centers = [img[int(box[1] + box[3]) // 2, int(box[0] + box[2]) // 2].astype(np.float64) for box in boxes]
+        faces = [int(np.argmin(np.abs(palette - center).sum(axis=1))) for center in centers]
+        descriptors = identities[faces] + rng.normal(scale=0.01, size=(len(faces), 128)).astype(np.float32)
+        video.add_timing(timings, 'embedding', start)
+        return descriptors
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        video_path = os.path.join(temp_dir, 'clip.mp4')
+        make_tracking_clip(video_path, seconds, fps, n_faces)
+
+        timings = {}
+        with (
+            mock.patch.object(video, 'detect_faces', detect_faces),
+            mock.patch.object(video, 'compute_box_descriptors', compute_box_descriptors),
+        ):
+            start = time.perf_counter()
+            tracker = video.track_video(video_path, timings)
+            descriptors = tracker.descriptors()
+            elapsed = time.perf_counter() - start
+
+    ok = len(descriptors) == n_faces and tracker.embeddings <= n_faces * video.VIDEO_EMBEDDINGS_PER_TRACK
+    print(f'视频跟踪（检测与特征提取为替身）：{seconds:g} 秒，{fps} 帧/秒，{n_faces} 人')
+    print(f'  读取 {tracker.frames} 帧，抽取 {tracker.sampled_frames} 帧，耗时 {elapsed:.2f} 秒（{tracker.frames / elapsed:.1f} 帧/秒）')
+    print(f'  检测到 {tracker.detections} 张人脸，{len(tracker.tracks)} 条轨迹，{len(descriptors)} 人')
+    print(f'  提取特征 {tracker.embeddings} 次（逐帧提取需要 {tracker.detections} 次）')
+    print('  ' + '，'.join(f'{stage} {seconds * 1000:.0f} ms' for stage, seconds in timings.items()))
+    print('通过' if ok else f'失败：应为 {n_faces} 人，每人最多提取 {video.VIDEO_EMBEDDINGS_PER_TRACK} 次特征')
+    return ok
+
+
+def run_suite(sizes: list[int], face_counts: list[int], repeat: int) -> dict[str, float]:
+    """
+    在随机生成的数据上测量识别与数据库热点路径的耗时（秒，取 repeat 次中最快的一次），返回 用例名 -> 耗时
+
+    人脸检测与特征提取被替换为直接返回随机生成的人脸特征，因此不需要模型文件
+    """
+    import attendance
+    import core
+    from descriptor_cache import FaceDescriptorCache, descriptor_cache
+    from store import DescriptorStore
+
+    results = {}
+
+    def measure(name: str, func: Callable[[], object]) -> None:
+        results[name] = timeit(func, repeat)
+        print(f'  {name}：{results[name] * 1000:.3f} ms')
+
+    for n_students in sizes:
+        print(f'{n_students} 名学生')
+        students, mask, _ = generate_descriptors(n_students, 0)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            database = os.path.join(temp_dir, 'data.sqlite')
+            populate_db(database, n_students)
+            store = DescriptorStore(os.path.join(temp_dir, 'descriptors'), descriptor_cache.store.gallery_size)
+            store.put_many([
+                (f'student{i}', student) for i, (student, has_descriptor) in enumerate(zip(students, mask))
+                if has_descriptor
+            ])
+            photo_path = os.path.join(temp_dir, 'photo.jpg')
+            with open(photo_path, 'wb') as f:
+                f.write(os.urandom(256 * 1024))
+
+            test_app = create_app(database)
+            cache = FaceDescriptorCache(store, descriptor_cache.max_bytes)
+            with (
+                test_app.app_context(),
+                mock.patch.object(core, 'descriptor_cache', cache),
+                mock.patch.object(core, 'descriptor_store', store),
+                mock.patch.object(core, 'GALLERY_AUTO_ADD', False)  # 避免照片库随重复次数增长
+            ):
+                course = db.fetch_course_by_id('course0')
+                student_list = db.fetch_student_list_from_course('course0')
+                student_descriptors = [student if has_descriptor else None for student, has_descriptor in zip(students, mask)]
+
+                for n_faces in face_counts:
+                    _, _, faces = generate_descriptors(n_students, n_faces)
+                    measure(f'compare_faces/{n_students}x{n_faces}', lambda: core.compare_faces(student_descriptors, list(faces)))
+
+                def load_cold():
+                    cache.clear()
+                    core.load_face_descriptors(student_list, 'course0')
+
+                measure(f'load_face_descriptors/{n_students}/cold', load_cold)
+                measure(f'load_face_descriptors/{n_students}/warm', lambda: core.load_face_descriptors(student_list, 'course0'))
+
+                # 写入路径包括匹配、计算照片哈希与写入整个班级的考勤结果，人脸检测被替换为返回固定的人脸特征
+                _, _, faces = generate_descriptors(n_students, max(face_counts))
+                with mock.patch.object(core, 'detect_face_descriptors_parallel', lambda paths, timings=None, **kwargs: [faces]):
+                    measure(
+                        f'attendance/{n_students}x{len(faces)}',
+                        lambda: attendance.attendance(course, student_list, [photo_path])
+                    )
+
+                measure(
+                    f'fetch_attendance_detail_by_course/{n_students}',
+                    lambda: db.fetch_attendance_detail_by_course('course0')
+                )
+                student_id = student_list[0].id
+                measure(f'fetch_course_from_student/{n_students}', lambda: db.fetch_course_from_student(student_id))
+
+    return results
+
+
+def compare_with_baseline(results: dict[str, float], baseline: dict[str, float], tolerance: float, min_delta: float) -> bool:
+    """比较与基准的耗时，慢了超过 tolerance（比例）且超过 min_delta（秒）时视为退化，返回是否没有退化"""
+    ok = True
+    for name, seconds in results.items():
+        if name not in baseline:
+            print(f'新增 {name}：{seconds * 1000:.3f} ms')
+            continue
+        ratio = seconds / baseline[name] if baseline[name] else float('inf')
+        regressed = ratio > 1 + tolerance and seconds - baseline[name] > min_delta
+        ok &= not regressed
+        print(f'{"退化" if regressed else "通过"} {name}：{baseline[name] * 1000:.3f} ms -> {seconds * 1000:.3f} ms（{ratio:.2f} 倍）')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='人脸考勤性能基准测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compare_parser = subparsers.add_parser('compare', help='比较逐对循环与批量匹配的耗时')
+    compare_parser.add_argument('--students', type=int, default=500)
+    compare_parser.add_argument('--faces', type=int, default=200)
+    compare_parser.add_argument('--repeat', type=int, default=5)
+
+    queries_parser = subparsers.add_parser('queries', help='检查面板页面的 SQL 语句数不随班级规模增长')
+    queries_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 300])
+
+    plans_parser = subparsers.add_parser('plans', help='用 EXPLAIN QUERY PLAN 检查面板页面的查询没有全表扫描')
+    plans_parser.add_argument('--students', type=int, default=300)
+
+    users_parser = subparsers.add_parser('users', help='比较关闭与开启登录用户缓存时每次请求的 SQL 语句数')
+    users_parser.add_argument('--requests', type=int, default=1000)
+    users_parser.add_argument('--users', type=int, default=50)
+
+    detect_parser = subparsers.add_parser('detect', help='比较整张照片检测与分块检测的耗时')
+    detect_parser.add_argument('photo')
+    detect_parser.add_argument('--repeat', type=int, default=3)
+
+    video_parser = subparsers.add_parser('video', help='用照片生成测试视频，统计视频考勤的处理速度')
+    video_parser.add_argument('photo')
+    video_parser.add_argument('--seconds', type=float, default=30)
+    video_parser.add_argument('--fps', type=int, default=25)
+
+    tracking_parser = subparsers.add_parser('tracking', help='用生成的测试视频检查视频考勤的抽帧与跟踪，不需要 dlib')
+    tracking_parser.add_argument('--seconds', type=float, default=20)
+    tracking_parser.add_argument('--fps', type=int, default=25)
+    tracking_parser.add_argument('--faces', type=int, default=5)
+
+    detectors_parser = subparsers.add_parser('detectors', help='比较各人脸检测器的耗时与检测到的人脸数')
+    detectors_parser.add_argument('photo')
+    detectors_parser.add_argument('--detectors', nargs='+', default=['hog', 'cnn', 'cascade'])
+    detectors_parser.add_argument('--expected', type=int, help='预期的人脸数（课程人数），cascade 模式使用')
+
+    embed_parser = subparsers.add_parser('embed', help='比较各特征提取模式以及逐张与批量提取特征的速度')
+    embed_parser.add_argument('photo')
+    embed_parser.add_argument('--modes', nargs='+', default=['fast', 'balanced', 'accurate'])
+    embed_parser.add_argument('--repeat', type=int, default=3)
+
+    gallery_parser = subparsers.add_parser('gallery', help='比较不同照片库大小下匹配的耗时与内存占用')
+    gallery_parser.add_argument('--students', type=int, default=500)
+    gallery_parser.add_argument('--faces', type=int, default=200)
+    gallery_parser.add_argument('--sizes', type=int, nargs='+', default=[1, 5, 10])
+    gallery_parser.add_argument('--repeat', type=int, default=5)
+
+    ann_parser = subparsers.add_parser('ann', help='比较全校近似最近邻索引与暴力搜索')
+    ann_parser.add_argument('--students', type=int, default=20000)
+    ann_parser.add_argument('--queries', type=int, default=200)
+    ann_parser.add_argument('--probes', type=int, nargs='+', default=[4, 8, 16])
+
+    suite_parser = subparsers.add_parser('suite', help='测量识别与数据库热点路径的耗时，并与基准比较')
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='班级规模')
+    suite_parser.add_argument('--faces', type=int, nargs='+', default=[1, 50, 200], help='照片中的人脸数')
+    suite_parser.add_argument('--repeat', type=int, default=5)
+    suite_parser.add_argument('--output', help='将结果写入 JSON 文件，可作为之后运行的基准')
+    suite_parser.add_argument('--baseline', help='作为基准的 JSON 文件')
+    suite_parser.add_argument('--tolerance', type=float, default=0.25, help='允许比基准慢的比例')
+    suite_parser.add_argument('--min-delta', type=float, default=0.0005, help='忽略小于该值（秒）的差异，避免计时噪声')
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        bench_compare_faces(args.students, args.faces, args.repeat)
+    elif args.command == 'queries':
+        if not check_route_queries(args.sizes):
+            sys.exit(1)
+    elif args.command == 'plans':
+        if not check_query_plans(args.students):
+            sys.exit(1)
+    elif args.command == 'users':
+        bench_user_cache(args.requests, args.users)
+    elif args.command == 'detect':
+        bench_detect(args.photo, args.repeat)
+    elif args.command == 'video':
+        bench_video(args.photo, args.seconds, args.fps)
+    elif args.command == 'tracking':
+        if not check_video_tracking(args.seconds, args.fps, args.faces):
+            sys.exit(1)
+    elif args.command == 'detectors':
+        bench_detectors(args.photo, args.detectors, args.expected)
+    elif args.command == 'embed':
+        bench_embed(args.photo, args.modes, args.repeat)
+    elif args.command == 'gallery':
+        bench_gallery(args.students, args.faces, args.sizes, args.repeat)
+    elif args.command == 'ann':
+        bench_ann(args.students, args.queries, args.probes)
+    elif args.command == 'suite':
+        results = run_suite(args.sizes, args.faces, args.repeat)
+        if args.output:
+            with open(args.output, 'w', encoding='utf8') as f:
+                json.dump({
+                    'python': platform.python_version(),
+                    'numpy': np.__version__,
+                    'machine': platform.machine(),
+                    'repeat': args.repeat,
+                    'results': results,
+                }, f, ensure_ascii=False, indent=2)
+        if args.baseline:
+            with open(args.baseline, encoding='utf8') as f:
+                baseline = json.load(f)['results']
+            if not compare_with_baseline(results, baseline, args.tolerance, args.min_delta):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
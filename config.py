@@ -9,7 +9,7 @@ HOST: str = '127.0.0.1'
 # 数据库存放路径
 DATABASE: str = './data/data.sqlite'
 
-# 临时文件夹存放路径
+# 临时文件夹存放路径（在其他主机上运行 worker.py 时，需要与服务端共享该文件夹）
 TEMP: str = './data/temp'
 
 # 学生照片存放路径
@@ -24,3 +24,121 @@ DEFAULT_ADMIN: str = 'superuser'
 
 # 人脸识别阈值（默认 0.4）
 THRESHOLD = 0.4
+
+# 人脸检测器：hog（HOG+SVM，速度快）、cnn（CNN+MMOD，更准确，能检测到侧脸，但在 CPU 上慢一到两个数量级）、
+# cascade（先用 HOG 检测，只复核 HOG 置信度略低的候选，并且只在人脸数少于课程人数时在人脸稀疏的区域运行 CNN）。
+# 教师上传考勤照片时可以为该次考勤单独选择
+DETECTOR: str = 'hog'
+
+# cascade 模式下由 CNN 复核的 HOG 候选的最低置信度（HOG 的默认阈值为 0）
+CASCADE_HOG_ADJUST_THRESHOLD: float = -0.5
+
+# 人脸特征提取的速度/精度模式，对应 RECOGNITION_MODES 中的一项：
+# landmarks 为特征点模型，num_jitters 为对每张人脸随机抖动后重复提取并取平均的次数（耗时约为 1 + num_jitters 倍），
+# padding 为对齐后的人脸图像（固定为 150 × 150，由特征提取模型决定）四周保留的比例。
+# 学生照片与考勤照片应当使用同一个模式，修改后建议重新录入学生照片
+RECOGNITION_MODE: str = 'balanced'
+RECOGNITION_MODES: dict[str, dict] = {
+    'fast': {'landmarks': 'model/shape_predictor_5_face_landmarks.dat', 'num_jitters': 0, 'padding': 0.25},
+    'balanced': {'landmarks': 'model/shape_predictor_68_face_landmarks_GTX.dat', 'num_jitters': 0, 'padding': 0.25},
+    'accurate': {'landmarks': 'model/shape_predictor_68_face_landmarks_GTX.dat', 'num_jitters': 10, 'padding': 0.25},
+}
+
+# 课程人脸特征缓存的内存预算（字节），超出后按最近最少使用的顺序淘汰
+DESCRIPTOR_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+
+# 登录用户缓存的最大用户数，以及不查询数据库直接使用缓存的时长（秒），其他进程对用户的修改最多延迟这么久生效，设为 0 时不缓存
+USER_CACHE_SIZE: int = 4096
+USER_CACHE_TTL: float = 30.0
+
+# 在同一个请求内复用数据库连接
+DB_POOL: bool = True
+
+# 每个数据库连接缓存的预编译语句数量
+DB_CACHED_STATEMENTS: int = 256
+
+# 启动时在后台线程中预先载入人脸识别模型，关闭后模型将在第一次考勤时载入
+MODEL_WARMUP: bool = True
+
+# 服务端进程内运行的任务 worker 线程数，设为 0 时只由 python worker.py 启动的独立进程处理任务
+ATTENDANCE_WORKER_THREADS: int = 1
+
+# 任务租约时长（秒），worker 执行任务期间会定期续约，崩溃后租约到期的任务会被其他 worker 重新领取
+JOB_LEASE_SECONDS: int = 60
+
+# 任务的最大尝试次数
+JOB_MAX_ATTEMPTS: int = 3
+
+# worker 没有领取到任务时的轮询间隔（秒）
+JOB_POLL_INTERVAL: float = 1.0
+
+# 同一次考勤上传多张照片时，并行识别照片的进程数（0 表示使用全部 CPU 核心）
+PHOTO_WORKERS: int = 0
+
+# 高分辨率照片分块检测人脸，长边超过 TILE_SIZE 像素的照片会被切分为互相重叠的分块，在多个进程中并行检测
+DETECTION_TILING: bool = True
+
+# 分块的边长（像素）
+TILE_SIZE: int = 1024
+
+# 相邻分块重叠的宽度（像素），应大于大多数人脸的尺寸
+TILE_OVERLAP: int = 256
+
+# 每个分块最多放大的次数，每放大一次可以检测到尺寸减半的人脸，耗时约为原来的 4 倍
+TILE_MAX_UPSAMPLE: int = 2
+
+# 并行检测分块的进程数（0 表示使用全部 CPU 核心）
+TILE_WORKERS: int = 0
+
+# 视频考勤：画面中的人脸发生变化时的抽帧间隔（秒），画面稳定时间隔逐渐加倍，直到 VIDEO_MAX_SAMPLE_INTERVAL
+VIDEO_SAMPLE_INTERVAL: float = 0.2
+VIDEO_MAX_SAMPLE_INTERVAL: float = 2.0
+
+# 视频考勤：相邻两次抽帧中人脸框的 IoU 不小于该值时视为同一个人
+VIDEO_TRACK_IOU: float = 0.3
+
+# 视频考勤：人脸连续消失超过该时长（秒）后结束跟踪
+VIDEO_TRACK_TTL: float = 3.0
+
+# 视频考勤：每条人脸轨迹最多提取特征的次数，以及两次提取之间的最短间隔（秒）
+VIDEO_EMBEDDINGS_PER_TRACK: int = 3
+VIDEO_EMBEDDING_INTERVAL: float = 1.0
+
+# 批量录入学生照片时并行计算人脸特征的进程数（0 表示使用全部 CPU 核心），以及每批处理并写入结果的照片数
+ENROLL_WORKERS: int = 0
+ENROLL_BATCH_SIZE: int = 64
+
+# 批量导入名单（见 roster.py）时并行计算新用户密码哈希的进程数（0 表示使用全部 CPU 核心）
+ROSTER_WORKERS: int = 0
+
+# 考勤照片的人脸特征缓存文件夹（见 face_cache.py），以及缓存的总大小上限（字节），超过时淘汰最久未使用的照片
+FACE_CACHE: str = './data/face_cache'
+FACE_CACHE_MAX_BYTES: int = 256 * 1024 * 1024
+
+# 人脸特征存储文件夹（见 store.py），旧版本保存在 PHOTO 中的 <学号>.npy 文件会在启动时自动导入
+DESCRIPTOR_STORE: str = './data/descriptors'
+
+# 每名学生照片库中最多保存的人脸特征数
+GALLERY_SIZE: int = 5
+
+# 与照片库匹配的方式：min 取照片库中最近的特征，centroid 取照片库中所有特征的平均值
+GALLERY_MATCH: str = 'min'
+
+# 考勤时将置信度较高的匹配自动添加到照片库：距离小于 GALLERY_AUTO_ADD_THRESHOLD，
+# 且不小于 GALLERY_MIN_NOVELTY（与照片库中已有的特征有足够差异）。
+# 开启后每次考勤都会修改学生的照片库，照片库满后被替换的特征仍占用人脸特征存储的空间，
+# 需要定期执行 python store.py compact 回收，因此默认关闭
+GALLERY_AUTO_ADD: bool = False
+GALLERY_AUTO_ADD_THRESHOLD: float = 0.3
+GALLERY_MIN_NOVELTY: float = 0.15
+
+# 考勤时在全校范围内识别未与课程名单中的学生匹配的人脸（例如走错教室、旁听的学生）
+ANN_IDENTIFY_UNMATCHED: bool = True
+
+# 全校近似最近邻索引：查询时扫描的列表数、是否将特征量化为 int8、量化时精确重排的候选数
+ANN_N_PROBE: int = 8
+ANN_QUANTIZE: bool = True
+ANN_RERANK: int = 32
+
+# 是否开放 /metrics（Prometheus 文本格式的请求耗时、考勤各阶段耗时等指标）
+METRICS: bool = True
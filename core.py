@@ -1,76 +1,717 @@
+import logging
+import math
+import multiprocessing
 import os
-from enum import Enum, auto
-from typing import Optional
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Any, Callable, Iterable, Optional
 
-import dlib
 import numpy as np
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
-from config_local import PHOTO
-from data_model import User
+import metrics
+from ann import school_index
+from config_local import (
+    PHOTO, PHOTO_WORKERS,
+    DETECTION_TILING, TILE_SIZE, TILE_OVERLAP, TILE_MAX_UPSAMPLE, TILE_WORKERS,
+    GALLERY_MATCH, GALLERY_AUTO_ADD, GALLERY_AUTO_ADD_THRESHOLD, GALLERY_MIN_NOVELTY,
+    RECOGNITION_MODE, RECOGNITION_MODES, DETECTOR, CASCADE_HOG_ADJUST_THRESHOLD
+)
+from data_model import User, AttendanceStatus
+from descriptor_cache import descriptor_cache, CourseDescriptors, DESCRIPTOR_DIM
+from face_cache import face_cache, content_hash
+from matching import MatchResult, match_faces, merge_descriptors
+from store import descriptor_store
 
-# 载入所有模型
-detector = dlib.get_frontal_face_detector()  # HOG+SVM
-# detector = dlib.cnn_face_detection_model_v1('model/mmod_human_face_detector.dat')  # CNN+MMOD
-sp = dlib.shape_predictor('model/shape_predictor_68_face_landmarks_GTX.dat')
-facerec = dlib.face_recognition_model_v1('model/dlib_face_recognition_resnet_model_v1.dat')
 
+def load_detector():
+    import dlib
+    return dlib.get_frontal_face_detector()  # HOG+SVM
 
-class AttendanceStatus(Enum):
-    UNKNOWN = auto()  # 未知，例如学生没有提交照片
-    PRESENT = auto()  # 出勤
-    ABSENT = auto()  # 缺勤
-    # UNEXCUSED_ABSENCE = auto()  # 无故缺勤
-    # EXCUSED_ABSENCE = auto()  # 请假
-    # LATE = auto()  # 迟到
-    # LEFT_EARLY = auto()  # 早退
 
+def load_cnn_detector():
+    import dlib
+    return dlib.cnn_face_detection_model_v1('model/mmod_human_face_detector.dat')  # CNN+MMOD
 
-def check_attendance(student_list: list[User], photo_path: str, threshold=0.4) -> list[AttendanceStatus]:
-    unknown_face_descriptors = []
-    student_face_descriptors = load_face_descriptors(student_list)
+
+def load_shape_predictor():
+    import dlib
+    return dlib.shape_predictor(RECOGNITION_MODES[RECOGNITION_MODE]['landmarks'])
+
+
+def load_face_recognition_model():
+    import dlib
+    return dlib.face_recognition_model_v1('model/dlib_face_recognition_resnet_model_v1.dat')
+
+
+class ModelRegistry:
+    """
+    人脸识别模型注册表
+
+    模型在第一次被使用时载入，也可以通过 warm_up() 在后台线程中预先载入，
+    因此导入本模块以及不涉及人脸识别的页面都不需要等待模型载入。
+    required 为默认配置下需要的模型，只有这些模型会被预先载入，全部载入后 ready 为 True，
+    其余模型（例如为某次考勤单独选择的检测器）仍在第一次被使用时载入
+    """
+
+    def __init__(self, loaders: dict[str, Callable[[], object]], required: Iterable[str]):
+        self.loaders = loaders
+        self.required = list(required)
+        self.load_times: dict[str, float] = {}
+        self.errors: dict[str, str] = {}
+        self._models: dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str):
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._lock:
+            if name not in self._models:
+                start = time.time()
+                try:
+                    self._models[name] = self.loaders[name]()
+                except Exception as e:
+                    self.errors[name] = str(e)
+                    raise
+                self.errors.pop(name, None)
+                self.load_times[name] = time.time() - start
+        return self._models[name]
+
+    @property
+    def detector(self):
+        return self.get('detector')
+
+    @property
+    def cnn_detector(self):
+        return self.get('cnn_detector')
+
+    @property
+    def sp(self):
+        return self.get('sp')
+
+    @property
+    def facerec(self):
+        return self.get('facerec')
+
+    @property
+    def ready(self) -> bool:
+        return all(name in self._models for name in self.required)
+
+    def status(self) -> dict:
+        return {
+            'ready': self.ready,
+            'required': self.required,
+            'loaded': sorted(self._models),
+            'load_times': {name: round(seconds, 3) for name, seconds in self.load_times.items()},
+            'errors': dict(self.errors),
+        }
+
+    def warm_up(self, logger: Optional[logging.Logger] = None) -> threading.Thread:
+        """在后台线程中载入 required 中的模型"""
+        logger = logger or logging.getLogger(__name__)
+
+        def load_all():
+            for name in self.required:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    logger.error(f'模型 {name} 载入失败：{e}')
+                else:
+                    logger.info(f'模型 {name} 已载入，耗时 {self.load_times[name]:.3f} 秒')
+
+        thread = threading.Thread(target=load_all, name='model-warm-up', daemon=True)
+        thread.start()
+        return thread
+
+
+def required_models(detector: str) -> list[str]:
+    """使用 detector（见 detect_faces()）识别人脸时需要的模型，cascade 模式复核与补充检测都需要 CNN"""
+    detector_models = {'hog': ['detector'], 'cnn': ['cnn_detector'], 'cascade': ['detector', 'cnn_detector']}
+    return detector_models[detector] + ['sp', 'facerec']
+
+
+models = ModelRegistry({
+    'detector': load_detector,
+    'cnn_detector': load_cnn_detector,
+    'sp': load_shape_predictor,
+    'facerec': load_face_recognition_model,
+}, required=required_models(DETECTOR))
+
+
+# HOG+SVM 检测器的滑动窗口大小，小于该尺寸的人脸需要放大照片后才能被检测到
+HOG_WINDOW_SIZE = 80  # CNN 检测器不放大时能检测到的最小人脸与之相近
+
+# 可选的人脸检测器及其说明，见 detect_faces()
+DETECTORS = {'hog': 'HOG（快速）', 'cnn': 'CNN（准确，较慢）', 'cascade': 'HOG + CNN 补充检测'}
+
+
+def check_attendance(
+        student_list: list[User],
+        photo_path: str | list[str],
+        threshold=0.4,
+        course_id: Optional[str] = None,
+        timings: Optional[dict[str, float]] = None,
+        identified: Optional[list[tuple[str, float]]] = None,
+        detector: Optional[str] = None
+) -> list[AttendanceStatus]:
+    """
+    photo_path 可以是同一次考勤的多张照片，同一个人出现在多张照片中时只计为一张人脸
+
+    photo_path 也可以是视频文件，见 video.py
+
+    给定 timings 时，各阶段的耗时（秒）会被累加到其中，识别视频时还会累加读取的帧数 frames
+
+    给定 identified 时，未与名单中的学生匹配的人脸会在全校范围内识别，识别到的 (学号, 距离) 会被添加到其中
+
+    detector 为使用的人脸检测器（见 detect_faces()），默认为 DETECTOR，cascade 模式以名单人数作为预期的人脸数
+    """
+    photo_paths = [photo_path] if isinstance(photo_path, str) else photo_path
+    start = time.perf_counter()
+    course_descriptors = load_course_descriptors(student_list, course_id)
+    add_timing(timings, 'load_descriptors', start)
 
     # 读取待识别图片中的人脸
-    img = dlib.load_rgb_image(photo_path)
-    unknown_faces = detector(img, 1)
-    for face in unknown_faces:
-        shape = sp(img, face)
-        face_descriptor = facerec.compute_face_descriptor(img, shape)
-        unknown_face_descriptors.append(face_descriptor)
+    face_descriptor_groups = detect_face_descriptors_parallel(
+        photo_paths, timings, detector=detector or DETECTOR, expected=len(student_list)
+    )
+    start = time.perf_counter()
+    unknown_face_matrix = merge_descriptors(face_descriptor_groups, threshold=threshold)
+    add_timing(timings, 'merge', start)
+
+    start = time.perf_counter()
+    match = match_faces(
+        course_descriptors.matrix, course_descriptors.mask, unknown_face_matrix, threshold=threshold,
+        mode=GALLERY_MATCH
+    )
+    add_timing(timings, 'match', start)
+
+    if GALLERY_AUTO_ADD:
+        start = time.perf_counter()
+        add_confident_matches(course_descriptors.usernames, match, unknown_face_matrix)
+        add_timing(timings, 'gallery', start)
+
+    if identified is not None:
+        start = time.perf_counter()
+        identified.extend(identify_unmatched_faces(course_descriptors.usernames, match, unknown_face_matrix, threshold))
+        add_timing(timings, 'identify', start)
+    return match.status
+
+
+def identify_unmatched_faces(
+        usernames: Iterable[str],
+        match: MatchResult,
+        face_matrix: np.ndarray,
+        threshold=0.4
+) -> list[tuple[str, float]]:
+    """在全校范围内识别未与名单中的学生匹配的人脸，返回不在名单中的 (学号, 距离)"""
+    unmatched = np.setdiff1d(np.arange(len(face_matrix)), match.face_index[match.face_index >= 0])
+    if not len(unmatched):
+        return []
+
+    roster = set(usernames)
+    result = {}
+    for candidates in school_index.identify(face_matrix[unmatched], k=1):
+        for username, distance in candidates:
+            if distance < threshold and username not in roster and username not in result:
+                result[username] = distance
+    return list(result.items())
+
+
+def add_confident_matches(usernames: Iterable[str], match: MatchResult, face_matrix: np.ndarray) -> None:
+    """
+    将置信度较高的匹配添加到学生的照片库中
+
+    只添加距离小于 GALLERY_AUTO_ADD_THRESHOLD 的人脸，并且距离不小于 GALLERY_MIN_NOVELTY，
+    即与照片库中已有的特征有足够差异，避免照片库被几乎相同的特征占满
+    """
+    confident = (match.distance < GALLERY_AUTO_ADD_THRESHOLD) & (match.distance >= GALLERY_MIN_NOVELTY)
+    items = [
+        (username, face_matrix[face_index])
+        for username, face_index, is_confident in zip(usernames, match.face_index, confident) if is_confident
+    ]
+    descriptor_store.put_many(items, append=True)
+    for username, _ in items:
+        descriptor_cache.invalidate_student(username)
+
+
+def add_timing(timings: Optional[dict[str, float]], stage: str, start: float) -> None:
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def detect_face_descriptors(
+        photo_path: str,
+        timings: Optional[dict[str, float]] = None,
+        detector: str = DETECTOR,
+        expected: Optional[int] = None
+) -> np.ndarray:
+    """返回照片中所有人脸的特征，形状为 (人脸数, DESCRIPTOR_DIM)"""
+    return detect_face_descriptors_batch([photo_path], timings, detector, expected)[0]
+
+
+def detect_face_descriptors_batch(
+        photo_paths: list[str],
+        timings: Optional[dict[str, float]] = None,
+        detector: str = DETECTOR,
+        expected: Optional[int] = None
+) -> list[np.ndarray]:
+    """依次检测每张照片中的人脸，再一次性提取所有照片中所有人脸的特征"""
+    import dlib
+    images, shapes = [], []
+    for photo_path in photo_paths:
+        start = time.perf_counter()
+        img = dlib.load_rgb_image(photo_path)
+        add_timing(timings, 'decode', start)
+
+        images.append(img)
+        shapes.append(detect_landmarks(img, detect_faces(img, timings, detector, expected), timings))
+
+    return compute_face_descriptors(images, shapes, timings)
+
+
+def detect_landmarks(img: np.ndarray, faces: list, timings: Optional[dict[str, float]] = None):
+    """返回各人脸的特征点，类型为 dlib.full_object_detections，faces 为 dlib.rectangle 列表"""
+    import dlib
+    start = time.perf_counter()
+    shapes = dlib.full_object_detections()
+    for face in faces:
+        shapes.append(models.sp(img, face))
+    add_timing(timings, 'landmarks', start)
+    return shapes
+
+
+def compute_face_descriptors(
+        images: list[np.ndarray],
+        shapes: list,
+        timings: Optional[dict[str, float]] = None
+) -> list[np.ndarray]:
+    """
+    一次调用提取多张照片中所有人脸的特征，shapes[i] 为 images[i] 中各人脸的特征点（dlib.full_object_detections），
+    返回每张照片的特征，形状为 (人脸数, DESCRIPTOR_DIM)
+
+    逐张人脸调用时每次都有固定的开销，批量提取可以分摊这部分开销，使用 CUDA 编译的 dlib 时效果更明显
+    """
+    mode = RECOGNITION_MODES[RECOGNITION_MODE]
+    start = time.perf_counter()
+    results = [np.zeros((0, DESCRIPTOR_DIM), dtype=np.float32) for _ in images]
+    # 没有人脸的照片不参与计算
+    batch = [i for i, image_shapes in enumerate(shapes) if len(image_shapes)]
+    if len(batch) == 1:
+        outputs = [models.facerec.compute_face_descriptor(
+            images[batch[0]], shapes[batch[0]], mode['num_jitters'], mode['padding']
+        )]
+    elif batch:
+        outputs = models.facerec.compute_face_descriptor(
+            [images[i] for i in batch], [shapes[i] for i in batch], mode['num_jitters'], mode['padding']
+        )
+    else:
+        outputs = []
+    for i, descriptors in zip(batch, outputs):
+        results[i] = np.array(descriptors, dtype=np.float32).reshape(-1, DESCRIPTOR_DIM)
+    add_timing(timings, 'embedding', start)
+    return results
+
+
+def compute_face_descriptor(img: np.ndarray, face, timings: Optional[dict[str, float]] = None) -> np.ndarray:
+    """计算照片中一张人脸的特征，face 为 dlib.rectangle"""
+    return compute_face_descriptors([img], [detect_landmarks(img, [face], timings)], timings)[0][0]
+
+
+def compute_box_descriptors(img: np.ndarray, boxes: np.ndarray, timings: Optional[dict[str, float]] = None) -> np.ndarray:
+    """一次提取照片中多个人脸框的特征，boxes 的每行为 left, top, right, bottom，返回形状为 (人脸数, DESCRIPTOR_DIM)"""
+    import dlib
+    rects = [dlib.rectangle(*(int(value) for value in box[:4])) for box in boxes]
+    return compute_face_descriptors([img], [detect_landmarks(img, rects, timings)], timings)[0]
+
+
+def detect_face_descriptors_with_timings(
+        photo_path: str,
+        detector: str = DETECTOR,
+        expected: Optional[int] = None
+) -> tuple[np.ndarray, dict[str, float]]:
+    """照片与视频均可，视频中的人脸经过跟踪与合并，同一个人只返回一个特征"""
+    from video import is_video, detect_video_descriptors
 
-    return compare_faces(student_face_descriptors, unknown_face_descriptors, threshold=threshold)
+    timings = {}
+    if is_video(photo_path):
+        return detect_video_descriptors(photo_path, timings, detector), timings
+    return detect_face_descriptors(photo_path, timings, detector, expected), timings
 
 
-def load_face_descriptors(student_list: list[User]) -> list[Optional[np.ndarray]]:
-    result = []
-    for student in student_list:
-        # 载入numpy数组
-        npy_path = os.path.join(PHOTO, f'{student.username}.npy')
-        if os.path.isfile(npy_path):
-            student_face_descriptor = np.load(npy_path)
-        else:
-            student_face_descriptor = None
-        result.append(student_face_descriptor)
+def detect_face_descriptors_parallel(
+        photo_paths: list[str],
+        timings: Optional[dict[str, float]] = None,
+        detector: str = DETECTOR,
+        expected: Optional[int] = None
+) -> list[np.ndarray]:
+    """
+    在多个进程中并行识别多张照片，只有一张照片时直接在当前进程中识别
 
-    return result
+    识别过的照片（按内容哈希）直接从 face_cache 中读取人脸特征，不再检测。
+    多张照片在当前进程中识别时（PHOTO_WORKERS 为 1 或只有一个核心），所有照片中的人脸一次性提取特征
+    """
+    from video import is_video
 
+    start = time.perf_counter()
+    # 不同的检测器检测到的人脸不同，cascade 模式的结果还与预期的人脸数有关
+    suffix = f'{detector}{expected}' if detector == 'cascade' else detector
+    content_hashes = [f'{content_hash(photo_path)}-{suffix}' for photo_path in photo_paths]
+    groups = [face_cache.get(content_hash) for content_hash in content_hashes]
+    add_timing(timings, 'face_cache', start)
+    missing = [i for i, descriptors in enumerate(groups) if descriptors is None]
+    metrics.face_cache_requests.inc(len(photo_paths) - len(missing), result='hit')
+    metrics.face_cache_requests.inc(len(missing), result='miss')
 
-def save_student_photo(student_username: str, file: FileStorage) -> str:
+    missing_paths = [photo_paths[i] for i in missing]
+    if len(missing) > 1 and runs_in_process(PHOTO_WORKERS, len(missing)) and not any(map(is_video, missing_paths)):
+        # 各阶段的耗时直接累加到 timings 中
+        results = [
+            (descriptors, {})
+            for descriptors in detect_face_descriptors_batch(missing_paths, timings, detector, expected)
+        ]
+    else:
+        results = map_in_pool(
+            'photo', PHOTO_WORKERS,
+            partial(detect_face_descriptors_with_timings, detector=detector, expected=expected), missing_paths
+        )
+    for i, (descriptors, photo_timings) in zip(missing, results):
+        groups[i] = descriptors
+        face_cache.put(content_hashes[i], descriptors)
+        # 子进程中的指标不会被导出，因此在主进程中记录
+        metrics.attendance_faces_per_image.observe(len(descriptors))
+        for stage, seconds in photo_timings.items():
+            if timings is not None:
+                timings[stage] = timings.get(stage, 0.0) + seconds
+    return groups
+
+
+def detect_faces(
+        img: np.ndarray,
+        timings: Optional[dict[str, float]] = None,
+        detector: str = DETECTOR,
+        expected: Optional[int] = None
+) -> list:
+    """
+    检测照片中的人脸，返回 dlib.rectangle 列表
+
+    detector 为 hog（HOG+SVM）、cnn（CNN+MMOD，更准确，但在 CPU 上慢得多）或 cascade（见 detect_boxes_cascade()），
+    expected 为预期的人脸数，只在 cascade 模式下使用
+    """
+    import dlib
+    if detector == 'cascade':
+        boxes = detect_boxes_cascade(img, expected, timings)
+    else:
+        boxes = detect_boxes(img, detector, timings)
+    return [dlib.rectangle(int(left), int(top), int(right), int(bottom)) for left, top, right, bottom, _ in boxes]
+
+
+def run_detector(detector: str, img: np.ndarray, upsample: int, adjust_threshold=0.0) -> np.ndarray:
+    """
+    运行 hog 或 cnn 检测器，返回形状为 (人脸数, 5) 的数组，每行为 left, top, right, bottom, score
+
+    两种检测器的返回值不同（cnn 返回的是带 confidence 的 mmod_rectangle，人脸框在 .rect 中），在这里统一，
+    adjust_threshold 只对 hog 有效，小于 0 时还会返回置信度低于默认阈值的候选
+    """
+    if detector == 'cnn':
+        detections = models.cnn_detector(img, upsample)
+        rows = [[d.rect.left(), d.rect.top(), d.rect.right(), d.rect.bottom(), d.confidence] for d in detections]
+    else:
+        rects, scores, _ = models.detector.run(img, upsample, adjust_threshold)
+        rows = [[rect.left(), rect.top(), rect.right(), rect.bottom(), score] for rect, score in zip(rects, scores)]
+    return np.array(rows, dtype=np.float64).reshape(-1, 5)
+
+
+def detect_boxes(
+        img: np.ndarray,
+        detector: str = 'hog',
+        timings: Optional[dict[str, float]] = None,
+        adjust_threshold=0.0
+) -> np.ndarray:
+    """用一种检测器检测整张照片，启用 DETECTION_TILING 且照片长边超过 TILE_SIZE 时分块检测，返回值同 run_detector()"""
+    if not DETECTION_TILING or max(img.shape[:2]) <= TILE_SIZE:
+        start = time.perf_counter()
+        boxes = run_detector(detector, img, 1, adjust_threshold)
+        add_timing(timings, detection_stage(detector), start)
+        return boxes
+    return detect_boxes_tiled(img, timings, detector, adjust_threshold)
+
+
+def detection_stage(detector: str) -> str:
+    """timings 中检测阶段的名称，hog 沿用原先的 detect"""
+    return 'cnn' if detector == 'cnn' else 'detect'
+
+
+def detect_boxes_cascade(
+        img: np.ndarray,
+        expected: Optional[int] = None,
+        timings: Optional[dict[str, float]] = None
+) -> np.ndarray:
+    """
+    两级检测：先用 HOG 检测整张照片，再只在以下两种情况下运行较慢的 CNN
+
+    1. 复核 HOG 置信度低于默认阈值（0）但不低于 CASCADE_HOG_ADJUST_THRESHOLD 的候选（例如侧脸、低头），
+       CNN 在候选周围的区域中检测到人脸时保留该候选（cnn_verify）
+    2. 人脸数少于 expected（课程名单人数）时，将照片划分为 TILE_SIZE 的区域，
+       按 HOG 检测到的人脸密度从低到高在各区域中运行 CNN，补充 HOG 漏检的人脸，人脸数达到 expected 后停止（cnn_fill）
+
+    timings 中会累加各阶段检测到的人脸数 faces_hog、faces_cnn_verify 与 faces_cnn_fill
+    """
+    candidates = detect_boxes(img, 'hog', timings, CASCADE_HOG_ADJUST_THRESHOLD)
+    boxes = candidates[candidates[:, 4] >= 0]
+    weak = candidates[candidates[:, 4] < 0]
+    add_count(timings, 'faces_hog', len(boxes))
+
+    if len(weak):
+        start = time.perf_counter()
+        verified = np.array([verify_with_cnn(img, box) for box in weak], dtype=bool)
+        boxes = np.concatenate([boxes, weak[verified]])
+        add_timing(timings, 'cnn_verify', start)
+        add_count(timings, 'faces_cnn_verify', int(verified.sum()))
+
+    if expected and len(boxes) < expected:
+        start = time.perf_counter()
+        found = 0
+        for left, top, right, bottom in cascade_regions(img.shape, boxes):
+            region_boxes = run_detector('cnn', np.ascontiguousarray(img[top:bottom, left:right]), 1)
+            region_boxes[:, [0, 2]] += left
+            region_boxes[:, [1, 3]] += top
+            new_boxes = region_boxes[~overlaps_any(region_boxes, boxes)]
+            boxes = np.concatenate([boxes, new_boxes])
+            found += len(new_boxes)
+            if len(boxes) >= expected:
+                break
+        add_timing(timings, 'cnn_fill', start)
+        add_count(timings, 'faces_cnn_fill', found)
+
+    return boxes
+
+
+def verify_with_cnn(img: np.ndarray, box: np.ndarray) -> bool:
+    """在人脸框四周各扩大一个人脸框大小的区域中运行 CNN，检测到与之重叠的人脸时返回 True"""
+    left, top, right, bottom = box[:4]
+    size = max(right - left, bottom - top)
+    crop_left, crop_top = int(max(left - size, 0)), int(max(top - size, 0))
+    crop_right, crop_bottom = int(min(right + size, img.shape[1])), int(min(bottom + size, img.shape[0]))
+    # 放大到 CNN 能够检测到该人脸的尺寸
+    upsample = min(max(math.ceil(math.log2(HOG_WINDOW_SIZE / max(size, 1))), 0), 2)
+    found = run_detector('cnn', np.ascontiguousarray(img[crop_top:crop_bottom, crop_left:crop_right]), upsample)
+    found[:, [0, 2]] += crop_left
+    found[:, [1, 3]] += crop_top
+    return bool(overlaps_any(box[None], found)[0])
+
+
+def cascade_regions(shape: tuple[int, ...], boxes: np.ndarray) -> list[tuple[int, int, int, int]]:
+    """将照片划分为 TILE_SIZE 的区域，按区域中已检测到的人脸密度从低到高排列，返回 left, top, right, bottom"""
+    height, width = shape[:2]
+    regions = [
+        (left, top, min(left + TILE_SIZE, width), min(top + TILE_SIZE, height))
+        for top in tile_starts(height) for left in tile_starts(width)
+    ]
+    centers_x = (boxes[:, 0] + boxes[:, 2]) / 2
+    centers_y = (boxes[:, 1] + boxes[:, 3]) / 2
+
+    def density(region):
+        left, top, right, bottom = region
+        inside = (centers_x >= left) & (centers_x < right) & (centers_y >= top) & (centers_y < bottom)
+        return inside.sum() / ((right - left) * (bottom - top))
+
+    return sorted(regions, key=density)
+
+
+def overlaps_any(boxes: np.ndarray, others: np.ndarray, iou_threshold=0.3, containment_threshold=0.6) -> np.ndarray:
+    """boxes 中的每个框是否与 others 中的任意一个框重叠，判断方式与 non_max_suppression() 相同"""
+    if not len(boxes) or not len(others):
+        return np.zeros(len(boxes), dtype=bool)
+    inter_width = np.minimum(boxes[:, None, 2], others[None, :, 2]) - np.maximum(boxes[:, None, 0], others[None, :, 0])
+    inter_height = np.minimum(boxes[:, None, 3], others[None, :, 3]) - np.maximum(boxes[:, None, 1], others[None, :, 1])
+    inter = np.clip(inter_width, 0, None) * np.clip(inter_height, 0, None)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    other_areas = (others[:, 2] - others[:, 0]) * (others[:, 3] - others[:, 1])
+    iou = inter / (areas[:, None] + other_areas[None, :] - inter)
+    containment = inter / np.minimum(areas[:, None], other_areas[None, :])
+    return ((iou > iou_threshold) | (containment > containment_threshold)).any(axis=1)
+
+
+def add_count(timings: Optional[dict[str, float]], key: str, count: int) -> None:
+    if timings is not None:
+        timings[key] = timings.get(key, 0) + count
+
+
+def detect_boxes_tiled(
+        img: np.ndarray,
+        timings: Optional[dict[str, float]] = None,
+        detector: str = 'hog',
+        adjust_threshold=0.0
+) -> np.ndarray:
+    """
+    将照片切分为互相重叠的分块，并行检测后用非极大值抑制合并，
+    返回形状为 (人脸数, 5) 的数组，每行为 left, top, right, bottom, score
+    """
+    start = time.perf_counter()
+    height, width = img.shape[:2]
+    # 缩小后的整张照片不放大检测一次，用于找到大于重叠区域、会被分块边界截断的大脸
+    scale = math.ceil(max(height, width) / TILE_SIZE)
+    tasks = [(np.ascontiguousarray(img[::scale, ::scale]), 0, 0, scale, 0, detector, adjust_threshold)]
+    for top in tile_starts(height):
+        for left in tile_starts(width):
+            tile = np.ascontiguousarray(img[top:top + TILE_SIZE, left:left + TILE_SIZE])
+            tasks.append((tile, left, top, 1, TILE_MAX_UPSAMPLE, detector, adjust_threshold))
+    add_timing(timings, 'tiling', start)
+
+    start = time.perf_counter()
+    boxes = np.concatenate(map_in_pool('tile', TILE_WORKERS, detect_tile, tasks))
+    add_timing(timings, detection_stage(detector), start)
+
+    start = time.perf_counter()
+    boxes = non_max_suppression(boxes)
+    add_timing(timings, 'nms', start)
+    return boxes
+
+
+def tile_starts(length: int) -> list[int]:
+    """分块在某一维度上的起始坐标，最后一个分块与照片边缘对齐"""
+    starts = list(range(0, max(length - TILE_SIZE, 0) + 1, TILE_SIZE - TILE_OVERLAP))
+    if starts[-1] + TILE_SIZE < length:
+        starts.append(length - TILE_SIZE)
+    return starts
+
+
+def detect_tile(task: tuple[np.ndarray, int, int, int, int, str, float]) -> np.ndarray:
+    """
+    检测一个分块中的人脸，task 为 (分块, 左侧偏移, 顶部偏移, 缩小倍数, 最大放大次数, 检测器, adjust_threshold)
+
+    与原先整张照片的检测一致，分块从放大一次开始检测，只有检测到的最小人脸接近检测窗口大小（说明可能还有更小的人脸）时，
+    才再放大一倍重新检测，直到达到最大放大次数，返回原图坐标系下的 left, top, right, bottom, score
+    """
+    tile, left, top, scale, max_upsample, detector, adjust_threshold = task
+    boxes = np.zeros((0, 5))
+    for upsample in range(min(1, max_upsample), max_upsample + 1):
+        boxes = run_detector(detector, tile, upsample, adjust_threshold)
+        # 放大 upsample 次后能检测到的最小人脸为 HOG_WINDOW_SIZE / 2 ** upsample
+        if not len(boxes) or (boxes[:, 2] - boxes[:, 0]).min() >= 2 * HOG_WINDOW_SIZE / 2 ** upsample:
+            break
+
+    boxes[:, :4] *= scale
+    boxes[:, [0, 2]] += left
+    boxes[:, [1, 3]] += top
+    return boxes
+
+
+def non_max_suppression(boxes: np.ndarray, iou_threshold=0.3, containment_threshold=0.6) -> np.ndarray:
+    """
+    按置信度从高到低保留人脸框，去除与已保留的框重叠的框
+
+    被分块边界截断的人脸框会被另一个分块中完整的人脸框包含，
+    因此交集占较小框面积的比例超过 containment_threshold 时同样视为重叠
+    """
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    # 置信度相同时优先保留面积较大的框
+    order = np.lexsort((-areas, -boxes[:, 4]))
+    keep = []
+    while order.size:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        inter_width = np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0])
+        inter_height = np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1])
+        inter = np.clip(inter_width, 0, None) * np.clip(inter_height, 0, None)
+        iou = inter / (areas[i] + areas[rest] - inter)
+        containment = inter / np.minimum(areas[i], areas[rest])
+        order = rest[(iou <= iou_threshold) & (containment <= containment_threshold)]
+    return boxes[keep]
+
+
+# 人脸识别所用的进程池，子进程各自载入模型，并在多次考勤之间复用
+_process_pools: dict[str, ProcessPoolExecutor] = {}
+_process_pools_lock = threading.Lock()
+# 当前进程是否为进程池的子进程，子进程中不再创建进程池
+_in_pool_worker = False
+
+
+def _mark_pool_worker() -> None:
+    global _in_pool_worker
+    _in_pool_worker = True
+
+
+def runs_in_process(workers: int, n_items: int) -> bool:
+    """map_in_pool 是否会在当前进程中执行"""
+    return n_items <= 1 or (workers or os.cpu_count()) == 1 or _in_pool_worker
+
+
+def map_in_pool(name: str, workers: int, func: Callable[[Any], Any], items: Iterable) -> list:
+    """在名为 name 的进程池中并行执行 func，workers 为 0 时使用全部 CPU 核心，只有一项任务或一个核心时在当前进程中执行"""
+    items = list(items)
+    workers = workers or os.cpu_count()
+    if runs_in_process(workers, len(items)):
+        return [func(item) for item in items]
+
+    with _process_pools_lock:
+        if name not in _process_pools:
+            # 服务端进程中有其他线程，使用 spawn 避免 fork 时复制被其他线程持有的锁
+            _process_pools[name] = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_mark_pool_worker
+            )
+        pool = _process_pools[name]
+
+    try:
+        return list(pool.map(func, items))
+    except BrokenProcessPool:
+        # 子进程异常退出后进程池无法继续使用，下一次调用时重新创建
+        with _process_pools_lock:
+            if _process_pools.get(name) is pool:
+                del _process_pools[name]
+        raise
+
+
+def load_course_descriptors(student_list: list[User], course_id: Optional[str] = None) -> CourseDescriptors:
+    usernames = [student.username for student in student_list]
+    # 未指定课程时以学生名单本身作为缓存的键
+    key = course_id if course_id is not None else tuple(usernames)
+    return descriptor_cache.get(key, usernames)
+
+
+def load_face_descriptors(student_list: list[User], course_id: Optional[str] = None) -> list[Optional[np.ndarray]]:
+    """返回各学生的照片库，形状为 (特征数, DESCRIPTOR_DIM)，没有录入照片的学生为 None"""
+    course_descriptors = load_course_descriptors(student_list, course_id)
+    return [
+        gallery[gallery_mask] if gallery_mask.any() else None
+        for gallery, gallery_mask in zip(course_descriptors.matrix, course_descriptors.mask)
+    ]
+
+
+def save_student_photo(student_username: str, file: FileStorage, append=False) -> str:
+    """append 为 True 时照片将被添加到照片库中，以时间戳区分同一名学生的多张照片"""
     filename = secure_filename(file.filename)
     suffix = filename.rsplit('.', 1)[1]
-    save_path = os.path.join(PHOTO, f'{student_username}.{suffix}')
+    name = f'{student_username}_{time.time_ns()}' if append else student_username
+    save_path = os.path.join(PHOTO, f'{name}.{suffix}')
     file.save(save_path)
     return save_path
 
 
-def save_student_face_descriptor(student_username: str, photo_path: str) -> bool:
+def detect_student_faces(photo_path: str) -> tuple[np.ndarray, list]:
+    """读取学生照片并用 DETECTOR 检测其中的人脸，返回 (照片, dlib.rectangle 列表)"""
+    import dlib
     student_image = dlib.load_rgb_image(photo_path)
-    student_face = detector(student_image, 1)[0]
-    shape = sp(student_image, student_face)  # HOG+SVM
-    # shape = sp(student_image, student_face.rect)  # CNN+MMOD
-    student_face_descriptor = facerec.compute_face_descriptor(student_image, shape)
-    np.save(os.path.join(PHOTO, f'{student_username}.npy'), student_face_descriptor)
+    return student_image, detect_faces(student_image, detector=DETECTOR)
+
+
+def save_student_face_descriptor(student_username: str, photo_path: str, append=False) -> bool:
+    """append 为 False 时以该照片替换学生的整个照片库，为 True 时将其添加到照片库中"""
+    student_image, student_faces = detect_student_faces(photo_path)
+    if not student_faces:
+        raise RuntimeError('照片中没有检测到人脸')
+    # 与考勤照片使用同一个特征提取模式
+    student_face_descriptor = compute_face_descriptor(student_image, student_faces[0])
+    descriptor_store.put_many([(student_username, student_face_descriptor)], append=append)
+    descriptor_cache.invalidate_student(student_username)
     return True
 
 
@@ -79,17 +720,21 @@ def compare_faces(
         unknown_face_descriptors: list[np.ndarray],
         threshold=0.4
 ) -> list[AttendanceStatus]:
-    result = []
-    for student_face_descriptor in student_face_descriptors:
-        if student_face_descriptor is None:
-            result.append(AttendanceStatus.UNKNOWN)
-            continue
-        for unknown_face_descriptor in unknown_face_descriptors:
-            distance = np.linalg.norm(student_face_descriptor - unknown_face_descriptor)
-            if distance < threshold:
-                result.append(AttendanceStatus.PRESENT)
-                break
-        else:
-            result.append(AttendanceStatus.ABSENT)
+    """student_face_descriptors 为各学生的照片库（见 load_face_descriptors()），也可以是每名学生一个特征"""
+    galleries = [
+        np.asarray(descriptors, dtype=np.float32).reshape(-1, DESCRIPTOR_DIM) if descriptors is not None
+        else np.zeros((0, DESCRIPTOR_DIM), dtype=np.float32)
+        for descriptors in student_face_descriptors
+    ]
+    # 与 CourseDescriptors 相同，补齐为 (学生数, 最大照片库大小, DESCRIPTOR_DIM)，空位由 mask 标记
+    gallery_size = max((len(gallery) for gallery in galleries), default=0) or 1
+    student_matrix = np.zeros((len(galleries), gallery_size, DESCRIPTOR_DIM), dtype=np.float32)
+    student_mask = np.zeros((len(galleries), gallery_size), dtype=bool)
+    for i, gallery in enumerate(galleries):
+        student_matrix[i, :len(gallery)] = gallery
+        student_mask[i, :len(gallery)] = True
 
-    return result
+    unknown_face_matrix = np.array(unknown_face_descriptors, dtype=np.float32).reshape(-1, DESCRIPTOR_DIM)
+    return match_faces(
+        student_matrix, student_mask, unknown_face_matrix, threshold=threshold, mode=GALLERY_MATCH
+    ).status
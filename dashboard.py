@@ -1,13 +1,18 @@
 from sqlite3 import IntegrityError
+from urllib.parse import quote
 
-from flask import Blueprint, flash, redirect, render_template, request, url_for, current_app, g
+from flask import (
+    Blueprint, Response, flash, redirect, render_template, request, url_for, current_app, g, stream_with_context
+)
 
 from auth import login_required
+from export import FORMATS, import_openpyxl, parse_date, stream_course
 from db import (
     set_nickname,
     add_course, delete_course, update_course,
-    fetch_course_from_student, fetch_course_from_teacher,
-    fetch_attendance_detail_by_student, fetch_attendance_detail_by_course
+    fetch_course_by_id, fetch_course_from_student, fetch_course_from_teacher,
+    fetch_attendance_detail_from_student, fetch_attendance_detail_by_course,
+    fetch_course_stat, fetch_course_stat_from_teacher
 )
 
 bp = Blueprint('dashboard', __name__, url_prefix='/dashboard')
@@ -24,13 +29,13 @@ def index():
 def data():
     if g.user.role == 0:
         course_list = fetch_course_from_student(g.user.id)
-        record_list = [fetch_attendance_detail_by_student(course.id, g.user.id) for course in course_list]
-        # 计算所有学生中最多的考勤记录次数，方便在模板中绘制表头
-        max_record = max(map(lambda _: len(_), [record.attendance for record in record_list])) if record_list else 0
+        record_list = fetch_attendance_detail_from_student(g.user.id)
+        # 所有课程中最多的考勤记录次数，方便在模板中绘制表头
+        max_record = max(record.sessions for record in record_list) if record_list else 0
         return render_template(
             'dashboard/data/index.html',
             zip=zip,  # 必须给定 zip 函数，因为 jinja2 默认没有定义该函数
-            headline=['课程代号', '课程名称', '任课教师'],
+            headline=['课程代号', '课程名称', '任课教师', '出勤率'],
             course_list=course_list,
             record_list=record_list,
             max_record=max_record
@@ -39,7 +44,8 @@ def data():
         return render_template(
             'dashboard/data/index.html',
             course_list=fetch_course_from_teacher(g.user.id),
-            headline=['课程代号', '课程名称', '操作']
+            course_stats=fetch_course_stat_from_teacher(g.user.id),
+            headline=['课程代号', '课程名称', '考勤次数', '出勤率', '最近考勤', '操作']
         )
     else:
         g.error = '你所在的用户组无法执行此操作'
@@ -84,17 +90,51 @@ def attendance_detail():
     if g.user.role == 1:
         course_id = request.args.get('course_id')
         record_list = fetch_attendance_detail_by_course(course_id)
-        # 计算所有学生中最多的考勤记录次数，方便在模板中绘制表头
-        max_record = max(map(lambda _: len(_), [record.attendance for record in record_list])) if record_list else 0
+        # 课程的考勤次数，方便在模板中绘制表头
+        max_record = fetch_course_stat(course_id).sessions
     else:
         g.error = '你所在的用户组无法执行此操作'
         return render_template('error.html')
 
     return render_template(
         'dashboard/data/detail.html',
-        headline=['学生编号', '学生姓名'],
+        headline=['学生编号', '学生姓名', '出勤率', '出勤', '缺勤', '未知', '最近出勤'],
         record_list=record_list,
-        max_record=max_record
+        max_record=max_record,
+        course_id=course_id,
+        formats=FORMATS
+    )
+
+
+@bp.route('/data/attendance_export')
+@login_required
+def attendance_export():
+    course_id = request.args.get('course_id')
+    fmt = request.args.get('format', 'csv')
+    course = fetch_course_by_id(course_id)
+    if g.user.role != 1 or course is None or course.teacher_id != g.user.id:
+        g.error = '你不是该课程的教师，无法导出考勤记录'
+        return render_template('error.html')
+
+    try:
+        # 空字符串表示不限制
+        start, end = (parse_date(value) if value else None for value in (
+            request.args.get('start'), request.args.get('end')
+        ))
+        if fmt not in FORMATS:
+            raise ValueError(f'不支持的格式 {fmt}')
+        if fmt == 'xlsx':
+            import_openpyxl()
+    except (ValueError, RuntimeError) as e:
+        g.error = f'无法导出考勤记录：{e}'
+        return render_template('error.html')
+
+    current_app.logger.info(f'{g.user.nickname}（{g.user.username}）导出课程 {course_id} 的考勤记录')
+    filename = quote(f'{course_id}-{course.name}.{fmt}')
+    return Response(
+        stream_with_context(stream_course(current_app.config['DATABASE'], course_id, start, end, fmt)),
+        mimetype=FORMATS[fmt],
+        headers={'Content-Disposition': f"attachment; filename*=UTF-8''{filename}"}
     )
 
 
@@ -1,8 +1,27 @@
-from typing import Optional
+from enum import Enum, auto
+from typing import Any, Optional
 
 from pydantic import BaseModel
 
 
+class AttendanceStatus(Enum):
+    UNKNOWN = auto()  # 未知，例如学生没有提交照片
+    PRESENT = auto()  # 出勤
+    ABSENT = auto()  # 缺勤
+    # UNEXCUSED_ABSENCE = auto()  # 无故缺勤
+    # EXCUSED_ABSENCE = auto()  # 请假
+    # LATE = auto()  # 迟到
+    # LEFT_EARLY = auto()  # 早退
+
+
+# 考勤状态在页面上显示的色块
+COLOR_BLOCK = {
+    AttendanceStatus.UNKNOWN: '🟥',
+    AttendanceStatus.PRESENT: '🟩',
+    AttendanceStatus.ABSENT: '🟥',
+}
+
+
 class User(BaseModel):
     id: int
     username: str
@@ -23,3 +42,30 @@ class Record(BaseModel):
     student_username: str  # 学号
     student_nickname: str  # 姓名，User 类的 nickname
     attendance: list[Optional[str]]
+    rate: Optional[float] = None  # 出勤率，没有任何考勤时为 None
+    sessions: int = 0  # 考勤次数
+    present: int = 0  # 出勤次数
+    absent: int = 0  # 缺勤次数
+    unknown: int = 0  # 未知次数
+    last_present_at: Optional[str] = None  # 最近一次出勤的考勤时间
+
+
+class CourseStat(BaseModel):
+    course_id: str
+    sessions: int = 0  # 考勤次数
+    present: int = 0  # 所有学生的出勤次数之和
+    absent: int = 0
+    unknown: int = 0
+    rate: Optional[float] = None  # 出勤率，没有任何考勤时为 None
+    last_session_at: Optional[str] = None  # 最近一次考勤的时间
+
+
+class Job(BaseModel):
+    id: int
+    kind: str  # 任务类型，例如 attendance
+    payload: dict[str, Any]
+    status: str  # queued: 排队中, running: 执行中, done: 已完成, failed: 已失败
+    attempts: int  # 已尝试执行的次数
+    worker: Optional[str]  # 最近一次领取任务的 worker
+    result: Optional[Any]
+    error: Optional[str]
@@ -1,31 +1,55 @@
+import argparse
 import json
-import secrets
 import sqlite3
+import time
 import traceback
 from typing import Optional
 
-from flask import current_app
+from flask import current_app, g, has_app_context
 from werkzeug.security import generate_password_hash
 
-from data_model import User, Course, Record
+from data_model import User, Course, CourseStat, Record, Job, AttendanceStatus, COLOR_BLOCK
+from descriptor_cache import descriptor_cache
+from metrics import user_cache_requests
+from user_cache import user_cache
+
+
+# 整个进程打开与复用数据库连接的次数，以及执行的 SQL 语句数
+connection_stats = {'opened': 0, 'reused': 0, 'queries': 0}
 
 
 class Connect:
+    """
+    数据库连接的上下文管理器，with 块正常结束时提交，出现异常时回滚
+
+    在应用上下文中且 DB_POOL 开启时，同一个请求内的所有 with 块复用同一个连接，
+    连接在应用上下文结束时由 close_db 关闭
+    """
 
     def __init__(self, file_path):
         self.file_path = file_path
-        self.conn = sqlite3.connect(self.file_path)
-        self.c = self.conn.cursor()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.c: Optional[sqlite3.Cursor] = None
+        self.pooled = has_app_context() and current_app.config.get('DB_POOL', True)
+        self.nested = False
 
     def __enter__(self) -> sqlite3.Cursor:
-        self.conn = sqlite3.connect(self.file_path)
+        self.conn = get_db(self.file_path) if self.pooled else open_connection(self.file_path)
+        # 外层的 with 块已经开启了事务，由外层负责提交或回滚
+        self.nested = self.conn.in_transaction
         self.c = self.conn.cursor()
         return self.c
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> bool:
         if self.conn:
-            self.conn.commit()
-            self.conn.close()
+            # 出现异常时回滚，保证同一个 with 块中的写入要么全部生效，要么全部不生效
+            if not self.nested:
+                if exc_type:
+                    self.conn.rollback()
+                else:
+                    self.conn.commit()
+            if not self.pooled:
+                self.conn.close()
 
         if exc_type:
             current_app.logger.error(traceback.format_exc())
@@ -34,29 +58,42 @@ class Connect:
         return True
 
 
-def init_db(file_path: Optional[str] = None):
-    if not file_path:
-        file_path = current_app.config['DATABASE']
+def open_connection(file_path: str) -> sqlite3.Connection:
+    cached_statements = current_app.config.get('DB_CACHED_STATEMENTS', 128) if has_app_context() else 128
+    conn = sqlite3.connect(file_path, cached_statements=cached_statements)
+    conn.set_trace_callback(count_query)
 
-    with current_app.open_resource('schema.sql') as f:
-        init_sql = f.read().decode('utf8')
+    connection_stats['opened'] += 1
+    if has_app_context():
+        g.db_connections_opened = g.get('db_connections_opened', 0) + 1
+    return conn
 
-    default_admin_username = current_app.config['DEFAULT_ADMIN']
-    default_admin_password = secrets.token_urlsafe(16)
-    with Connect(file_path) as c:
-        c.executescript(init_sql)
-        c.execute(
-            'INSERT INTO user (nickname, username, password, role) VALUES (?, ?, ?, ?)',
-            (default_admin_username, default_admin_username,
-             generate_password_hash(f'{default_admin_username}{default_admin_password}'), 3,)
-        )
 
-    current_app.logger.warning(f'数据库 {file_path} 已初始化')
-    current_app.logger.info(
-        f'初始用户为超级管理员，'
-        f'用户名：{default_admin_username}，'
-        f'密码：{default_admin_password}'
-    )
+def count_query(statement: str) -> None:
+    connection_stats['queries'] += 1
+    if has_app_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+
+
+def get_db(file_path: str) -> sqlite3.Connection:
+    """获取当前应用上下文中复用的数据库连接，不存在时打开新连接"""
+    connections = g.setdefault('db_connections', {})
+    if file_path in connections:
+        connection_stats['reused'] += 1
+    else:
+        connections[file_path] = open_connection(file_path)
+    return connections[file_path]
+
+
+def close_db(exception: Optional[BaseException] = None) -> None:
+    """关闭当前应用上下文中复用的数据库连接，注册为 teardown_appcontext 钩子"""
+    for conn in g.pop('db_connections', {}).values():
+        conn.close()
+
+    opened = g.pop('db_connections_opened', 0)
+    queries = g.pop('db_queries', 0)
+    if opened:
+        current_app.logger.debug(f'本次请求打开了 {opened} 个数据库连接，执行了 {queries} 条 SQL 语句')
 
 
 def get_user_model(user: Optional[tuple]) -> Optional[User]:
@@ -72,28 +109,91 @@ def get_user_model(user: Optional[tuple]) -> Optional[User]:
 
 
 def get_course_model(course: Optional[tuple]) -> Optional[Course]:
+    """course 为 SELECT_COURSE 查询到的一行"""
     if course is None:
         return None
     return Course(
         id=course[0],
         name=course[1],
         teacher_id=course[2],
-        teacher_nickname=fetch_user_by_id(course[2]).nickname,
+        teacher_nickname=course[3],
     )
 
 
-def get_record_model(record: Optional[tuple]) -> Optional[Record]:
+def get_record_model(record: Optional[tuple], marks: list[int]) -> Optional[Record]:
+    """record 为 SELECT_RECORD 查询到的一行，marks 为该学生按时间排序的考勤状态"""
     if record is None:
         return None
-    student = fetch_user_by_id(record[2])
     return Record(
         id=record[0],
-        student_username=student.username,
-        student_nickname=student.nickname,
-        attendance=json.loads(record[3])
+        student_username=record[3],
+        student_nickname=record[4],
+        attendance=[COLOR_BLOCK[AttendanceStatus(status)] for status in marks],
+        rate=record[2],
+        sessions=record[6],
+        present=record[7],
+        absent=record[8],
+        unknown=record[9],
+        last_present_at=record[10],
     )
 
 
+def get_course_stat_model(course_stat: Optional[tuple]) -> Optional[CourseStat]:
+    """course_stat 为 SELECT_COURSE_STAT 查询到的一行"""
+    if course_stat is None:
+        return None
+    return CourseStat(
+        course_id=course_stat[0],
+        sessions=course_stat[1],
+        present=course_stat[2],
+        absent=course_stat[3],
+        unknown=course_stat[4],
+        rate=course_stat[5],
+        last_session_at=course_stat[6],
+    )
+
+
+# 课程及其任课教师的姓名，教师已被删除时姓名为空
+SELECT_COURSE = (
+    "SELECT c.id, c.name, c.teacher_id, coalesce(t.nickname, '') FROM course c "
+    'LEFT JOIN user t ON t.id = c.teacher_id '
+)
+
+# 选课记录、学生信息及其考勤统计，出勤率为出勤次数占该学生全部考勤次数的比例，没有任何考勤时为 NULL
+SELECT_RECORD = (
+    'SELECT a.id, a.student_id, CAST(st.present AS REAL) / nullif(st.sessions, 0), u.username, u.nickname, '
+    'a.course_id, coalesce(st.sessions, 0), coalesce(st.present, 0), coalesce(st.absent, 0), '
+    'coalesce(st.unknown, 0), st.last_present_at FROM attendance a '
+    'JOIN user u ON u.id = a.student_id '
+    'LEFT JOIN attendance_stat st ON st.course_id = a.course_id AND st.student_id = a.student_id '
+)
+
+# 课程的考勤统计，出勤率为所有学生的出勤次数占考勤次数之和的比例
+SELECT_COURSE_STAT = (
+    'SELECT course_id, sessions, present, absent, unknown, '
+    'CAST(present AS REAL) / nullif(present + absent + unknown, 0), last_session_at FROM course_stat '
+)
+
+
+def get_job_model(job: Optional[tuple]) -> Optional[Job]:
+    """job 为 SELECT_JOB 查询到的一行"""
+    if job is None:
+        return None
+    return Job(
+        id=job[0],
+        kind=job[1],
+        payload=json.loads(job[2]),
+        status=job[3],
+        attempts=job[4],
+        worker=job[5],
+        result=json.loads(job[6]) if job[6] is not None else None,
+        error=job[7]
+    )
+
+
+SELECT_JOB = 'SELECT id, kind, payload, status, attempts, worker, result, error FROM job '
+
+
 def create_user(username: str, password: str, role: int | str) -> Optional[User]:
     with Connect(current_app.config['DATABASE']) as db:
         db.execute(
@@ -104,6 +204,7 @@ def create_user(username: str, password: str, role: int | str) -> Optional[User]
             "SELECT * FROM user WHERE username = ?", (username,)
         ).fetchone()
 
+    user_cache.invalidate(user_cache_key(user[0]))
     current_app.logger.info(f"用户名 {username} 注册成功")
     return get_user_model(user)
 
@@ -113,7 +214,8 @@ def delete_user_by_id(user_id: int | str) -> bool:
         db.execute(
             "DELETE FROM user WHERE id = ?", (user_id,)
         )
-        return True
+    user_cache.invalidate(user_cache_key(user_id))
+    return True
 
 
 def fetch_user_by_id(user_id: int | str) -> Optional[User]:
@@ -123,6 +225,35 @@ def fetch_user_by_id(user_id: int | str) -> Optional[User]:
         ).fetchone())
 
 
+def user_cache_key(user_id: int | str) -> tuple[str, int]:
+    return current_app.config['DATABASE'], int(user_id)
+
+
+def fetch_cached_user_by_id(user_id: int | str) -> Optional[User]:
+    """与 fetch_user_by_id 相同，但优先使用 user_cache，缓存超过 USER_CACHE_TTL 时只查询版本号确认是否仍然有效"""
+    key = user_cache_key(user_id)
+    entry, fresh = user_cache.get(key)
+    user_cache_requests.inc(result='hit' if fresh else 'miss' if entry is None else 'revalidate')
+    if fresh:
+        return get_user_model(entry.row)
+
+    with Connect(current_app.config['DATABASE']) as db:
+        if entry is not None:
+            version = db.execute('SELECT version FROM user WHERE id = ?', (user_id,)).fetchone()
+            if version is not None and version[0] == entry.version:
+                user_cache.refresh(key, entry.version)
+                return get_user_model(entry.row)
+        user = db.execute(
+            'SELECT id, nickname, username, password, role, version FROM user WHERE id = ?', (user_id,)
+        ).fetchone()
+
+    if user is None:
+        user_cache.invalidate(key)
+        return None
+    user_cache.put(key, user, user[5])
+    return get_user_model(user)
+
+
 def fetch_user_by_username(username: str) -> Optional[User]:
     with Connect(current_app.config['DATABASE']) as db:
         return get_user_model(db.execute(
@@ -130,17 +261,43 @@ def fetch_user_by_username(username: str) -> Optional[User]:
         ).fetchone())
 
 
+def fetch_existing_usernames(usernames: list[str]) -> set[str]:
+    """返回 usernames 中已注册的用户名"""
+    existing = set()
+    with Connect(current_app.config['DATABASE']) as db:
+        # SQLite 默认最多绑定 999 个参数，分批查询
+        for i in range(0, len(usernames), 900):
+            batch = usernames[i:i + 900]
+            existing.update(row[0] for row in db.execute(
+                f"SELECT username FROM user WHERE username IN ({', '.join('?' * len(batch))})", batch
+            ))
+    return existing
+
+
+def fetch_user_list_by_usernames(usernames: list[str]) -> list[Optional[User]]:
+    """按 usernames 的顺序返回用户，不存在的用户名被忽略"""
+    users = {}
+    with Connect(current_app.config['DATABASE']) as db:
+        for i in range(0, len(usernames), 900):
+            batch = usernames[i:i + 900]
+            for user in db.execute(
+                    f"SELECT * FROM user WHERE username IN ({', '.join('?' * len(batch))})", batch
+            ):
+                users[user[2]] = get_user_model(user)
+    return [users[username] for username in usernames if username in users]
+
+
 def fetch_course_by_id(course_id: str) -> Optional[Course]:
     with Connect(current_app.config['DATABASE']) as db:
         return get_course_model(db.execute(
-            "SELECT * FROM course WHERE id = ?", (course_id,)
+            SELECT_COURSE + 'WHERE c.id = ?', (course_id,)
         ).fetchone())
 
 
 def fetch_course_from_teacher(teacher_id: int | str) -> list[Optional[Course]]:
     with Connect(current_app.config['DATABASE']) as db:
         course = db.execute(
-            'SELECT * FROM course where teacher_id = ?',
+            SELECT_COURSE + 'where c.teacher_id = ?',
             (teacher_id,)
         ).fetchall()
     # map 返回的是一个迭代器，只能一次性使用，因此需要转换为 list 以便多次使用
@@ -148,42 +305,133 @@ def fetch_course_from_teacher(teacher_id: int | str) -> list[Optional[Course]]:
 
 
 def fetch_course_from_student(student_id: int | str) -> list[Optional[Course]]:
+    """按选课顺序返回学生的所有课程，与 fetch_attendance_detail_from_student 的顺序一致"""
     with Connect(current_app.config['DATABASE']) as db:
         course = db.execute(
-            'SELECT * FROM attendance where student_id = ?',
+            SELECT_COURSE + 'JOIN attendance a ON a.course_id = c.id where a.student_id = ? ORDER BY a.id',
             (student_id,)
         ).fetchall()
     # map 返回的是一个迭代器，只能一次性使用，因此需要转换为 list 以便多次使用
-    return list(map(lambda row: fetch_course_by_id(row[1]), course))
+    return list(map(get_course_model, course))
 
 
 def fetch_student_list_from_course(course_id: str) -> list[Optional[User]]:
     with Connect(current_app.config['DATABASE']) as db:
         user = db.execute(
-            'SELECT * FROM attendance where course_id = ?',
+            'SELECT u.id, u.nickname, u.username, u.password, u.role FROM attendance a '
+            'JOIN user u ON u.id = a.student_id where a.course_id = ? ORDER BY a.id',
             (course_id,)
         ).fetchall()
     # map 返回的是一个迭代器，只能一次性使用，因此需要转换为 list 以便多次使用
-    return list(map(lambda row: fetch_user_by_id(row[2]), user))
+    return list(map(get_user_model, user))
 
 
 def fetch_attendance_detail_by_student(course_id: str, student_id: int | str) -> Optional[Record]:
     with Connect(current_app.config['DATABASE']) as db:
         record = db.execute(
-            'SELECT * FROM attendance where course_id = ? and student_id = ?',
+            SELECT_RECORD + 'WHERE a.course_id = ? and a.student_id = ?',
             (course_id, student_id)
         ).fetchone()
-    return get_record_model(record)
+        marks = db.execute(
+            'SELECT m.status FROM session s JOIN attendance_mark m ON m.session_id = s.id '
+            'WHERE s.course_id = ? and m.student_id = ? ORDER BY s.id',
+            (course_id, student_id)
+        ).fetchall()
+    return get_record_model(record, [status for status, in marks])
 
 
 def fetch_attendance_detail_by_course(course_id: str) -> list[Optional[Record]]:
     with Connect(current_app.config['DATABASE']) as db:
         record = db.execute(
-            'SELECT * FROM attendance where course_id = ?',
+            SELECT_RECORD + 'WHERE a.course_id = ? ORDER BY a.id',
             (course_id,)
         ).fetchall()
-        # map 返回的是一个迭代器，只能一次性使用，因此需要转换为 list 以便多次使用
-    return list(map(get_record_model, record))
+        marks_of_student: dict[int, list[int]] = {}
+        for student_id, status in db.execute(
+                'SELECT m.student_id, m.status FROM session s JOIN attendance_mark m ON m.session_id = s.id '
+                'WHERE s.course_id = ? ORDER BY s.id',
+                (course_id,)
+        ):
+            marks_of_student.setdefault(student_id, []).append(status)
+    return [get_record_model(row, marks_of_student.get(row[1], [])) for row in record]
+
+
+def fetch_attendance_detail_from_student(student_id: int | str) -> list[Optional[Record]]:
+    """按选课顺序返回学生在所有课程中的考勤记录，与 fetch_course_from_student 的顺序一致"""
+    with Connect(current_app.config['DATABASE']) as db:
+        record = db.execute(
+            SELECT_RECORD + 'JOIN course c ON c.id = a.course_id WHERE a.student_id = ? ORDER BY a.id',
+            (student_id,)
+        ).fetchall()
+        marks_of_course: dict[str, list[int]] = {}
+        for course_id, status in db.execute(
+                'SELECT s.course_id, m.status FROM session s JOIN attendance_mark m ON m.session_id = s.id '
+                'WHERE m.student_id = ? ORDER BY s.id',
+                (student_id,)
+        ):
+            marks_of_course.setdefault(str(course_id), []).append(status)
+    return [get_record_model(row, marks_of_course.get(str(row[5]), [])) for row in record]
+
+
+def fetch_course_stat(course_id: str) -> CourseStat:
+    """课程还没有任何考勤时返回全为 0 的统计"""
+    with Connect(current_app.config['DATABASE']) as db:
+        course_stat = db.execute(SELECT_COURSE_STAT + 'WHERE course_id = ?', (course_id,)).fetchone()
+    return get_course_stat_model(course_stat) or CourseStat(course_id=course_id)
+
+
+def fetch_course_stat_from_teacher(teacher_id: int | str) -> dict[str, CourseStat]:
+    """返回教师所有已经有考勤的课程的统计，键为课程代号"""
+    with Connect(current_app.config['DATABASE']) as db:
+        course_stats = db.execute(
+            SELECT_COURSE_STAT + 'WHERE course_id IN (SELECT id FROM course WHERE teacher_id = ?)',
+            (teacher_id,)
+        ).fetchall()
+    return {course_stat.course_id: course_stat for course_stat in map(get_course_stat_model, course_stats)}
+
+
+# 导出时按日期筛选考勤，起止日期均包含在内，为 NULL 时不限制，session.created_at 为本地时间，可以直接与日期比较
+EXPORT_SESSION_RANGE = "course_id = ? AND created_at >= coalesce(?, '') AND created_at < coalesce(date(?, '+1 day'), '9999')"
+
+
+def fetch_export_courses(c: sqlite3.Cursor) -> list[tuple[str, str]]:
+    """返回所有课程的代号与名称"""
+    return c.execute('SELECT id, name FROM course ORDER BY id').fetchall()
+
+
+def fetch_export_sessions(
+        c: sqlite3.Cursor,
+        course_id: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None
+) -> list[tuple[int, str]]:
+    """返回课程在 start 到 end（YYYY-MM-DD）之间的所有考勤的 id 与时间"""
+    return c.execute(
+        f'SELECT id, created_at FROM session WHERE {EXPORT_SESSION_RANGE} ORDER BY id',
+        (course_id, start, end)
+    ).fetchall()
+
+
+def iter_export_marks(
+        c: sqlite3.Cursor,
+        course_id: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None
+) -> sqlite3.Cursor:
+    """
+    逐行返回选课记录 id、学生的学号、姓名、考勤 id 与考勤状态，同一条选课记录的各行相邻，
+    没有考勤的学生只有一行且考勤 id 为 NULL
+
+    返回的是游标本身，由调用者迭代，不会一次性读取所有行
+    """
+    return c.execute(
+        'SELECT a.id, u.username, u.nickname, m.session_id, m.status FROM attendance a '
+        'JOIN user u ON u.id = a.student_id '
+        'LEFT JOIN attendance_mark m ON m.student_id = a.student_id '
+        f'AND m.session_id IN (SELECT id FROM session WHERE {EXPORT_SESSION_RANGE}) '
+        'WHERE a.course_id = ? ORDER BY a.id',
+        (course_id, start, end, course_id)
+    )
 
 
 def fetch_all_admin() -> list[Optional[User]]:
@@ -195,16 +443,205 @@ def fetch_all_admin() -> list[Optional[User]]:
     return list(map(get_user_model, admin))
 
 
-def update_attendance_record(course_id: str, student_id: int | str, new_record: list[Optional[str]]) -> bool:
-    old_record = fetch_attendance_detail_by_student(course_id, student_id)
-    if old_record is None:
-        return False
+def add_attendance_session(
+        course_id: str,
+        statuses: dict[int, AttendanceStatus],
+        photo_hash: Optional[str] = None,
+        job_id: Optional[int] = None
+) -> int:
+    """
+    在同一个事务中写入一次考勤及课程所有学生的考勤状态，statuses 为学生 id 到考勤状态的映射，返回考勤 id
+
+    由任务队列写入时需要给定 job_id，同一个任务重试时不会重复写入
+    """
     with Connect(current_app.config['DATABASE']) as db:
+        if job_id is not None:
+            db.execute('BEGIN IMMEDIATE')
+            session = db.execute('SELECT id FROM session WHERE job_id = ?', (job_id,)).fetchone()
+            if session is not None:
+                return session[0]
+
         db.execute(
-            'UPDATE attendance SET record = ? WHERE id = ?',
-            (json.dumps(new_record), old_record.id)
+            'INSERT INTO session (course_id, photo_hash, job_id) VALUES (?, ?, ?)',
+            (course_id, photo_hash, job_id)
         )
-    return True
+        session_id = db.lastrowid
+        db.executemany(
+            'INSERT INTO attendance_mark (session_id, student_id, status) VALUES (?, ?, ?)',
+            [(session_id, student_id, status.value) for student_id, status in statuses.items()]
+        )
+        created_at, = db.execute('SELECT created_at FROM session WHERE id = ?', (session_id,)).fetchone()
+        update_attendance_stat(db, course_id, created_at, statuses)
+    return session_id
+
+
+def update_attendance_stat(
+        c: sqlite3.Cursor,
+        course_id: str,
+        created_at: str,
+        statuses: dict[int, AttendanceStatus]
+) -> None:
+    """在写入一次考勤的事务中，将该次考勤累加到 attendance_stat 与 course_stat"""
+    rows = [
+        (course_id, student_id, status is AttendanceStatus.PRESENT, status is AttendanceStatus.ABSENT,
+         status is AttendanceStatus.UNKNOWN, created_at if status is AttendanceStatus.PRESENT else None)
+        for student_id, status in statuses.items()
+    ]
+    c.executemany(
+        'INSERT INTO attendance_stat (course_id, student_id, sessions, present, absent, unknown, last_present_at) '
+        'VALUES (?, ?, 1, ?, ?, ?, ?) '
+        'ON CONFLICT (course_id, student_id) DO UPDATE SET '
+        'sessions = sessions + 1, present = present + excluded.present, absent = absent + excluded.absent, '
+        'unknown = unknown + excluded.unknown, last_present_at = coalesce(excluded.last_present_at, last_present_at)',
+        rows
+    )
+    c.execute(
+        'INSERT INTO course_stat (course_id, sessions, present, absent, unknown, last_session_at) '
+        'VALUES (?, 1, ?, ?, ?, ?) '
+        'ON CONFLICT (course_id) DO UPDATE SET '
+        'sessions = sessions + 1, present = present + excluded.present, absent = absent + excluded.absent, '
+        'unknown = unknown + excluded.unknown, last_session_at = excluded.last_session_at',
+        (course_id, sum(row[2] for row in rows), sum(row[3] for row in rows), sum(row[4] for row in rows), created_at)
+    )
+
+
+def rebuild_attendance_stat(c: sqlite3.Cursor) -> None:
+    """根据 session 与 attendance_mark 重新计算 attendance_stat 与 course_stat，用于升级数据库或修复统计"""
+    present, absent, unknown = (
+        AttendanceStatus.PRESENT.value, AttendanceStatus.ABSENT.value, AttendanceStatus.UNKNOWN.value
+    )
+    c.execute('DELETE FROM attendance_stat')
+    c.execute('DELETE FROM course_stat')
+    c.execute(
+        'INSERT INTO attendance_stat (course_id, student_id, sessions, present, absent, unknown, last_present_at) '
+        'SELECT s.course_id, m.student_id, count(*), sum(m.status = ?), sum(m.status = ?), sum(m.status = ?), '
+        'max(CASE WHEN m.status = ? THEN s.created_at END) '
+        'FROM session s JOIN attendance_mark m ON m.session_id = s.id GROUP BY s.course_id, m.student_id',
+        (present, absent, unknown, present)
+    )
+    c.execute(
+        'INSERT INTO course_stat (course_id, sessions, present, absent, unknown, last_session_at) '
+        'SELECT s.course_id, count(DISTINCT s.id), coalesce(sum(m.status = ?), 0), coalesce(sum(m.status = ?), 0), '
+        'coalesce(sum(m.status = ?), 0), max(s.created_at) '
+        'FROM session s LEFT JOIN attendance_mark m ON m.session_id = s.id GROUP BY s.course_id',
+        (present, absent, unknown)
+    )
+
+
+def enqueue_job(kind: str, payload: dict) -> int:
+    with Connect(current_app.config['DATABASE']) as db:
+        db.execute(
+            'INSERT INTO job (kind, payload) VALUES (?, ?)',
+            (kind, json.dumps(payload))
+        )
+        return db.lastrowid
+
+
+def fetch_job_by_id(job_id: int | str) -> Optional[Job]:
+    with Connect(current_app.config['DATABASE']) as db:
+        return get_job_model(db.execute(
+            SELECT_JOB + 'WHERE id = ?', (job_id,)
+        ).fetchone())
+
+
+def claim_job(worker: str, kinds: list[str], lease_seconds: float, max_attempts: int) -> Optional[Job]:
+    """
+    领取最早的一个可执行任务，并在 lease_seconds 秒内独占该任务
+
+    可执行的任务包括排队中的任务，以及租约已到期的执行中任务（例如 worker 崩溃），
+    租约到期且已达到最大尝试次数的任务会被标记为失败
+    """
+    now = time.time()
+    with Connect(current_app.config['DATABASE']) as db:
+        db.execute('BEGIN IMMEDIATE')
+        db.execute(
+            "UPDATE job SET status = 'failed', error = ?, updated_at = CURRENT_TIMESTAMP "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= ?",
+            ('任务多次执行超时', now, max_attempts)
+        )
+        job = db.execute(
+            "SELECT id FROM job WHERE (status = 'queued' OR (status = 'running' AND lease_until < ?)) "
+            f"AND kind IN ({', '.join('?' * len(kinds))}) ORDER BY id LIMIT 1",
+            (now, *kinds)
+        ).fetchone()
+        if job is None:
+            return None
+        db.execute(
+            "UPDATE job SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1, "
+            'updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (worker, now + lease_seconds, job[0])
+        )
+        return get_job_model(db.execute(
+            SELECT_JOB + 'WHERE id = ?', (job[0],)
+        ).fetchone())
+
+
+def renew_job_lease(job_id: int, worker: str, lease_seconds: float) -> bool:
+    """延长租约，任务已被其他 worker 领取时返回 False"""
+    with Connect(current_app.config['DATABASE']) as db:
+        return db.execute(
+            "UPDATE job SET lease_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+            (time.time() + lease_seconds, job_id, worker)
+        ).rowcount > 0
+
+
+def complete_job(job_id: int, worker: str, result, observations: Optional[list] = None) -> bool:
+    """observations 为任务执行期间记录的指标，见 metrics.capture()"""
+    with Connect(current_app.config['DATABASE']) as db:
+        db.execute('BEGIN IMMEDIATE')
+        if db.execute(
+            "UPDATE job SET status = 'done', result = ?, error = NULL, lease_until = NULL, "
+            "updated_at = CURRENT_TIMESTAMP WHERE id = ? AND worker = ? AND status = 'running'",
+            (json.dumps(result), job_id, worker)
+        ).rowcount == 0:
+            return False
+        add_job_metrics(db, job_id, observations)
+        return True
+
+
+def add_job_metrics(db: sqlite3.Cursor, job_id: int, observations: Optional[list]) -> None:
+    """
+    保存任务一次执行期间记录的指标，等待 /metrics 汇总
+
+    同一任务之前执行时记录的指标尚未汇总时追加在其后，已汇总的指标不再保留，需要在调用方的事务中执行
+    """
+    if not observations:
+        return
+    saved, collected_at = db.execute('SELECT metrics, metrics_collected_at FROM job WHERE id = ?', (job_id,)).fetchone()
+    pending = json.loads(saved) if saved is not None and collected_at is None else []
+    db.execute(
+        'UPDATE job SET metrics = ?, metrics_collected_at = NULL WHERE id = ?',
+        (json.dumps(pending + observations), job_id)
+    )
+
+
+def collect_pending_job_metrics(limit: int) -> list[list]:
+    """取出最多 limit 个任务尚未汇总的指标，并将这些任务标记为已汇总"""
+    with Connect(current_app.config['DATABASE']) as db:
+        db.execute('BEGIN IMMEDIATE')
+        jobs = db.execute(
+            'SELECT id, metrics FROM job WHERE metrics IS NOT NULL AND metrics_collected_at IS NULL '
+            'ORDER BY id LIMIT ?', (limit,)
+        ).fetchall()
+        db.executemany(
+            'UPDATE job SET metrics_collected_at = CURRENT_TIMESTAMP WHERE id = ?', [(job_id,) for job_id, _ in jobs]
+        )
+        return [json.loads(observations) for _, observations in jobs]
+
+
+def fail_job(job_id: int, worker: str, error: str, max_attempts: int, observations: Optional[list] = None) -> bool:
+    """任务执行失败，尚未达到最大尝试次数时重新排队，observations 为本次执行失败前记录的指标"""
+    with Connect(current_app.config['DATABASE']) as db:
+        db.execute('BEGIN IMMEDIATE')
+        if db.execute(
+            "UPDATE job SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+            'error = ?, lease_until = NULL, updated_at = CURRENT_TIMESTAMP '
+            "WHERE id = ? AND worker = ? AND status = 'running'",
+            (max_attempts, error, job_id, worker)
+        ).rowcount == 0:
+            return False
+        add_job_metrics(db, job_id, observations)
+        return True
 
 
 def add_course(course_id: str, course_name: str, teacher_id: int | str) -> bool:
@@ -242,29 +679,167 @@ def delete_course(course_id: str) -> bool:
             'DELETE FROM attendance where course_id = ?',
             (course_id,)
         )
+        db.execute(
+            'DELETE FROM attendance_mark where session_id in (SELECT id FROM session where course_id = ?)',
+            (course_id,)
+        )
+        db.execute(
+            'DELETE FROM session where course_id = ?',
+            (course_id,)
+        )
+        db.execute('DELETE FROM attendance_stat where course_id = ?', (course_id,))
+        db.execute('DELETE FROM course_stat where course_id = ?', (course_id,))
     return True
 
 
 def add_student_to_course(student_id: int | str, course_id: str) -> bool:
-    student = fetch_user_by_username(student_id)
-    course = fetch_course_by_id(course_id)
-    if not student:
-        raise RuntimeError(f'学生 {student_id} 不存在')
-    if not course:
-        raise RuntimeError(f'课程 {course_id}不存在')
-
     with Connect(current_app.config['DATABASE']) as db:
+        student = db.execute('SELECT id FROM user WHERE username = ?', (student_id,)).fetchone()
+        if not student:
+            raise RuntimeError(f'学生 {student_id} 不存在')
+        if not db.execute('SELECT 1 FROM course WHERE id = ?', (course_id,)).fetchone():
+            raise RuntimeError(f'课程 {course_id}不存在')
         db.execute(
             'INSERT INTO attendance (course_id, student_id) VALUES (?, ?)',
-            (course_id, student.id)
+            (course_id, student[0])
         )
+    # 学生名单发生变化，该课程缓存的人脸特征需要重新载入
+    descriptor_cache.invalidate_course(course_id)
     return True
 
 
+def load_roster(c: sqlite3.Cursor, rows: list[tuple]) -> None:
+    """
+    将导入的名单写入临时表 roster 并在其中校验，rows 为
+    (行号, 用户名, 姓名, 角色, 是否填写了密码, 课程代号, 课程名称, 任课教师用户名, 格式错误) 的列表
+
+    校验全部是针对整张表的查询，不逐行访问数据库。校验通过的行中，
+    new_user、new_course、enroll 分别标记由该行新建的用户、新建的课程与新增的选课记录
+    """
+    c.execute('DROP TABLE IF EXISTS temp.roster')
+    c.execute(
+        'CREATE TEMP TABLE roster ('
+        'line INTEGER PRIMARY KEY, username TEXT, nickname TEXT, role INTEGER, has_password INTEGER, '
+        'course_id TEXT, course_name TEXT, teacher TEXT, error TEXT, '
+        'new_user INTEGER NOT NULL DEFAULT 0, new_course INTEGER NOT NULL DEFAULT 0, enroll INTEGER NOT NULL DEFAULT 0'
+        ')'
+    )
+    c.executemany(
+        'INSERT INTO roster (line, username, nickname, role, has_password, course_id, course_name, teacher, error) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows
+    )
+    c.execute('CREATE INDEX temp.roster_username ON roster (username)')
+    c.execute('CREATE INDEX temp.roster_course_id ON roster (course_id)')
+
+    # 按顺序执行，每一项只检查之前的检查中没有出错的行
+    checks = [
+        ('同一用户名在名单中的角色不一致',
+         'username IN (SELECT username FROM roster GROUP BY username HAVING count(DISTINCT role) > 1)'),
+        ('用户已存在且角色不同',
+         'EXISTS (SELECT 1 FROM main.user u WHERE u.username = roster.username AND u.role != roster.role)'),
+        ('新用户需要填写密码',
+         'username NOT IN (SELECT username FROM main.user) AND NOT EXISTS ('
+         'SELECT 1 FROM roster r WHERE r.username = roster.username AND r.has_password AND r.error IS NULL)'),
+        ('同一课程在名单中的课程名称或任课教师不一致',
+         'course_id IN (SELECT course_id FROM roster GROUP BY course_id '
+         'HAVING count(DISTINCT course_name) > 1 OR count(DISTINCT teacher) > 1)'),
+        ('课程已存在，但课程名称或任课教师不一致',
+         'EXISTS (SELECT 1 FROM main.course c JOIN main.user u ON u.id = c.teacher_id WHERE c.id = roster.course_id '
+         'AND (c.name != coalesce(roster.course_name, c.name) OR u.username != coalesce(roster.teacher, u.username)))'),
+        ('课程名称已被其他课程使用',
+         'EXISTS (SELECT 1 FROM main.course c WHERE c.name = roster.course_name AND c.id != roster.course_id) '
+         'OR course_name IN ('
+         'SELECT course_name FROM roster GROUP BY course_name HAVING count(DISTINCT course_id) > 1)'),
+        ('任课教师不存在或不是教师',
+         'teacher IS NOT NULL AND teacher NOT IN (SELECT username FROM main.user WHERE role = 1) '
+         'AND teacher NOT IN (SELECT username FROM roster WHERE role = 1 AND error IS NULL)'),
+        ('课程不存在，新课程需要填写课程名称与任课教师',
+         'course_id IS NOT NULL AND course_id NOT IN (SELECT id FROM main.course) AND course_id NOT IN ('
+         'SELECT course_id FROM roster WHERE course_name IS NOT NULL AND teacher IS NOT NULL AND error IS NULL)'),
+    ]
+    for error, condition in checks:
+        c.execute(f'UPDATE roster SET error = ? WHERE error IS NULL AND ({condition})', (error,))
+
+    # 同一用户或课程只由第一条校验通过的行新建，同一名学生的同一门课程只选一次
+    c.execute(
+        'UPDATE roster SET new_user = 1 WHERE line IN (SELECT min(line) FROM roster WHERE error IS NULL GROUP BY username) '
+        'AND username NOT IN (SELECT username FROM main.user)'
+    )
+    c.execute(
+        'UPDATE roster SET new_course = 1 WHERE line IN ('
+        'SELECT min(line) FROM roster WHERE error IS NULL AND course_name IS NOT NULL AND teacher IS NOT NULL '
+        'GROUP BY course_id) AND course_id NOT IN (SELECT id FROM main.course)'
+    )
+    # 已有的选课记录通过 user.username 与 attendance (student_id, course_id) 的索引逐行查找
+    c.execute(
+        'UPDATE roster SET enroll = 1 WHERE line IN ('
+        'SELECT min(line) FROM roster WHERE error IS NULL AND course_id IS NOT NULL GROUP BY username, course_id) '
+        'AND NOT EXISTS (SELECT 1 FROM main.user u JOIN main.attendance a ON a.student_id = u.id '
+        'WHERE u.username = roster.username AND a.course_id = roster.course_id)'
+    )
+
+
+def fetch_roster_new_users(c: sqlite3.Cursor) -> list[tuple[str, str, int, int]]:
+    """返回 load_roster 之后需要新建的用户 (用户名, 姓名, 角色, 提供密码的行号)"""
+    return c.execute(
+        'SELECT r.username, coalesce(r.nickname, r.username), r.role, ('
+        'SELECT min(p.line) FROM roster p WHERE p.username = r.username AND p.has_password AND p.error IS NULL'
+        ') FROM roster r WHERE r.new_user ORDER BY r.line'
+    ).fetchall()
+
+
+def fetch_roster_results(c: sqlite3.Cursor) -> list[tuple]:
+    """返回名单每一行的 (行号, 用户名, 课程代号, 错误, 是否新建用户, 是否新建课程, 是否选课)"""
+    return c.execute(
+        'SELECT line, username, course_id, error, new_user, new_course, enroll FROM roster ORDER BY line'
+    ).fetchall()
+
+
+def import_roster(c: sqlite3.Cursor, users: list[tuple[str, str, str, int]]) -> list[str]:
+    """
+    在调用者开启的事务中写入 load_roster 校验通过的名单，users 为 (姓名, 用户名, 密码哈希, 角色) 的列表，
+    返回选课名单发生变化的课程代号
+    """
+    c.executemany('INSERT OR IGNORE INTO main.user (nickname, username, password, role) VALUES (?, ?, ?, ?)', users)
+    c.execute(
+        'INSERT INTO main.course (id, name, teacher_id) SELECT r.course_id, r.course_name, u.id FROM roster r '
+        'JOIN main.user u ON u.username = r.teacher WHERE r.new_course ORDER BY r.line'
+    )
+    c.execute(
+        'INSERT OR IGNORE INTO main.attendance (course_id, student_id) SELECT r.course_id, u.id FROM roster r '
+        'JOIN main.user u ON u.username = r.username WHERE r.enroll ORDER BY r.line'
+    )
+    return [course_id for course_id, in c.execute('SELECT DISTINCT course_id FROM roster WHERE enroll')]
+
+
 def set_nickname(user_id: int | str, nickname: str) -> bool:
     with Connect(current_app.config['DATABASE']) as db:
         db.execute(
-            'UPDATE user SET nickname = ? WHERE id = ?',
+            'UPDATE user SET nickname = ?, version = version + 1 WHERE id = ?',
             (nickname, user_id)
         )
+    user_cache.invalidate(user_cache_key(user_id))
     return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据库维护')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('rebuild-stats', help='根据所有考勤记录重新计算考勤统计')
+    args = parser.parse_args()
+
+    from app import app, init_app
+
+    init_app()
+    with app.app_context():
+        if args.command == 'rebuild-stats':
+            with Connect(current_app.config['DATABASE']) as c:
+                c.execute('BEGIN IMMEDIATE')
+                rebuild_attendance_stat(c)
+                count, = c.execute('SELECT count(*) FROM attendance_stat').fetchone()
+            print(f'已重新计算 {count} 条考勤统计')
+
+
+if __name__ == '__main__':
+    main()
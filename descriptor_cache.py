@@ -0,0 +1,126 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable, Iterable
+
+import numpy as np
+
+from config_local import DESCRIPTOR_CACHE_MAX_BYTES
+from store import DescriptorStore, descriptor_store, DESCRIPTOR_DIM
+
+
+class CourseDescriptors:
+    """
+    一门课程全部学生的照片库，matrix 的形状为 (学生数, GALLERY_SIZE, DESCRIPTOR_DIM)，第 i 项对应 usernames[i]，
+    mask[i, j] 表示该学生的照片库中第 j 个位置是否有特征
+    """
+
+    __slots__ = ('usernames', 'matrix', 'mask', 'rows')
+
+    def __init__(self, usernames: tuple[str, ...], matrix: np.ndarray, mask: np.ndarray, rows: np.ndarray):
+        self.usernames = usernames
+        self.matrix = matrix
+        self.mask = mask
+        self.rows = rows  # 载入时各学生照片库在人脸特征存储中的行号，空位为 -1
+
+    @property
+    def student_mask(self) -> np.ndarray:
+        """各学生是否已录入照片"""
+        return self.mask.any(axis=1)
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.mask.nbytes + self.rows.nbytes
+
+
+class FaceDescriptorCache:
+    """
+    进程内的课程人脸特征缓存，以 LRU 方式在内存预算内淘汰
+
+    以下情况缓存会失效：
+    1. 调用 invalidate_student()，例如重新保存了学生的人脸特征
+    2. 调用 invalidate_course()，例如课程的学生名单发生了变化
+    3. 传入的学生名单与缓存中的不一致，或任意一名学生在存储中的行号发生了变化（例如由其他进程写入）
+    """
+
+    def __init__(self, store: DescriptorStore, max_bytes: int):
+        self.store = store
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[Hashable, CourseDescriptors] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable, usernames: Iterable[str]) -> CourseDescriptors:
+        usernames = tuple(usernames)
+        # 追加写入的特征总是位于新的行，比较行号即可发现其他进程的写入
+        rows = self.store.rows(usernames)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.usernames == usernames and np.array_equal(entry.rows, rows):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = self._load(usernames)
+        with self._lock:
+            self._put(key, entry)
+        return entry
+
+    def invalidate_course(self, key: Hashable) -> None:
+        with self._lock:
+            if self._pop(key) is not None:
+                self.invalidations += 1
+
+    def invalidate_student(self, username: str) -> None:
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if username in entry.usernames]:
+                self._pop(key)
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _load(self, usernames: tuple[str, ...]) -> CourseDescriptors:
+        rows, matrix, mask = self.store.gather(usernames)
+        # 缓存中的数组会被多个请求共享，禁止原地修改
+        matrix.flags.writeable = False
+        mask.flags.writeable = False
+        return CourseDescriptors(usernames, matrix, mask, rows)
+
+    def _put(self, key: Hashable, entry: CourseDescriptors) -> None:
+        self._pop(key)
+        self._entries[key] = entry
+        self._bytes += entry.nbytes
+        # 按最近最少使用的顺序淘汰，直到满足内存预算，超出预算的单个条目同样不会被保留
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def _pop(self, key: Hashable):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.nbytes
+        return entry
+
+
+descriptor_cache = FaceDescriptorCache(descriptor_store, DESCRIPTOR_CACHE_MAX_BYTES)
@@ -0,0 +1,188 @@
+"""
+批量录入学生照片
+
+输入为 ZIP 压缩包或文件夹，其中的照片以 <学号>.jpg 命名（也支持其他图片格式）。
+只读取顶层的照片，子文件夹中的文件与以 . 开头的文件（例如 macOS 压缩时生成的 __MACOSX/._x.jpg 与 .DS_Store）会被忽略，不写入报告。
+照片按批处理：逐个解压到临时文件夹，在进程池中并行计算人脸特征，然后一次性将整批的人脸特征写入存储（见 store.py）并写入报告
+
+报告为 CSV 文件，每张照片一行：文件名, 学号, 状态, 说明。
+中断后使用同一份报告重新运行时，报告中已有的照片会被跳过
+
+用法：python enroll.py <ZIP 或文件夹> [--report report.csv]
+"""
+import argparse
+import csv
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+from collections import Counter
+from contextlib import contextmanager
+from functools import partial
+from typing import BinaryIO, Callable, Iterator, NamedTuple, Optional
+
+import numpy as np
+
+from config_local import PHOTO, TEMP, ENROLL_WORKERS, ENROLL_BATCH_SIZE
+from core import detect_student_faces, compute_face_descriptor, map_in_pool
+from db import fetch_existing_usernames
+from descriptor_cache import descriptor_cache
+from store import descriptor_store
+
+PHOTO_SUFFIXES = {'jpg', 'jpeg', 'png', 'bmp'}
+
+# 报告中的状态
+STATUS_OK = 'ok'
+STATUS_NO_FACE = 'no_face'
+STATUS_MULTIPLE_FACES = 'multiple_faces'
+STATUS_UNKNOWN_USERNAME = 'unknown_username'
+STATUS_UNSUPPORTED = 'unsupported'
+STATUS_ERROR = 'error'
+
+REPORT_HEADER = ['filename', 'username', 'status', 'message']
+
+
+class EnrollResult(NamedTuple):
+    filename: str
+    username: str
+    status: str
+    message: str = ''
+
+
+@contextmanager
+def open_source(source: str) -> Iterator[list[tuple[str, Callable[[], BinaryIO]]]]:
+    """返回顶层文件的 (文件名, 打开该文件的函数) 的列表，只读取压缩包的目录，照片在处理时才逐个解压"""
+    if os.path.isdir(source):
+        yield [
+            (name, partial(open, os.path.join(source, name), 'rb'))
+            for name in sorted(os.listdir(source))
+            if not name.startswith('.') and os.path.isfile(os.path.join(source, name))
+        ]
+        return
+
+    with zipfile.ZipFile(source) as archive:
+        yield [
+            (info.filename, partial(archive.open, info))
+            for info in archive.infolist()
+            # 部分 Windows 压缩工具以反斜杠分隔路径
+            if not info.is_dir() and not any(sep in info.filename for sep in '/\\') and not info.filename.startswith('.')
+        ]
+
+
+def parse_filename(filename: str) -> tuple[str, str]:
+    """返回 (学号, 后缀)"""
+    stem, _, suffix = os.path.basename(filename).rpartition('.')
+    return stem.strip(), suffix.lower()
+
+
+def read_report(report_path: str) -> list[EnrollResult]:
+    if not os.path.isfile(report_path):
+        return []
+    with open(report_path, newline='', encoding='utf8') as f:
+        return [EnrollResult(**row) for row in csv.DictReader(f)]
+
+
+def compute_enrollment_descriptor(photo_path: str) -> tuple[str, Optional[np.ndarray], str]:
+    """在进程池中执行，返回 (状态, 人脸特征, 说明)，只有照片中恰好有一张人脸时才计算特征"""
+    try:
+        student_image, student_faces = detect_student_faces(photo_path)
+    except Exception as e:
+        return STATUS_ERROR, None, str(e) or type(e).__name__
+    if not student_faces:
+        return STATUS_NO_FACE, None, '照片中没有检测到人脸'
+    if len(student_faces) > 1:
+        return STATUS_MULTIPLE_FACES, None, f'照片中检测到 {len(student_faces)} 张人脸'
+    return STATUS_OK, compute_face_descriptor(student_image, student_faces[0]), ''
+
+
+def enroll_batch(batch: list[tuple[str, Callable[[], BinaryIO]]], temp_dir: str) -> list[EnrollResult]:
+    parsed = [parse_filename(filename) for filename, _ in batch]
+    existing = fetch_existing_usernames([username for username, _ in parsed])
+
+    results: list[Optional[EnrollResult]] = [None] * len(batch)
+    pending: list[tuple[int, str]] = []  # (下标, 临时文件路径)
+    for i, ((filename, open_entry), (username, suffix)) in enumerate(zip(batch, parsed)):
+        if suffix not in PHOTO_SUFFIXES:
+            results[i] = EnrollResult(filename, username, STATUS_UNSUPPORTED, f'不支持的文件格式 {suffix}')
+        elif username not in existing:
+            results[i] = EnrollResult(filename, username, STATUS_UNKNOWN_USERNAME, '学生不存在')
+        else:
+            temp_path = os.path.join(temp_dir, f'{i}.{suffix}')
+            with open_entry() as src, open(temp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            pending.append((i, temp_path))
+
+    outputs = map_in_pool('enroll', ENROLL_WORKERS, compute_enrollment_descriptor, [path for _, path in pending])
+    descriptors = []
+    for (i, temp_path), (status, descriptor, message) in zip(pending, outputs):
+        filename = batch[i][0]
+        username, suffix = parsed[i]
+        if status == STATUS_OK:
+            shutil.move(temp_path, os.path.join(PHOTO, f'{username}.{suffix}'))
+            descriptors.append((username, descriptor))
+        else:
+            os.remove(temp_path)
+        results[i] = EnrollResult(filename, username, status, message)
+
+    # 整批的人脸特征一次性追加到存储中
+    descriptor_store.put_many(descriptors)
+    for username, _ in descriptors:
+        descriptor_cache.invalidate_student(username)
+    return results
+
+
+def enroll(source: str, report_path: str, logger: Optional[logging.Logger] = None) -> Counter:
+    """批量录入 source 中的学生照片，返回各状态的照片数，报告中已有的照片计为 skipped"""
+    logger = logger or logging.getLogger(__name__)
+    done = {result.filename for result in read_report(report_path)}
+    counts = Counter()
+
+    with (
+        open_source(source) as entries,
+        tempfile.TemporaryDirectory(dir=TEMP) as temp_dir,
+        open(report_path, 'a', newline='', encoding='utf8') as report_file
+    ):
+        writer = csv.writer(report_file)
+        if report_file.tell() == 0:
+            writer.writerow(REPORT_HEADER)
+
+        def flush(batch):
+            results = enroll_batch(batch, temp_dir)
+            # 整批的人脸特征写入后再写入报告，中断时未写入报告的照片会在下次运行时重新处理
+            writer.writerows(results)
+            report_file.flush()
+            os.fsync(report_file.fileno())
+            counts.update(result.status for result in results)
+            logger.info(f'已处理 {sum(counts.values())} 张照片，其中 {counts[STATUS_OK]} 张录入成功')
+
+        pending = [(filename, open_entry) for filename, open_entry in entries if filename not in done]
+        if len(pending) < len(entries):
+            logger.info(f'跳过报告中已有的 {len(entries) - len(pending)} 张照片')
+        for i in range(0, len(pending), ENROLL_BATCH_SIZE):
+            flush(pending[i:i + ENROLL_BATCH_SIZE])
+        if len(pending) < len(entries):
+            counts['skipped'] = len(entries) - len(pending)
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量录入学生照片')
+    parser.add_argument('source', help='照片的 ZIP 压缩包或文件夹，照片以学号命名')
+    parser.add_argument('--report', help='报告路径，默认为 <source>.report.csv，中断后使用同一份报告重新运行即可继续')
+    args = parser.parse_args()
+
+    from app import app, init_app
+
+    init_app()
+    report_path = args.report or f'{args.source.rstrip("/")}.report.csv'
+    with app.app_context():
+        counts = enroll(args.source, report_path, app.logger)
+
+    print('，'.join(f'{status} {count} 张' for status, count in counts.items()) or '没有需要处理的照片')
+    print(f'报告：{report_path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+导出课程的考勤记录
+
+每名学生一行：学号, 姓名, 出勤, 缺勤, 未知, 出勤率，之后每次考勤一列（表头为考勤时间，即服务端所在时区的本地时间，
+起止日期同样按本地日期计算）。
+行从数据库游标中逐行读取并逐块写出，内存占用与课程人数和考勤次数无关（只保存当前学生的一行）。
+CSV 带有 BOM，可以直接用 Excel 打开；XLSX 需要安装 openpyxl
+
+用法：python export.py [--output 文件夹] [--start YYYY-MM-DD] [--end YYYY-MM-DD] [--format csv|xlsx]
+"""
+import argparse
+import csv
+import io
+import os
+import re
+import sqlite3
+import tempfile
+from datetime import date
+from typing import BinaryIO, Iterator, Optional
+
+from data_model import AttendanceStatus
+from db import open_connection, fetch_export_courses, fetch_export_sessions, iter_export_marks
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+
+STATUS_TEXT = {
+    AttendanceStatus.UNKNOWN.value: '未知',
+    AttendanceStatus.PRESENT.value: '出勤',
+    AttendanceStatus.ABSENT.value: '缺勤',
+}
+
+# 每次写出的块大小（字节）
+CHUNK_SIZE = 64 * 1024
+
+
+def import_openpyxl():
+    try:
+        import openpyxl
+    except ImportError:
+        raise RuntimeError('导出 XLSX 需要安装 openpyxl') from None
+    return openpyxl
+
+
+def parse_date(value: str) -> str:
+    """检查日期格式为 YYYY-MM-DD，格式错误时抛出 ValueError"""
+    return date.fromisoformat(value).isoformat()
+
+
+def safe_filename(name: str) -> str:
+    return re.sub(r'[/\\:*?"<>|]', '_', name)
+
+
+def iter_rows(c: sqlite3.Cursor, course_id: str, start: Optional[str] = None, end: Optional[str] = None) -> Iterator[list]:
+    """逐行生成课程的考勤表，第一行为表头"""
+    sessions = fetch_export_sessions(c, course_id, start, end)
+    columns = {session_id: i for i, (session_id, _) in enumerate(sessions)}
+    yield ['学号', '姓名', '出勤', '缺勤', '未知', '出勤率'] + [created_at for _, created_at in sessions]
+
+    current, row, marks = None, None, None
+    for record_id, username, nickname, session_id, status in iter_export_marks(c, course_id, start, end):
+        if record_id != current:
+            if current is not None:
+                yield finish_row(row, marks)
+            current, row, marks = record_id, [username, nickname], [''] * len(sessions)
+        if session_id is not None:
+            marks[columns[session_id]] = STATUS_TEXT[status]
+    if current is not None:
+        yield finish_row(row, marks)
+
+
+def finish_row(row: list, marks: list[str]) -> list:
+    present, absent, unknown = (marks.count(STATUS_TEXT[status.value]) for status in (
+        AttendanceStatus.PRESENT, AttendanceStatus.ABSENT, AttendanceStatus.UNKNOWN
+    ))
+    total = present + absent + unknown
+    return row + [present, absent, unknown, f'{present / total:.1%}' if total else ''] + marks
+
+
+def iter_csv(rows: Iterator[list]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    yield '\ufeff'.encode('utf8')
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf8')
+
+
+def write_xlsx(rows: Iterator[list], file: str | BinaryIO, title: str) -> None:
+    """openpyxl 的只写模式逐行写入临时文件，不在内存中保存整张表"""
+    openpyxl = import_openpyxl()
+    workbook = openpyxl.Workbook(write_only=True)
+    # 工作表名称最长 31 个字符，且不能包含 []:*?/\
+    sheet = workbook.create_sheet(re.sub(r'[\[\]:*?/\\]', '_', title)[:31] or 'Sheet')
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file)
+
+
+def iter_xlsx(rows: Iterator[list], title: str) -> Iterator[bytes]:
+    """XLSX 是 ZIP 文件，只能写完后再发送，因此先写入临时文件"""
+    with tempfile.TemporaryFile() as f:
+        write_xlsx(rows, f, title)
+        f.seek(0)
+        yield from iter(lambda: f.read(CHUNK_SIZE), b'')
+
+
+def stream_course(
+        file_path: str,
+        course_id: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        fmt: str = 'csv'
+) -> Iterator[bytes]:
+    """
+    逐块生成课程的考勤表，用于流式响应
+
+    使用单独的连接而不是请求中复用的连接，在同一个读事务中读取考勤列表与考勤状态，导出期间写入的考勤不会使两者不一致
+    """
+    conn = open_connection(file_path)
+    try:
+        c = conn.cursor()
+        c.execute('BEGIN')
+        rows = iter_rows(c, course_id, start, end)
+        yield from iter_xlsx(rows, course_id) if fmt == 'xlsx' else iter_csv(rows)
+    finally:
+        conn.close()
+
+
+def export_all(
+        file_path: str,
+        output: str,
+        start: Optional[str] = None,
+        end: Optional[str] = None,
+        fmt: str = 'csv'
+) -> list[str]:
+    """在同一个读事务中将所有课程分别导出为 <output>/<课程代号>.<fmt>，返回导出的文件路径"""
+    os.makedirs(output, exist_ok=True)
+    conn = open_connection(file_path)
+    paths = []
+    try:
+        c = conn.cursor()
+        c.execute('BEGIN')
+        for course_id, _ in fetch_export_courses(c):
+            path = os.path.join(output, f'{safe_filename(course_id)}.{fmt}')
+            rows = iter_rows(conn.cursor(), course_id, start, end)
+            if fmt == 'xlsx':
+                write_xlsx(rows, path, course_id)
+            else:
+                with open(path, 'wb') as f:
+                    for chunk in iter_csv(rows):
+                        f.write(chunk)
+            paths.append(path)
+    finally:
+        conn.close()
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='导出所有课程的考勤记录')
+    parser.add_argument('--output', default='export', help='输出文件夹，每门课程一个文件')
+    parser.add_argument('--start', type=parse_date, help='起始日期（YYYY-MM-DD），默认不限制')
+    parser.add_argument('--end', type=parse_date, help='结束日期（YYYY-MM-DD，包含当天），默认不限制')
+    parser.add_argument('--format', choices=list(FORMATS), default='csv')
+    args = parser.parse_args()
+
+    from config_local import DATABASE
+
+    paths = export_all(DATABASE, args.output, args.start, args.end, args.format)
+    print(f'已导出 {len(paths)} 门课程的考勤记录到 {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+考勤照片的人脸特征缓存
+
+教师经常因为超时或选错课程而重新上传同一张照片，此时不需要再次检测人脸与提取特征，只需要重新匹配。
+缓存以照片内容的 sha256 为键，每张照片（或视频）的人脸特征保存为 FACE_CACHE 中的一个 .npy 文件，
+文件名中还包含影响识别结果的配置的指纹，修改这些配置后旧的缓存自然失效。
+
+总大小超过 FACE_CACHE_MAX_BYTES 时按最近使用时间（命中时会更新文件的修改时间）淘汰，
+多个进程可以同时使用同一个缓存文件夹
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import uuid
+from typing import Optional
+
+import numpy as np
+
+from config_local import (
+    FACE_CACHE, FACE_CACHE_MAX_BYTES, THRESHOLD, RECOGNITION_MODE, RECOGNITION_MODES, CASCADE_HOG_ADJUST_THRESHOLD,
+    DETECTION_TILING, TILE_SIZE, TILE_OVERLAP, TILE_MAX_UPSAMPLE,
+    VIDEO_SAMPLE_INTERVAL, VIDEO_MAX_SAMPLE_INTERVAL, VIDEO_TRACK_IOU, VIDEO_TRACK_TTL,
+    VIDEO_EMBEDDINGS_PER_TRACK, VIDEO_EMBEDDING_INTERVAL
+)
+
+# 识别流程的代码发生会影响结果的修改时递增，使旧的缓存失效
+PIPELINE_VERSION = 1
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def content_hash(path: str) -> str:
+    """照片内容的 sha256，attendance.save_photo() 保存的照片以 <sha256>.<后缀> 命名，此时直接取文件名，不再读取文件"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    if re.fullmatch('[0-9a-f]{64}', name):
+        return name
+    return hash_file(path)
+
+
+def config_fingerprint() -> str:
+    """影响人脸检测与特征提取结果的配置的指纹"""
+    settings = [
+        PIPELINE_VERSION, THRESHOLD, RECOGNITION_MODES[RECOGNITION_MODE], CASCADE_HOG_ADJUST_THRESHOLD,
+        DETECTION_TILING, TILE_SIZE, TILE_OVERLAP, TILE_MAX_UPSAMPLE,
+        VIDEO_SAMPLE_INTERVAL, VIDEO_MAX_SAMPLE_INTERVAL, VIDEO_TRACK_IOU, VIDEO_TRACK_TTL,
+        VIDEO_EMBEDDINGS_PER_TRACK, VIDEO_EMBEDDING_INTERVAL,
+    ]
+    return hashlib.sha256(json.dumps(settings).encode()).hexdigest()[:12]
+
+
+class FaceCache:
+    """照片内容哈希 -> 人脸特征 (人脸数, DESCRIPTOR_DIM) 的磁盘缓存"""
+
+    def __init__(self, path: str, max_bytes: int, fingerprint: str):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._bytes: Optional[int] = None  # 缓存文件夹的总大小，第一次写入时统计，之后按写入累加
+
+        self.hits = 0
+        self.misses = 0
+
+    def file_path(self, content_hash: str) -> str:
+        return os.path.join(self.path, f'{content_hash}.{self.fingerprint}.npy')
+
+    def get(self, content_hash: str) -> Optional[np.ndarray]:
+        path = self.file_path(content_hash)
+        try:
+            descriptors = np.load(path)
+            os.utime(path)  # 更新修改时间，作为最近使用时间
+        except (OSError, ValueError):  # 不存在，或者被其他进程淘汰
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return descriptors
+
+    def put(self, content_hash: str, descriptors: np.ndarray) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        path = self.file_path(content_hash)
+        # 先写入临时文件再原子地替换，其他进程不会读到写了一半的文件
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.asarray(descriptors, dtype=np.float32))
+        # 覆盖已有的文件时只累加大小的差值
+        try:
+            replaced_size = os.path.getsize(path)
+        except OSError:
+            replaced_size = 0
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._scan()[1]
+            else:
+                self._bytes += os.path.getsize(path) - replaced_size
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            for entry in self._scan()[0]:
+                self._remove(entry.path)
+            self._bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        entries, total = self._scan()
+        with self._lock:
+            return {'entries': len(entries), 'bytes': total, 'hits': self.hits, 'misses': self.misses}
+
+    def _scan(self) -> tuple[list[os.DirEntry], int]:
+        if not os.path.isdir(self.path):
+            return [], 0
+        entries = [entry for entry in os.scandir(self.path) if entry.name.endswith('.npy')]
+        return entries, sum(entry.stat().st_size for entry in entries)
+
+    def _evict(self) -> None:
+        """淘汰最久未使用的文件，直到总大小不超过上限的 90%，避免每次写入都触发淘汰"""
+        entries, total = self._scan()
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if total <= self.max_bytes * 0.9:
+                break
+            total -= entry.stat().st_size
+            self._remove(entry.path)
+        self._bytes = total
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # 已经被其他进程淘汰
+            pass
+
+
+face_cache = FaceCache(FACE_CACHE, FACE_CACHE_MAX_BYTES, config_fingerprint())
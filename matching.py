@@ -0,0 +1,220 @@
+from typing import NamedTuple
+
+import numpy as np
+
+from data_model import AttendanceStatus
+
+
+class MatchResult(NamedTuple):
+    status: list[AttendanceStatus]
+    face_index: np.ndarray  # 每个学生匹配到的人脸下标，未匹配时为 -1
+    distance: np.ndarray  # 每个学生与匹配到的人脸之间的距离，未匹配时为 inf
+
+
+def distance_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """批量计算欧氏距离，a 的形状为 (N, D)，b 的形状为 (M, D)，返回形状为 (N, M) 的距离矩阵"""
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    # |a - b|^2 = |a|^2 + |b|^2 - 2ab，用一次矩阵乘法代替 N*M 次 np.linalg.norm
+    squared = np.einsum('ij,ij->i', a, a)[:, None] + np.einsum('ij,ij->i', b, b)[None, :] - 2 * a @ b.T
+    np.maximum(squared, 0, out=squared)  # 消除浮点误差产生的负数
+    return np.sqrt(squared)
+
+
+def gallery_distance_matrix(
+        gallery: np.ndarray,
+        gallery_mask: np.ndarray,
+        face_matrix: np.ndarray,
+        mode='min'
+) -> np.ndarray:
+    """
+    计算每名学生的照片库与每张人脸之间的距离，gallery 的形状为 (N, K, D)，gallery_mask 的形状为 (N, K)
+
+    mode 为 min 时取照片库中最近的特征的距离，为 centroid 时取照片库中所有特征的平均值的距离，
+    没有任何特征的学生距离为 inf
+    """
+    n_students, k, dim = gallery.shape
+    if mode == 'centroid':
+        counts = gallery_mask.sum(axis=1)
+        centroids = (gallery * gallery_mask[:, :, None]).sum(axis=1) / np.maximum(counts, 1)[:, None]
+        distances = distance_matrix(centroids, face_matrix)
+        distances[counts == 0] = np.inf
+        return distances
+
+    # 所有学生的所有特征与所有人脸一次性计算，(N * K, M) 再按 K 取最小值
+    distances = distance_matrix(gallery.reshape(n_students * k, dim), face_matrix).reshape(n_students, k, -1)
+    distances[~gallery_mask] = np.inf
+    return distances.min(axis=1)
+
+
+def match_faces(
+        student_matrix: np.ndarray,
+        student_mask: np.ndarray,
+        face_matrix: np.ndarray,
+        threshold=0.4,
+        mode='min'
+) -> MatchResult:
+    """
+    将学生与照片中的人脸进行一对一匹配
+
+    每张人脸最多匹配一名学生，每名学生最多匹配一张人脸，
+    在距离小于 threshold 的所有匹配方案中，选择距离之和最小的方案
+
+    student_matrix 可以是形状为 (N, D) 的每名学生一个特征，也可以是形状为 (N, K, D) 的照片库，
+    此时 student_mask 的形状为 (N, K)，mode 见 gallery_distance_matrix()
+    """
+    if student_matrix.ndim == 3:
+        gallery, gallery_mask = student_matrix, student_mask
+        student_mask = gallery_mask.any(axis=1)
+    else:
+        gallery, gallery_mask = student_matrix[:, None, :], student_mask[:, None]
+
+    n_students = len(student_mask)
+    face_index = np.full(n_students, -1, dtype=np.int64)
+    distance = np.full(n_students, np.inf, dtype=np.float64)
+
+    face_matrix = np.asarray(face_matrix, dtype=np.float64).reshape(-1, gallery.shape[2])
+    if n_students and len(face_matrix):
+        distances = gallery_distance_matrix(gallery, gallery_mask, face_matrix, mode)
+        for student, face in _assign(distances, threshold):
+            face_index[student] = face
+            distance[student] = distances[student, face]
+
+    status = [
+        AttendanceStatus.UNKNOWN if not has_descriptor
+        else AttendanceStatus.PRESENT if face >= 0
+        else AttendanceStatus.ABSENT
+        for has_descriptor, face in zip(student_mask, face_index)
+    ]
+    return MatchResult(status, face_index, distance)
+
+
+def merge_descriptors(groups: list[np.ndarray], threshold=0.4) -> np.ndarray:
+    """
+    合并多张照片中属于同一个人的人脸特征，groups 的每一项为一张照片中所有人脸的特征
+
+    同一张照片中的人脸一定属于不同的人，因此每张照片的人脸与已有的人按距离进行一对一匹配，
+    距离小于 threshold 的视为同一个人，其余的视为新的人，返回每个人所有特征的平均值
+    """
+    dim = groups[0].shape[1] if groups else 128
+    sums = np.zeros((0, dim), dtype=np.float64)
+    counts = np.zeros(0, dtype=np.int64)
+
+    for group in groups:
+        group = np.asarray(group, dtype=np.float64).reshape(-1, dim)
+        matched = np.zeros(len(group), dtype=bool)
+        if len(sums) and len(group):
+            for person, face in _assign(distance_matrix(sums / counts[:, None], group), threshold):
+                sums[person] += group[face]
+                counts[person] += 1
+                matched[face] = True
+        sums = np.concatenate([sums, group[~matched]])
+        counts = np.concatenate([counts, np.ones(int((~matched).sum()), dtype=np.int64)])
+
+    return (sums / counts[:, None]).astype(np.float32)
+
+
+def _assign(distances: np.ndarray, threshold: float) -> list[tuple[int, int]]:
+    candidates = distances < threshold
+    rows = np.flatnonzero(candidates.any(axis=1))
+    cols = np.flatnonzero(candidates.any(axis=0))
+    if not len(rows):
+        return []
+
+    # 只有距离小于阈值的学生与人脸才可能互相影响，按连通分量拆分后分别求解，
+    # 大多数分量只包含一名学生与一张人脸，无需运行匈牙利算法
+    sub_candidates = candidates[np.ix_(rows, cols)]
+    pairs = []
+    for component_rows, component_cols in _connected_components(sub_candidates):
+        student_index, face_index = rows[component_rows], cols[component_cols]
+        if len(student_index) == 1 and len(face_index) == 1:
+            pairs.append((int(student_index[0]), int(face_index[0])))
+            continue
+
+        block = distances[np.ix_(student_index, face_index)]
+        # 距离不小于阈值的配对与不配对等价，代价统一记为阈值
+        cost = np.minimum(block, threshold)
+        for r, c in zip(*linear_sum_assignment(cost)):
+            if block[r, c] < threshold:
+                pairs.append((int(student_index[r]), int(face_index[c])))
+
+    return pairs
+
+
+def _connected_components(adjacency: np.ndarray) -> list[tuple[np.ndarray, np.ndarray]]:
+    """求二分图的连通分量，adjacency 的每一行都至少有一条边"""
+    n_rows, n_cols = adjacency.shape
+    row_seen = np.zeros(n_rows, dtype=bool)
+    col_seen = np.zeros(n_cols, dtype=bool)
+    components = []
+
+    for start in range(n_rows):
+        if row_seen[start]:
+            continue
+        row_seen[start] = True
+        component_rows, component_cols = [start], []
+        frontier = np.array([start])
+        while frontier.size:
+            new_cols = np.flatnonzero(adjacency[frontier].any(axis=0) & ~col_seen)
+            col_seen[new_cols] = True
+            component_cols.extend(new_cols)
+            frontier = np.flatnonzero(adjacency[:, new_cols].any(axis=1) & ~row_seen)
+            row_seen[frontier] = True
+            component_rows.extend(frontier)
+        components.append((np.array(component_rows), np.array(component_cols)))
+
+    return components
+
+
+def linear_sum_assignment(cost: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    求解矩形代价矩阵的最小代价完美匹配（匈牙利算法，最短增广路实现）
+
+    返回 (row_ind, col_ind)，与 scipy.optimize.linear_sum_assignment 的约定相同
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)  # p[j] 为第 j 列匹配的行（从 1 开始，0 表示未匹配）
+    way = np.zeros(m + 1, dtype=np.int64)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            improved = free & (reduced < minv[1:])
+            minv[1:][improved] = reduced[improved]
+            way[1:][improved] = j0
+
+            masked = np.where(free, minv[1:], np.inf)
+            j1 = int(masked.argmin()) + 1
+            delta = masked[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    cols = np.flatnonzero(p[1:])
+    rows = p[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
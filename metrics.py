@@ -0,0 +1,202 @@
+"""
+进程内的计数器与直方图，由 /metrics 以 Prometheus 文本格式导出
+
+记录一次只需要一次二分查找与一次加锁的累加，不依赖 prometheus_client。
+指标在当前进程内累计；任务执行期间的指标由 capture() 记录并随任务保存在数据库中，
+服务端的 /metrics 再用 replay() 汇总，因此在 python worker.py 等其他进程中执行的任务同样会被导出
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from flask import Response, g, request
+
+# 耗时（秒）的默认分桶
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+registry: list['Metric'] = []
+
+# capture() 期间当前线程记录的指标
+_capture = threading.local()
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _captured(self, value: float, labels: dict[str, object]) -> bool:
+        """当前线程处于 capture() 中时记录本次观测值并返回 True"""
+        observations = getattr(_capture, 'observations', None)
+        if observations is None:
+            return False
+        observations.append([self.name, {name: str(label) for name, label in labels.items()}, value])
+        return True
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...], **extra: str) -> str:
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+    def collect(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.collect())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        if self._captured(amount, labels):
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def collect(self) -> Iterator[str]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield f'{self.name}{self._labels(key)} {format_value(value)}'
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每组标签对应 [各分桶的计数（不累加，最后一个为 +Inf）, 总和]
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        if self._captured(value, labels):
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def collect(self) -> Iterator[str]:
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{self._labels(key, le=format_value(bound))} {cumulative}'
+            yield f'{self.name}_sum{self._labels(key)} {format_value(total)}'
+            yield f'{self.name}_count{self._labels(key)} {cumulative}'
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def render() -> str:
+    return ''.join(metric.render() for metric in registry)
+
+
+@contextmanager
+def capture() -> Iterator[list]:
+    """
+    在 with 块中，当前线程的 inc() 与 observe() 不计入本进程的指标，而是以 [名称, 标签, 值] 的形式追加到返回的列表中，
+    列表可以序列化为 JSON 保存，之后由 replay() 计入
+    """
+    observations = []
+    _capture.observations = observations
+    try:
+        yield observations
+    finally:
+        _capture.observations = None
+
+
+def replay(observations: list) -> None:
+    """将 capture() 记录的观测值计入本进程的指标，忽略已不存在的指标"""
+    metrics = {metric.name: metric for metric in registry}
+    for name, labels, value in observations:
+        metric = metrics.get(name)
+        if isinstance(metric, Counter):
+            metric.inc(value, **labels)
+        elif isinstance(metric, Histogram):
+            metric.observe(value, **labels)
+
+
+http_request_seconds = Histogram(
+    'http_request_duration_seconds', '请求处理耗时', ('endpoint', 'method', 'status')
+)
+db_queries_per_request = Histogram(
+    'db_queries_per_request', '每个请求执行的 SQL 语句数', ('endpoint',),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+attendance_stage_seconds = Histogram(
+    'attendance_stage_duration_seconds', '每次考勤中各阶段的耗时', ('stage',)
+)
+attendance_job_seconds = Histogram('attendance_job_duration_seconds', '每次考勤的总耗时')
+attendance_faces_per_image = Histogram(
+    'attendance_faces_per_image', '每张照片（或每段视频）中检测到的人数',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200)
+)
+attendance_students_matched = Histogram(
+    'attendance_students_matched', '每次考勤中与人脸匹配的学生数',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+attendance_students = Counter('attendance_students_total', '考勤结果中各状态的学生数', ('status',))
+detector_faces = Counter('detector_faces_total', 'cascade 模式下各检测阶段检测到的人脸数', ('stage',))
+user_cache_requests = Counter(
+    'user_cache_requests_total', '登录用户缓存的命中、未命中与超过有效期后查询版本号的次数', ('result',)
+)
+face_cache_requests = Counter('face_cache_requests_total', '考勤照片人脸特征缓存的命中与未命中次数', ('result',))
+job_failures = Counter('job_failures_total', '任务执行失败的次数，重新排队的每次失败都会计入', ('kind',))
+
+
+def start_request_timer() -> None:
+    """注册为 before_request 钩子"""
+    g.request_start = time.perf_counter()
+
+
+def observe_request(response: Response) -> Response:
+    """注册为 after_request 钩子，记录请求耗时与执行的 SQL 语句数"""
+    start = g.pop('request_start', None)
+    if start is not None:
+        endpoint = request.endpoint or 'unknown'
+        http_request_seconds.observe(
+            time.perf_counter() - start, endpoint=endpoint, method=request.method, status=response.status_code
+        )
+        db_queries_per_request.observe(g.get('db_queries', 0), endpoint=endpoint)
+    return response
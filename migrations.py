@@ -0,0 +1,333 @@
+"""
+数据库的创建与版本迁移
+
+PRAGMA user_version 记录数据库已执行的迁移数，启动时按顺序执行 MIGRATIONS 中尚未执行的迁移，
+所有迁移在同一个事务中执行，失败时数据库保持原样。新建的数据库由 schema.sql 创建，直接标记为最新版本，
+因此修改表结构时需要同时修改 schema.sql 并在 MIGRATIONS 末尾追加一项迁移
+
+用法：python migrations.py [status|upgrade]
+"""
+import argparse
+import json
+import secrets
+import sqlite3
+from typing import Callable, Optional
+
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from data_model import AttendanceStatus
+from db import Connect, rebuild_attendance_stat
+
+# 版本 2 添加的索引，schema.sql 中有相同的定义
+INDEXES = {
+    # 学生的选课列表，同一名学生不能重复加入同一门课程
+    'attendance_student_course':
+        'CREATE UNIQUE INDEX IF NOT EXISTS attendance_student_course ON attendance (student_id, course_id)',
+    # 课程的选课名单，索引中同一门课程的记录按 id 排序，按选课顺序列出学生时不需要再排序
+    'attendance_course_id': 'CREATE INDEX IF NOT EXISTS attendance_course_id ON attendance (course_id)',
+    # 教师的课程列表
+    'course_teacher_id': 'CREATE INDEX IF NOT EXISTS course_teacher_id ON course (teacher_id)',
+    # 学生在所有课程中的考勤状态
+    'attendance_mark_student_id':
+        'CREATE INDEX IF NOT EXISTS attendance_mark_student_id ON attendance_mark (student_id)',
+}
+
+
+def init_db(file_path: Optional[str] = None):
+    if not file_path:
+        file_path = current_app.config['DATABASE']
+
+    with current_app.open_resource('schema.sql') as f:
+        init_sql = f.read().decode('utf8')
+
+    default_admin_username = current_app.config['DEFAULT_ADMIN']
+    default_admin_password = secrets.token_urlsafe(16)
+    with Connect(file_path) as c:
+        c.executescript(init_sql)
+        # 新建的数据库已经是最新的表结构，不需要执行任何迁移
+        c.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        c.execute(
+            'INSERT INTO user (nickname, username, password, role) VALUES (?, ?, ?, ?)',
+            (default_admin_username, default_admin_username,
+             generate_password_hash(f'{default_admin_username}{default_admin_password}'), 3,)
+        )
+
+    current_app.logger.warning(f'数据库 {file_path} 已初始化')
+    current_app.logger.info(
+        f'初始用户为超级管理员，'
+        f'用户名：{default_admin_username}，'
+        f'密码：{default_admin_password}'
+    )
+
+
+def upgrade_legacy_schema(c: sqlite3.Cursor) -> list[str]:
+    """
+    版本 1：将引入版本号之前的各版本数据库升级到当时的表结构，返回升级的内容
+
+    这些数据库的 user_version 都为 0，因此逐项检查表与列是否存在
+    """
+    upgraded = []
+    tables = {name for name, in c.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    # 旧版本允许同一名学生重复加入同一门课程，写入考勤状态与统计之前先去除重复的选课记录
+    removed = remove_duplicate_enrollments(c)
+    if removed:
+        upgraded.append(f'去除 {removed} 条重复的选课记录')
+
+    if 'session' not in tables:
+        migrate_attendance_record(c)
+        upgraded.append('考勤记录')
+    elif 'job_id' not in {row[1] for row in c.execute('PRAGMA table_info(session)')}:
+        c.execute('ALTER TABLE session ADD COLUMN job_id INTEGER')
+        c.execute('CREATE UNIQUE INDEX session_job_id ON session (job_id)')
+        upgraded.append('考勤与任务的关联')
+
+    if 'job' not in tables:
+        c.execute(
+            'CREATE TABLE job ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+            'kind TEXT NOT NULL, '
+            'payload TEXT NOT NULL, '
+            "status TEXT NOT NULL DEFAULT 'queued', "
+            'attempts INTEGER NOT NULL DEFAULT 0, '
+            'worker TEXT, '
+            'lease_until REAL, '
+            'result TEXT, '
+            'error TEXT, '
+            'created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+            'updated_at TEXT)'
+        )
+        c.execute('CREATE INDEX job_status ON job (status, id)')
+        upgraded.append('任务队列')
+
+    if 'version' not in {row[1] for row in c.execute('PRAGMA table_info(user)')}:
+        c.execute('ALTER TABLE user ADD COLUMN version INTEGER NOT NULL DEFAULT 0')
+        upgraded.append('用户版本号')
+
+    if 'attendance_stat' not in tables:
+        c.execute(
+            'CREATE TABLE attendance_stat ('
+            'course_id TEXT NOT NULL, '
+            'student_id INTEGER NOT NULL, '
+            'sessions INTEGER NOT NULL, '
+            'present INTEGER NOT NULL, '
+            'absent INTEGER NOT NULL, '
+            'unknown INTEGER NOT NULL, '
+            'last_present_at TEXT, '
+            'PRIMARY KEY (course_id, student_id)'
+            ') WITHOUT ROWID'
+        )
+        c.execute(
+            'CREATE TABLE course_stat ('
+            'course_id TEXT PRIMARY KEY, '
+            'sessions INTEGER NOT NULL, '
+            'present INTEGER NOT NULL, '
+            'absent INTEGER NOT NULL, '
+            'unknown INTEGER NOT NULL, '
+            'last_session_at TEXT'
+            ') WITHOUT ROWID'
+        )
+        rebuild_attendance_stat(c)
+        upgraded.append('考勤统计')
+    return upgraded
+
+
+def remove_duplicate_enrollments(c: sqlite3.Cursor) -> int:
+    """每名学生在每门课程中只保留最早的一条选课记录（旧版本的考勤只追加到这一条），返回去除的条数"""
+    c.execute('DELETE FROM attendance WHERE id NOT IN (SELECT min(id) FROM attendance GROUP BY course_id, student_id)')
+    return c.rowcount
+
+
+def add_indexes(c: sqlite3.Cursor) -> list[str]:
+    """
+    版本 2：为选课名单、课程与考勤状态的常用查询添加索引
+
+    旧版本的 attendance.course_id 声明为 INTEGER，与 course.id 等 TEXT 列比较时无法使用对方的索引，
+    因此重建该表，同时去除旧版本遗留的 record 列。版本 1 的数据库中仍可能有之后重复加入的选课记录，
+    重建时同样只保留最早的一条，否则无法创建唯一索引
+    """
+    upgraded = []
+    count, = c.execute('SELECT count(*) FROM attendance').fetchone()
+    c.execute(
+        'CREATE TABLE attendance_new ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'course_id TEXT NOT NULL, '
+        'student_id INTEGER NOT NULL)'
+    )
+    c.execute(
+        'INSERT INTO attendance_new (id, course_id, student_id) '
+        'SELECT min(id), CAST(course_id AS TEXT), student_id FROM attendance '
+        'GROUP BY CAST(course_id AS TEXT), student_id ORDER BY min(id)'
+    )
+    c.execute('DROP TABLE attendance')
+    c.execute('ALTER TABLE attendance_new RENAME TO attendance')
+    removed = count - c.execute('SELECT count(*) FROM attendance').fetchone()[0]
+    if removed:
+        upgraded.append(f'去除 {removed} 条重复的选课记录')
+
+    for statement in INDEXES.values():
+        c.execute(statement)
+    upgraded.append('添加索引')
+    return upgraded
+
+
+def add_job_metrics(c: sqlite3.Cursor) -> list[str]:
+    """版本 3：保存任务执行期间记录的指标，使其他进程中执行的任务也能出现在服务端的 /metrics 中"""
+    c.execute('ALTER TABLE job ADD COLUMN metrics TEXT')
+    return ['任务指标']
+
+
+def use_local_time(c: sqlite3.Cursor) -> list[str]:
+    """
+    版本 4：考勤时间改为保存服务端所在时区的本地时间
+
+    CURRENT_TIMESTAMP 为 UTC 时间，按日期导出、导出的表头与面板中的最近出勤、最近考勤时间都与教师所在的时区不一致，
+    默认值无法通过 ALTER TABLE 修改，因此重建 session 表，同时将已有的考勤时间转换为本地时间
+    """
+    c.execute(
+        'CREATE TABLE session_new ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'course_id TEXT NOT NULL, '
+        "created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')), "
+        'photo_hash TEXT, '
+        'job_id INTEGER)'
+    )
+    c.execute(
+        'INSERT INTO session_new (id, course_id, created_at, photo_hash, job_id) '
+        "SELECT id, course_id, datetime(created_at, 'localtime'), photo_hash, job_id FROM session ORDER BY id"
+    )
+    c.execute('DROP TABLE session')
+    c.execute('ALTER TABLE session_new RENAME TO session')
+    c.execute('CREATE INDEX session_course_id ON session (course_id)')
+    c.execute('CREATE UNIQUE INDEX session_job_id ON session (job_id)')
+    # 考勤统计中的最近出勤、最近考勤时间复制自 session.created_at，按转换后的时间重新计算
+    rebuild_attendance_stat(c)
+    return ['考勤时间改为本地时间']
+
+
+def track_job_metrics(c: sqlite3.Cursor) -> list[str]:
+    """
+    版本 5：记录任务指标的汇总时间，/metrics 汇总所有尚未汇总的任务，不再依赖任务的完成顺序
+
+    升级前已有的任务指标在此之前已被各个服务端进程按 id 顺序汇总过，标记为已汇总，避免重复计入
+    """
+    c.execute('ALTER TABLE job ADD COLUMN metrics_collected_at TEXT')
+    c.execute('UPDATE job SET metrics_collected_at = CURRENT_TIMESTAMP WHERE metrics IS NOT NULL')
+    c.execute(
+        'CREATE INDEX job_metrics_pending ON job (id) WHERE metrics IS NOT NULL AND metrics_collected_at IS NULL'
+    )
+    return ['任务指标汇总标记']
+
+
+# 按顺序执行的迁移，第 i 项（从 1 开始）将数据库从版本 i - 1 升级到版本 i，只能在末尾追加
+MIGRATIONS: list[Callable[[sqlite3.Cursor], list[str]]] = [
+    upgrade_legacy_schema,
+    add_indexes,
+    add_job_metrics,
+    use_local_time,
+    track_job_metrics,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_version(c: sqlite3.Cursor) -> int:
+    return c.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate_db(file_path: Optional[str] = None) -> bool:
+    """将数据库升级到最新版本，返回是否进行了升级"""
+    if not file_path:
+        file_path = current_app.config['DATABASE']
+
+    upgraded = []
+    with Connect(file_path) as c:
+        c.execute('BEGIN IMMEDIATE')
+        version = get_version(c)
+        if version > SCHEMA_VERSION:
+            raise RuntimeError(f'数据库 {file_path} 的版本 {version} 高于当前程序支持的版本 {SCHEMA_VERSION}')
+        for target, migration in enumerate(MIGRATIONS[version:], version + 1):
+            upgraded.extend(migration(c))
+            # user_version 保存在数据库文件头中，与迁移在同一个事务中提交
+            c.execute(f'PRAGMA user_version = {target}')
+
+    if upgraded:
+        current_app.logger.warning(f'数据库 {file_path} 已升级到版本 {SCHEMA_VERSION}：{"、".join(upgraded)}')
+    return bool(upgraded)
+
+
+def migrate_attendance_record(c: sqlite3.Cursor) -> None:
+    """将旧版本数据库中 attendance.record 的 JSON 考勤记录迁移到 session 与 attendance_mark 表"""
+    c.execute(
+        'CREATE TABLE session ('
+        'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'course_id TEXT NOT NULL, '
+        'created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP, '
+        'photo_hash TEXT, '
+        'job_id INTEGER)'
+    )
+    c.execute('CREATE INDEX session_course_id ON session (course_id)')
+    c.execute('CREATE UNIQUE INDEX session_job_id ON session (job_id)')
+    c.execute(
+        'CREATE TABLE attendance_mark ('
+        'session_id INTEGER NOT NULL, '
+        'student_id INTEGER NOT NULL, '
+        'status INTEGER NOT NULL, '
+        'PRIMARY KEY (session_id, student_id)'
+        ') WITHOUT ROWID'
+    )
+
+    # 旧版本中未知与缺勤都记为 🟥，迁移后无法区分，统一视为缺勤
+    status_of = {'🟩': AttendanceStatus.PRESENT.value, '🟥': AttendanceStatus.ABSENT.value}
+    # 旧版本允许同一名学生重复加入同一门课程，考勤只追加到其中最早的一条选课记录，其余的记录较短或为空，
+    # 因此每名学生只保留最长的一条记录，否则同一次考勤会写入重复的状态
+    records_of_course: dict[str, dict[int, list[str]]] = {}
+    for course_id, student_id, record in c.execute(
+            'SELECT course_id, student_id, record FROM attendance ORDER BY id'
+    ):
+        records = records_of_course.setdefault(course_id, {})
+        record = json.loads(record)
+        if student_id not in records or len(record) > len(records[student_id]):
+            records[student_id] = record
+
+    for course_id, records in records_of_course.items():
+        session_count = max(len(record) for record in records.values())
+        session_ids = []
+        for _ in range(session_count):
+            c.execute('INSERT INTO session (course_id) VALUES (?)', (course_id,))
+            session_ids.append(c.lastrowid)
+        # 学生的记录从加入课程后才开始追加，因此较短的记录对应的是最近的几次考勤
+        c.executemany(
+            'INSERT INTO attendance_mark (session_id, student_id, status) VALUES (?, ?, ?)',
+            [
+                (session_ids[session_count - len(record) + i], student_id,
+                 status_of.get(block, AttendanceStatus.UNKNOWN.value))
+                for student_id, record in records.items()
+                for i, block in enumerate(record)
+            ]
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='数据库版本迁移')
+    parser.add_argument('command', choices=['status', 'upgrade'], nargs='?', default='status')
+    args = parser.parse_args()
+
+    from app import app, import_config
+
+    import_config()
+    with app.app_context():
+        file_path = current_app.config['DATABASE']
+        if args.command == 'upgrade':
+            migrate_db(file_path)
+        with Connect(file_path) as c:
+            version = get_version(c)
+        pending = [migration.__name__ for migration in MIGRATIONS[version:]]
+        print(f'数据库 {file_path}：版本 {version}，最新版本 {SCHEMA_VERSION}')
+        if pending:
+            print(f'尚未执行的迁移：{"、".join(pending)}')
+
+
+if __name__ == '__main__':
+    main()
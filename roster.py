@@ -0,0 +1,182 @@
+"""
+批量导入用户、课程与选课名单
+
+名单为带表头的 CSV 文件，每行一名用户，可以同时将学生加入一门课程：
+username（必填）, nickname, role（0: 学生，1: 教师，默认为 0）, password（新用户必填）,
+course_id, course_name, teacher（任课教师的用户名，course_name 与 teacher 只在新建课程时需要）
+
+名单先写入临时表，用整张表的查询校验，再在同一个事务中批量写入。
+出错的行不会写入，其余的行照常导入，每一行的结果写入报告：行号, 用户名, 课程代号, 状态, 说明。
+新用户的密码哈希在进程池中并行计算，此时不持有数据库的写锁
+
+用法：python roster.py <名单.csv> [--report report.csv] [--dry-run]
+"""
+import argparse
+import csv
+import logging
+from collections import Counter
+from typing import NamedTuple, Optional
+
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from config_local import ROSTER_WORKERS
+from core import map_in_pool
+from db import open_connection, load_roster, fetch_roster_new_users, fetch_roster_results, import_roster
+from descriptor_cache import descriptor_cache
+
+COLUMNS = ['username', 'nickname', 'role', 'password', 'course_id', 'course_name', 'teacher']
+
+# 报告中的状态
+STATUS_OK = 'ok'
+STATUS_SKIPPED = 'skipped'
+STATUS_ERROR = 'error'
+
+REPORT_HEADER = ['line', 'username', 'course_id', 'status', 'message']
+
+
+class RosterResult(NamedTuple):
+    line: int
+    username: str
+    course_id: str
+    status: str
+    message: str = ''
+
+
+def check_row(row: dict[str, Optional[str]]) -> Optional[str]:
+    """只检查一行自身的格式，返回错误说明"""
+    username = row['username']
+    if not username:
+        return '用户名未填写'
+    if not username.isalnum():
+        return '用户名只能是字母和数字'
+    if len(username) < 3 or len(username) > 20:
+        return '用户名长度必须在 3 到 20 之间'
+    if row['role'] not in (None, '0', '1'):
+        return '角色只能是 0（学生）或 1（教师）'
+    if row['role'] == '1' and row['course_id']:
+        return '只有学生可以加入课程'
+    if (row['course_name'] or row['teacher']) and not row['course_id']:
+        return '填写了课程名称或任课教师，但没有填写课程代号'
+    return None
+
+
+def read_roster(source: str) -> tuple[list[tuple], dict[int, str]]:
+    """返回 load_roster 所需的行，以及行号到密码的映射（密码不写入数据库的临时表）"""
+    rows = []
+    passwords = {}
+    # Excel 保存的 CSV 带有 BOM
+    with open(source, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f)
+        if 'username' not in (reader.fieldnames or []):
+            raise RuntimeError('名单缺少 username 列')
+        for record in reader:
+            row = {column: (record.get(column) or '').strip() or None for column in COLUMNS}
+            line = reader.line_num
+            if row['password']:
+                passwords[line] = row['password']
+            rows.append((
+                line, row['username'], row['nickname'], int(row['role'] or 0) if row['role'] in ('0', '1') else None,
+                bool(row['password']), row['course_id'], row['course_name'], row['teacher'], check_row(row)
+            ))
+    return rows, passwords
+
+
+def hash_password(item: tuple[str, str]) -> str:
+    """在进程池中执行，与 create_user 使用相同的格式"""
+    username, password = item
+    return generate_password_hash(f'{username}{password}')
+
+
+def hash_new_users(new_users: list[tuple], passwords: dict[int, str], hashes: dict[str, str]) -> None:
+    pending = [(username, passwords[line]) for username, _, _, line in new_users if username not in hashes]
+    for (username, _), password_hash in zip(pending, map_in_pool('roster', ROSTER_WORKERS, hash_password, pending)):
+        hashes[username] = password_hash
+
+
+def get_result(line: int, username: str, course_id: str, error: Optional[str], new_user: int, new_course: int,
+               enroll: int) -> RosterResult:
+    if error:
+        return RosterResult(line, username, course_id, STATUS_ERROR, error)
+    done = [message for flag, message in ((new_user, '新建用户'), (new_course, '新建课程'), (enroll, '加入课程')) if flag]
+    if done:
+        return RosterResult(line, username, course_id, STATUS_OK, '，'.join(done))
+    return RosterResult(line, username, course_id, STATUS_SKIPPED, '已加入课程' if course_id else '用户已存在')
+
+
+def import_roster_file(
+        source: str,
+        report_path: str,
+        dry_run: bool = False,
+        logger: Optional[logging.Logger] = None
+) -> Counter:
+    """导入名单并写入报告，返回各状态的行数，dry_run 时只校验不写入"""
+    logger = logger or logging.getLogger(__name__)
+    rows, passwords = read_roster(source)
+    logger.info(f'名单 {source} 共 {len(rows)} 行')
+
+    conn = open_connection(current_app.config['DATABASE'])
+    try:
+        c = conn.cursor()
+        hashes: dict[str, str] = {}
+        if not dry_run:
+            # 第一遍校验只读取数据库，据此在不持有写锁的情况下计算新用户的密码哈希
+            load_roster(c, rows)
+            new_users = fetch_roster_new_users(c)
+            conn.commit()
+            hash_new_users(new_users, passwords, hashes)
+            c.execute('BEGIN IMMEDIATE')
+
+        # 在写事务中重新校验，期间被其他请求修改的数据也能被发现
+        load_roster(c, rows)
+        new_users = fetch_roster_new_users(c)
+        results = [get_result(*result) for result in fetch_roster_results(c)]
+        if dry_run:
+            conn.rollback()
+        else:
+            hash_new_users(new_users, passwords, hashes)
+            changed_courses = import_roster(c, [
+                (nickname, username, hashes[username], role) for username, nickname, role, _ in new_users
+            ])
+            conn.commit()
+            # 选课名单发生变化，这些课程缓存的人脸特征需要重新载入
+            for course_id in changed_courses:
+                descriptor_cache.invalidate_course(course_id)
+    finally:
+        conn.close()
+
+    with open(report_path, 'w', newline='', encoding='utf8') as f:
+        writer = csv.writer(f)
+        writer.writerow(REPORT_HEADER)
+        writer.writerows(results)
+
+    counts = Counter(result.status for result in results)
+    logger.info('，'.join(f'{status} {count} 行' for status, count in counts.items()))
+    return counts
+
+
+def read_report(report_path: str) -> list[RosterResult]:
+    with open(report_path, newline='', encoding='utf8') as f:
+        return [RosterResult(**row) for row in csv.DictReader(f)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='批量导入用户、课程与选课名单')
+    parser.add_argument('source', help='CSV 名单')
+    parser.add_argument('--report', help='报告路径，默认为 <source>.report.csv')
+    parser.add_argument('--dry-run', action='store_true', help='只校验名单，不写入数据库')
+    args = parser.parse_args()
+
+    from app import app, init_app
+
+    init_app()
+    report_path = args.report or f'{args.source}.report.csv'
+    with app.app_context():
+        counts = import_roster_file(args.source, report_path, args.dry_run, app.logger)
+
+    print('，'.join(f'{status} {count} 行' for status, count in counts.items()) or '名单为空')
+    print(f'报告：{report_path}')
+
+
+if __name__ == '__main__':
+    main()
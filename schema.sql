@@ -1,13 +1,19 @@
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS course;
 DROP TABLE IF EXISTS attendance;
+DROP TABLE IF EXISTS session;
+DROP TABLE IF EXISTS attendance_mark;
+DROP TABLE IF EXISTS job;
+DROP TABLE IF EXISTS attendance_stat;
+DROP TABLE IF EXISTS course_stat;
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   nickname TEXT NOT NULL,
   username TEXT UNIQUE NOT NULL,
   password TEXT NOT NULL,
-  role INTEGER NOT NULL  -- 0: 学生, 1: 教师, 2: 管理员, 3: 超级管理员
+  role INTEGER NOT NULL,  -- 0: 学生, 1: 教师, 2: 管理员, 3: 超级管理员
+  version INTEGER NOT NULL DEFAULT 0  -- 每次修改时递增，用于使其他进程中缓存的用户失效
 );
 
 CREATE TABLE course (
@@ -16,9 +22,73 @@ CREATE TABLE course (
   teacher_id INTEGER NOT NULL  -- user.id 的无约束外键
 );
 
-CREATE TABLE attendance (
+CREATE INDEX course_teacher_id ON course (teacher_id);
+
+CREATE TABLE attendance (  -- 选课名单
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  course_id TEXT NOT NULL,  -- course.id 的无约束外键
+  student_id INTEGER NOT NULL  -- user.id 的无约束外键
+);
+
+CREATE UNIQUE INDEX attendance_student_course ON attendance (student_id, course_id);  -- 同一名学生不能重复加入同一门课程
+CREATE INDEX attendance_course_id ON attendance (course_id);
+
+CREATE TABLE session (  -- 每次考勤
   id INTEGER PRIMARY KEY AUTOINCREMENT,
-  course_id INTEGER NOT NULL,  -- course.id 的无约束外键
+  course_id TEXT NOT NULL,  -- course.id 的无约束外键
+  created_at TEXT NOT NULL DEFAULT (datetime('now', 'localtime')),  -- 服务端所在时区的本地时间，按日期导出时直接比较
+  photo_hash TEXT,  -- 考勤照片的 sha256
+  job_id INTEGER  -- job.id 的无约束外键，由任务队列写入时用于防止重复写入
+);
+
+CREATE INDEX session_course_id ON session (course_id);
+CREATE UNIQUE INDEX session_job_id ON session (job_id);
+
+CREATE TABLE attendance_mark (  -- 每名学生在每次考勤中的状态
+  session_id INTEGER NOT NULL,  -- session.id 的无约束外键
   student_id INTEGER NOT NULL,  -- user.id 的无约束外键
-  record TEXT NOT NULL DEFAULT '[]' -- json
+  status INTEGER NOT NULL,  -- AttendanceStatus 的值，1: 未知, 2: 出勤, 3: 缺勤
+  PRIMARY KEY (session_id, student_id)
+) WITHOUT ROWID;
+
+CREATE INDEX attendance_mark_student_id ON attendance_mark (student_id);
+
+CREATE TABLE attendance_stat (  -- 每名学生在每门课程中的考勤统计，与每次考勤在同一个事务中增量更新
+  course_id TEXT NOT NULL,  -- course.id 的无约束外键
+  student_id INTEGER NOT NULL,  -- user.id 的无约束外键
+  sessions INTEGER NOT NULL,  -- 该学生的考勤次数
+  present INTEGER NOT NULL,  -- 出勤次数
+  absent INTEGER NOT NULL,  -- 缺勤次数
+  unknown INTEGER NOT NULL,  -- 未知次数
+  last_present_at TEXT,  -- 最近一次出勤的考勤时间
+  PRIMARY KEY (course_id, student_id)
+) WITHOUT ROWID;
+
+CREATE TABLE course_stat (  -- 每门课程的考勤统计，与每次考勤在同一个事务中增量更新
+  course_id TEXT PRIMARY KEY,  -- course.id 的无约束外键
+  sessions INTEGER NOT NULL,  -- 考勤次数
+  present INTEGER NOT NULL,  -- 所有学生的出勤次数之和
+  absent INTEGER NOT NULL,  -- 所有学生的缺勤次数之和
+  unknown INTEGER NOT NULL,  -- 所有学生的未知次数之和
+  last_session_at TEXT  -- 最近一次考勤的时间
+) WITHOUT ROWID;
+
+CREATE TABLE job (  -- 任务队列
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,  -- 任务类型，例如 attendance
+  payload TEXT NOT NULL,  -- json
+  status TEXT NOT NULL DEFAULT 'queued',  -- queued: 排队中, running: 执行中, done: 已完成, failed: 已失败
+  attempts INTEGER NOT NULL DEFAULT 0,  -- 已尝试执行的次数
+  worker TEXT,  -- 最近一次领取任务的 worker
+  lease_until REAL,  -- 租约到期的 unix 时间戳，到期后任务可以被其他 worker 重新领取
+  result TEXT,  -- json
+  metrics TEXT,  -- json，任务执行期间记录的指标（见 metrics.capture()），由服务端的 /metrics 汇总
+  metrics_collected_at TEXT,  -- 指标被 /metrics 汇总的时间，为 NULL 时表示尚未汇总
+  error TEXT,
+  created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  updated_at TEXT
 );
+
+CREATE INDEX job_status ON job (status, id);
+-- 尚未汇总的任务指标，见 collect_job_metrics()
+CREATE INDEX job_metrics_pending ON job (id) WHERE metrics IS NOT NULL AND metrics_collected_at IS NULL;
@@ -0,0 +1,326 @@
+"""
+人脸特征存储
+
+所有学生的人脸特征保存在同一个只追加的 float32 矩阵文件中，每行一个特征，
+每个进程以只读方式内存映射该文件，按行号读取一门课程的学生时不会复制整个文件。
+
+每名学生有一个最多 GALLERY_SIZE 个特征的照片库，第一个特征来自录入的照片，其余的特征可以由管理员添加，
+也可以在考勤时从置信度较高的匹配中自动添加，照片库已满时替换最早添加的非录入特征。
+学号到行号的索引保存在同样只追加的索引文件中，每行为以下三种之一，按顺序重放即可得到每名学生的照片库：
+"学号\\t行号" 表示以该行替换整个照片库，"学号\\t+行号" 表示将该行添加到照片库，"学号\\t-1" 表示删除（墓碑）。
+替换或删除学生的人脸特征后，旧的行成为无用数据，可以通过压缩去除
+
+压缩时写入新一代的矩阵与索引文件，再原子地替换 CURRENT 文件中记录的代数，
+因此读取方在任意时刻看到的矩阵与索引总是一致的
+
+用法：
+python store.py import [照片文件夹]  导入旧版本保存在照片文件夹中的 <学号>.npy 文件
+python store.py compact
+python store.py stats
+"""
+import argparse
+import glob
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows 下没有 fcntl，此时不支持多个进程同时写入
+    fcntl = None
+
+from config_local import DESCRIPTOR_STORE, PHOTO, GALLERY_SIZE
+
+# dlib 人脸特征向量的维度
+DESCRIPTOR_DIM = 128
+ROW_BYTES = DESCRIPTOR_DIM * np.dtype(np.float32).itemsize
+
+
+class DescriptorStore:
+    """内存映射的人脸特征存储，可以被多个进程同时读取，写入时通过文件锁互斥"""
+
+    def __init__(self, path: str, gallery_size: int):
+        self.path = path
+        self.gallery_size = gallery_size
+        self._lock = threading.RLock()
+        self._generation: Optional[int] = None
+        self._index: dict[str, list[int]] = {}  # 学号 -> 照片库中各特征的行号
+        self._index_offset = 0
+        self._matrix: np.ndarray = np.zeros((0, DESCRIPTOR_DIM), dtype=np.float32)
+
+    def matrix_path(self, generation: int) -> str:
+        return os.path.join(self.path, f'descriptors.{generation}.f32')
+
+    def index_path(self, generation: int) -> str:
+        return os.path.join(self.path, f'index.{generation}.log')
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._index)
+
+    def __contains__(self, username: str) -> bool:
+        with self._lock:
+            self._refresh()
+            return username in self._index
+
+    def rows(self, usernames: Iterable[str]) -> np.ndarray:
+        """返回形状为 (学生数, GALLERY_SIZE) 的各学生照片库所在的行号，空位为 -1"""
+        with self._lock:
+            self._refresh()
+            return self._rows(usernames)
+
+    def gather(self, usernames: Iterable[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        读取一组学生的照片库，返回 (行号, 特征, mask)，形状分别为 (N, K)、(N, K, DESCRIPTOR_DIM) 与 (N, K)，
+        只会读取并复制这些学生所在的行
+
+        行号与特征在同一次加锁中读取，不会因为其他线程刷新而互相不一致
+        """
+        with self._lock:
+            self._refresh()
+            rows = self._rows(usernames)
+            mask = rows >= 0
+            matrix = np.zeros(rows.shape + (DESCRIPTOR_DIM,), dtype=np.float32)
+            matrix[mask] = self._matrix[rows[mask]]
+            return rows, matrix, mask
+
+    def version(self) -> tuple[int, int]:
+        """存储的版本，任何写入或压缩都会使其发生变化"""
+        with self._lock:
+            self._refresh()
+            return self._generation, self._index_offset
+
+    def live_rows(self) -> tuple[int, np.ndarray, list[str]]:
+        """返回 (代数, 所有照片库中的行号, 各行对应的学号)，行号只在同一代中有效"""
+        with self._lock:
+            self._refresh()
+            items = [(row, username) for username, gallery in self._index.items() for row in gallery]
+            return self._generation, np.array([row for row, _ in items], dtype=np.int64), [u for _, u in items]
+
+    def read_rows(self, rows: np.ndarray) -> tuple[int, np.ndarray]:
+        """按行号读取特征，返回 (代数, 特征)，只会复制这些行"""
+        with self._lock:
+            self._refresh()
+            return self._generation, np.asarray(self._matrix[rows], dtype=np.float32)
+
+    def get(self, username: str) -> Optional[np.ndarray]:
+        """返回学生的照片库，形状为 (特征数, DESCRIPTOR_DIM)"""
+        _, matrix, mask = self.gather([username])
+        return matrix[0][mask[0]] if mask[0].any() else None
+
+    def put(self, username: str, descriptor: np.ndarray) -> None:
+        self.put_many([(username, descriptor)])
+
+    def put_many(self, items: list[tuple[str, np.ndarray]], append=False) -> None:
+        """
+        追加一批人脸特征，append 为 False 时以新的特征替换学生的整个照片库，
+        为 True 时将新的特征添加到照片库中，学生还没有任何特征时与替换相同
+        """
+        if not items:
+            return
+        matrix = np.array([np.asarray(descriptor).reshape(-1) for _, descriptor in items], dtype=np.float32)
+        with self._write_lock():
+            start_row = self._append_matrix(matrix)
+            self._append_index(
+                f'{username}\t{"+" if append else ""}{start_row + i}\n' for i, (username, _) in enumerate(items)
+            )
+            self._refresh()
+
+    def add(self, username: str, descriptor: np.ndarray) -> None:
+        self.put_many([(username, descriptor)], append=True)
+
+    def delete(self, usernames: Iterable[str]) -> int:
+        """删除学生的人脸特征，返回实际删除的数量"""
+        with self._write_lock():
+            usernames = [username for username in usernames if username in self._index]
+            self._append_index(f'{username}\t-1\n' for username in usernames)
+            self._refresh()
+        return len(usernames)
+
+    def compact(self) -> tuple[int, int]:
+        """去除被替换或删除的行，返回压缩前后的行数"""
+        with self._write_lock():
+            before = len(self._matrix)
+            # 按照片库中的顺序重新编号，照片库的第一个特征替换整个照片库，其余的特征依次添加
+            live = [
+                (username, row, '+' if i else '')
+                for username, gallery in self._index.items() for i, row in enumerate(gallery)
+            ]
+            generation = self._generation + 1
+
+            with open(self.matrix_path(generation), 'wb') as f:
+                # 分块写入，避免一次性将整个矩阵读入内存
+                for i in range(0, len(live), 4096):
+                    rows = [row for _, row, _ in live[i:i + 4096]]
+                    f.write(np.ascontiguousarray(self._matrix[rows]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path(generation), 'w', encoding='utf8') as f:
+                f.writelines(f'{username}\t{prefix}{row}\n' for row, (username, _, prefix) in enumerate(live))
+                f.flush()
+                os.fsync(f.fileno())
+
+            current_path = os.path.join(self.path, 'CURRENT')
+            with open(f'{current_path}.tmp', 'w') as f:
+                f.write(str(generation))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f'{current_path}.tmp', current_path)
+
+            old_generation = self._generation
+            self._refresh()
+            for path in [self.matrix_path(old_generation), self.index_path(old_generation)]:
+                try:
+                    os.remove(path)
+                except OSError:  # 文件不存在，或在 Windows 下仍被其他进程映射
+                    pass
+
+        return before, len(live)
+
+    def import_npy(self, photo_dir: str, batch_size=1024) -> int:
+        """导入照片文件夹中旧版本保存的 <学号>.npy 文件，已在存储中的学生会被跳过，返回导入的数量"""
+        paths = [
+            path for path in sorted(glob.glob(os.path.join(photo_dir, '*.npy')))
+            if os.path.basename(path)[:-len('.npy')] not in self
+        ]
+        for i in range(0, len(paths), batch_size):
+            self.put_many([
+                (os.path.basename(path)[:-len('.npy')], np.load(path)) for path in paths[i:i + batch_size]
+            ])
+        return len(paths)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            self._refresh()
+            live_rows = sum(len(gallery) for gallery in self._index.values())
+            return {
+                'generation': self._generation,
+                'students': len(self._index),
+                'gallery_rows': live_rows,
+                'rows': len(self._matrix),
+                'garbage_rows': len(self._matrix) - live_rows,
+                'bytes': len(self._matrix) * ROW_BYTES,
+            }
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        """进程内与进程间的写入互斥，获得锁后刷新到最新状态"""
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, open(os.path.join(self.path, 'LOCK'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+            yield
+
+    def _append_matrix(self, matrix: np.ndarray) -> int:
+        """追加若干行，返回第一行的行号"""
+        with open(self.matrix_path(self._generation), 'ab') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size % ROW_BYTES:  # 上次写入时中断，丢弃写了一半的行
+                f.truncate(size - size % ROW_BYTES)
+                size -= size % ROW_BYTES
+            f.write(matrix.tobytes())
+            f.flush()
+            # 索引必须在矩阵落盘后写入，这样索引中的行号总是有效的
+            os.fsync(f.fileno())
+        return size // ROW_BYTES
+
+    def _append_index(self, lines: Iterable[str]) -> None:
+        with open(self.index_path(self._generation), 'ab') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size > self._index_offset:  # 上次写入时中断，丢弃写了一半的行
+                f.truncate(self._index_offset)
+            f.write(''.join(lines).encode('utf8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rows(self, usernames: Iterable[str]) -> np.ndarray:
+        usernames = list(usernames)
+        rows = np.full((len(usernames), self.gallery_size), -1, dtype=np.int64)
+        for i, username in enumerate(usernames):
+            gallery = self._index.get(username, ())[:self.gallery_size]
+            rows[i, :len(gallery)] = gallery
+        return rows
+
+    def _read_generation(self) -> int:
+        try:
+            with open(os.path.join(self.path, 'CURRENT')) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _refresh(self) -> None:
+        """读取其他进程追加的索引，在其他进程压缩后重新打开文件"""
+        generation = self._read_generation()
+        if generation != self._generation:
+            self._generation = generation
+            self._index = {}
+            self._index_offset = 0
+            self._matrix = np.zeros((0, DESCRIPTOR_DIM), dtype=np.float32)
+
+        try:
+            with open(self.index_path(generation), 'rb') as f:
+                f.seek(self._index_offset)
+                data = f.read()
+        except FileNotFoundError:
+            if self._read_generation() != generation:  # 读取期间其他进程完成了压缩
+                return self._refresh()
+            data = b''
+
+        # 只处理完整的行，写了一半的最后一行留到下次
+        end = data.rfind(b'\n') + 1
+        max_row = -1
+        for line in data[:end].decode('utf8').splitlines():
+            username, row = line.split('\t')
+            append = row.startswith('+')
+            row = int(row)
+            if row < 0:
+                self._index.pop(username, None)
+                continue
+            gallery = self._index.get(username) if append else None
+            if gallery is None:
+                self._index[username] = [row]
+            else:
+                gallery.append(row)
+                # 照片库已满时保留录入的特征，替换最早添加的特征
+                if len(gallery) > self.gallery_size:
+                    del gallery[1]
+            max_row = max(max_row, row)
+        self._index_offset += end
+
+        # 内存映射的大小是固定的，其他进程追加了新的行后需要重新映射
+        if max_row >= len(self._matrix):
+            n_rows = os.path.getsize(self.matrix_path(generation)) // ROW_BYTES
+            self._matrix = np.memmap(
+                self.matrix_path(generation), dtype=np.float32, mode='r', shape=(n_rows, DESCRIPTOR_DIM)
+            )
+
+
+descriptor_store = DescriptorStore(DESCRIPTOR_STORE, GALLERY_SIZE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='人脸特征存储')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help='导入照片文件夹中的 <学号>.npy 文件')
+    import_parser.add_argument('photo_dir', nargs='?', default=PHOTO)
+    subparsers.add_parser('compact', help='去除被替换或删除的行')
+    subparsers.add_parser('stats', help='显示存储的统计信息')
+    args = parser.parse_args()
+
+    if args.command == 'import':
+        print(f'已导入 {descriptor_store.import_npy(args.photo_dir)} 名学生的人脸特征')
+    elif args.command == 'compact':
+        before, after = descriptor_store.compact()
+        print(f'压缩完成，{before} 行 -> {after} 行')
+    elif args.command == 'stats':
+        for key, value in descriptor_store.stats().items():
+            print(f'{key}: {value}')
+
+
+if __name__ == '__main__':
+    main()
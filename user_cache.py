@@ -0,0 +1,90 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, NamedTuple, Optional
+
+from config_local import USER_CACHE_SIZE, USER_CACHE_TTL
+
+
+class CachedUser(NamedTuple):
+    row: tuple  # user 表的一行，每次取出时重新构造 User，避免多个请求共享同一个可修改的对象
+    version: int  # 载入时 user.version 的值
+    checked_at: float  # 最近一次确认与数据库一致的时间（time.monotonic）
+
+
+class UserCache:
+    """
+    进程内的登录用户缓存，以 LRU 方式保留最多 max_entries 名用户
+
+    本进程修改用户时由 invalidate() 立即失效；其他进程的修改通过 user.version 发现：
+    条目在 ttl 秒内直接使用，超过 ttl 后需要调用者查询数据库中的版本号，一致时由 refresh() 续期，
+    因此其他进程的修改最多延迟 ttl 秒生效。ttl 为 0 时不缓存
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, CachedUser] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> tuple[Optional[CachedUser], bool]:
+        """返回缓存的条目及其是否仍在 ttl 内，不存在时返回 (None, False)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            self._entries.move_to_end(key)
+            fresh = time.monotonic() - entry.checked_at < self.ttl
+            if fresh:
+                self.hits += 1
+            else:
+                self.revalidations += 1
+            return entry, fresh
+
+    def put(self, key: Hashable, row: tuple, version: int) -> None:
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            # 并发载入时不让较旧的版本覆盖较新的版本
+            if entry is not None and entry.version > version:
+                return
+            self._entries[key] = CachedUser(row, version, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def refresh(self, key: Hashable, version: int) -> None:
+        """数据库中的版本号与缓存一致时续期"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.version == version:
+                self._entries[key] = entry._replace(checked_at=time.monotonic())
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+            }
+
+
+user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
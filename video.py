@@ -0,0 +1,193 @@
+"""
+视频考勤
+
+逐帧读取视频，不会将整个文件载入内存。画面中的人脸发生变化时密集抽帧，画面稳定时逐渐降低抽帧频率，
+抽中的帧经过人脸检测后按人脸框的 IoU 与已有的轨迹关联，每条轨迹只提取少量特征，
+最后每条轨迹取特征的平均值，合并属于同一个人的轨迹后作为一组人脸参与匹配
+
+需要安装 opencv-python-headless
+"""
+import time
+from typing import Optional
+
+import numpy as np
+
+from config_local import (
+    THRESHOLD, DETECTOR,
+    VIDEO_SAMPLE_INTERVAL, VIDEO_MAX_SAMPLE_INTERVAL, VIDEO_TRACK_IOU, VIDEO_TRACK_TTL,
+    VIDEO_EMBEDDINGS_PER_TRACK, VIDEO_EMBEDDING_INTERVAL
+)
+from core import detect_faces, compute_box_descriptors, add_timing
+from descriptor_cache import DESCRIPTOR_DIM
+from matching import linear_sum_assignment, merge_descriptors
+
+VIDEO_SUFFIXES = {'mp4', 'avi', 'mov', 'mkv', 'webm', 'm4v'}
+
+
+def is_video(path: str) -> bool:
+    return path.rsplit('.', 1)[-1].lower() in VIDEO_SUFFIXES
+
+
+def import_cv2():
+    try:
+        import cv2
+    except ImportError:
+        raise RuntimeError('视频考勤需要安装 opencv-python-headless') from None
+    return cv2
+
+
+class FaceTrack:
+    """一条人脸轨迹，box 为最近一次检测到的人脸框 left, top, right, bottom"""
+
+    __slots__ = ('box', 'last_seen', 'last_embedded', 'descriptors')
+
+    def __init__(self, box: np.ndarray, seen: float):
+        self.box = box
+        self.last_seen = seen
+        self.last_embedded = -np.inf
+        self.descriptors: list[np.ndarray] = []
+
+
+class FaceTracker:
+    """在抽中的帧之间跟踪人脸，并统计各项计数，detector 见 core.detect_faces()"""
+
+    def __init__(self, detector: str = DETECTOR):
+        self.detector = detector
+        self.active: list[FaceTrack] = []
+        self.finished: list[FaceTrack] = []
+
+        self.frames = 0
+        self.sampled_frames = 0
+        self.detections = 0
+        self.embeddings = 0
+
+    @property
+    def tracks(self) -> list[FaceTrack]:
+        return self.finished + self.active
+
+    def update(self, img: np.ndarray, seen: float, timings: Optional[dict[str, float]] = None) -> bool:
+        """处理一帧画面，返回画面中的人脸是否发生了变化（出现了新的人脸，或有人脸消失）"""
+        # 每一帧的人脸数不固定，cascade 模式下只复核 HOG 置信度较低的候选
+        faces = detect_faces(img, timings, self.detector)
+        self.sampled_frames += 1
+        self.detections += len(faces)
+
+        start = time.perf_counter()
+        boxes = np.array(
+            [[face.left(), face.top(), face.right(), face.bottom()] for face in faces], dtype=np.float64
+        ).reshape(-1, 4)
+        matched_tracks, matched_boxes = self._associate(boxes)
+        lost = len(self.active) - len(matched_tracks)
+
+        for track_index, box_index in zip(matched_tracks, matched_boxes):
+            track = self.active[track_index]
+            track.box = boxes[box_index]
+            track.last_seen = seen
+        new_boxes = np.setdiff1d(np.arange(len(boxes)), matched_boxes)
+        self.active.extend(FaceTrack(boxes[box_index], seen) for box_index in new_boxes)
+
+        # 消失时间过长的轨迹不再参与关联
+        expired = [track for track in self.active if seen - track.last_seen > VIDEO_TRACK_TTL]
+        if expired:
+            self.finished.extend(expired)
+            self.active = [track for track in self.active if seen - track.last_seen <= VIDEO_TRACK_TTL]
+        add_timing(timings, 'track', start)
+
+        # 这一帧中需要提取特征的人脸一次性提取
+        embedding_tracks = [
+            track for track in self.active
+            if track.last_seen == seen
+            and len(track.descriptors) < VIDEO_EMBEDDINGS_PER_TRACK
+            and seen - track.last_embedded >= VIDEO_EMBEDDING_INTERVAL
+        ]
+        if embedding_tracks:
+            descriptors = compute_box_descriptors(img, np.array([track.box for track in embedding_tracks]), timings)
+            for track, descriptor in zip(embedding_tracks, descriptors):
+                track.descriptors.append(descriptor)
+                track.last_embedded = seen
+            self.embeddings += len(embedding_tracks)
+
+        return len(new_boxes) > 0 or lost > 0
+
+    def descriptors(self, threshold=THRESHOLD) -> np.ndarray:
+        """每条轨迹取特征的平均值，再合并属于同一个人的轨迹（例如离开画面后又回到画面中）"""
+        track_descriptors = [
+            np.mean(track.descriptors, axis=0, keepdims=True) for track in self.tracks if track.descriptors
+        ]
+        if not track_descriptors:
+            return np.zeros((0, DESCRIPTOR_DIM), dtype=np.float32)
+        return merge_descriptors(track_descriptors, threshold=threshold)
+
+    def _associate(self, boxes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """按 IoU 将人脸框与已有的轨迹一对一关联，返回 (轨迹下标, 人脸框下标)"""
+        if not self.active or not len(boxes):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        iou = box_iou(np.array([track.box for track in self.active]), boxes)
+        rows, cols = linear_sum_assignment(1 - iou)
+        accepted = iou[rows, cols] >= VIDEO_TRACK_IOU
+        return rows[accepted], cols[accepted]
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """计算两组人脸框两两之间的 IoU，返回形状为 (len(a), len(b)) 的矩阵"""
+    inter_width = np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])
+    inter_height = np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])
+    inter = np.clip(inter_width, 0, None) * np.clip(inter_height, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def track_video(
+        video_path: str,
+        timings: Optional[dict[str, float]] = None,
+        detector: str = DETECTOR
+) -> FaceTracker:
+    """逐帧读取视频并跟踪其中的人脸"""
+    cv2 = import_cv2()
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise RuntimeError(f'无法打开视频 {video_path}')
+
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    tracker = FaceTracker(detector)
+    interval = VIDEO_SAMPLE_INTERVAL
+    next_sample = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            # grab() 只解码而不转换画面，未被抽中的帧不需要 retrieve()
+            if not capture.grab():
+                break
+            seen = tracker.frames / fps
+            tracker.frames += 1
+            if seen < next_sample:
+                add_timing(timings, 'decode', start)
+                continue
+
+            ok, frame = capture.retrieve()
+            if not ok:
+                break
+            img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            add_timing(timings, 'decode', start)
+
+            changed = tracker.update(img, seen, timings)
+            interval = VIDEO_SAMPLE_INTERVAL if changed else min(interval * 2, VIDEO_MAX_SAMPLE_INTERVAL)
+            next_sample = seen + interval
+    finally:
+        capture.release()
+
+    return tracker
+
+
+def detect_video_descriptors(
+        video_path: str,
+        timings: Optional[dict[str, float]] = None,
+        detector: str = DETECTOR
+) -> np.ndarray:
+    """返回视频中所有人的人脸特征，形状为 (人数, DESCRIPTOR_DIM)，timings 中会累加读取的帧数 frames"""
+    tracker = track_video(video_path, timings, detector)
+    if timings is not None:
+        timings['frames'] = timings.get('frames', 0) + tracker.frames
+    return tracker.descriptors()
@@ -0,0 +1,152 @@
+"""
+任务队列 worker，从数据库中领取任务并执行
+
+可以启动多个进程，也可以在共享同一个数据库（以及 TEMP 文件夹）的其他主机上运行
+
+用法：python worker.py [--processes 2]
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from flask import Flask, current_app
+
+import metrics
+from data_model import Job
+from db import claim_job, renew_job_lease, complete_job, fail_job, collect_pending_job_metrics
+
+
+def get_job_handlers() -> dict[str, Callable[[Job], Any]]:
+    # 延迟导入，避免 app 导入本模块时产生循环导入
+    from admin import run_enroll_job, run_roster_job
+    from attendance import run_attendance_job
+
+    return {
+        'attendance': run_attendance_job,
+        'enroll': run_enroll_job,
+        'roster': run_roster_job,
+    }
+
+
+def get_worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.current_thread().name}'
+
+
+def keep_lease(app: Flask, job: Job, worker: str, stop: threading.Event) -> None:
+    """在任务执行期间定期续约，防止耗时较长的任务被其他 worker 重新领取"""
+    lease_seconds = app.config['JOB_LEASE_SECONDS']
+    with app.app_context():
+        while not stop.wait(lease_seconds / 3):
+            if not renew_job_lease(job.id, worker, lease_seconds):
+                app.logger.warning(f'任务 {job.id} 的租约已被其他 worker 获得')
+                return
+
+
+def run_job(job: Job, worker: str) -> bool:
+    """执行一个已领取的任务，返回任务是否成功"""
+    app = current_app._get_current_object()
+    stop = threading.Event()
+    threading.Thread(target=keep_lease, args=(app, job, worker, stop), daemon=True).start()
+
+    start = time.time()
+    try:
+        # 任务中记录的指标随任务保存，由服务端的 collect_job_metrics() 汇总，避免在本进程中重复计入
+        # 执行失败时已记录的指标同样保存
+        with metrics.capture() as observations:
+            try:
+                result = get_job_handlers()[job.kind](job)
+            except Exception:
+                metrics.job_failures.inc(kind=job.kind)
+                raise
+    except Exception as e:
+        app.logger.exception(f'任务 {job.id}（{job.kind}）第 {job.attempts} 次执行失败')
+        fail_job(job.id, worker, str(e) or type(e).__name__, app.config['JOB_MAX_ATTEMPTS'], observations)
+        return False
+    else:
+        complete_job(job.id, worker, result, observations)
+        app.logger.info(f'任务 {job.id}（{job.kind}）执行完毕，耗时 {time.time() - start:.3f} 秒')
+        return True
+    finally:
+        stop.set()
+
+
+def collect_job_metrics(batch_size=500) -> None:
+    """
+    将任务保存的尚未汇总的指标计入本进程，由 /metrics 在导出前调用
+
+    取出指标与标记已汇总在同一个事务中完成，每个任务的指标只会被一个进程计入一次，
+    有多个服务端进程时需要将各进程导出的指标相加
+    """
+    while True:
+        batch = collect_pending_job_metrics(batch_size)
+        for observations in batch:
+            metrics.replay(observations)
+        if len(batch) < batch_size:
+            return
+
+
+def run_worker(app: Flask, stop: Optional[threading.Event] = None) -> None:
+    """不断领取并执行任务，直到 stop 被设置"""
+    stop = stop or threading.Event()
+    worker = get_worker_name()
+    kinds = list(get_job_handlers())
+    app.logger.info(f'worker {worker} 已启动')
+
+    while not stop.is_set():
+        try:
+            with app.app_context():
+                job = claim_job(worker, kinds, app.config['JOB_LEASE_SECONDS'], app.config['JOB_MAX_ATTEMPTS'])
+                if job is not None:
+                    run_job(job, worker)
+                    continue
+        except Exception:
+            app.logger.exception(f'worker {worker} 领取任务失败')
+        stop.wait(app.config['JOB_POLL_INTERVAL'])
+
+
+def start_worker_threads(app: Flask, count: int) -> list[threading.Thread]:
+    """在服务端进程内启动 worker 线程"""
+    threads = [
+        threading.Thread(target=run_worker, args=(app,), name=f'worker-{i}', daemon=True)
+        for i in range(count)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def worker_process() -> None:
+    from app import app, init_app
+    from core import models
+
+    init_app()
+    if app.config['MODEL_WARMUP']:
+        models.warm_up(app.logger)
+    run_worker(app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='任务队列 worker')
+    parser.add_argument('--processes', type=int, default=1, help='启动的 worker 进程数')
+    args = parser.parse_args()
+
+    if args.processes == 1:
+        worker_process()
+        return
+
+    processes = [
+        multiprocessing.Process(target=worker_process, name=f'worker-{i}')
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()